@@ -0,0 +1,29 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Diffs filesystem content against the APT installation sources.
+
+The entry point for library users is verify(); see apt_diff.api.
+"""
+
+def verify(paths=(), packages=(), options=None):
+  """Checks paths and packages, yielding findings as they are made. See
+     apt_diff.api.verify()."""
+  # Imported on first use so that the helper modules can be imported without
+  # python-apt.
+  from apt_diff import api
+  return api.verify(paths, packages, options)
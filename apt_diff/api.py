@@ -0,0 +1,331 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Library API for diff'ing filesystem content against the APT installation
+sources.
+
+The check runs in a background thread of the calling process (with the usual
+pipeline of child processes), and its findings are handed over as they are
+made. Most settings are module-level state shared with the child processes,
+so only one check may run at a time.
+"""
+
+import hashlib
+import json
+import os
+import Queue
+import shutil
+import sys
+import tempfile
+import threading
+
+from apt_diff import apt_helper
+from apt_diff import findings
+from apt_diff import io_helper
+from apt_diff import launch_helper
+from apt_diff import main
+from apt_diff import stats
+from apt_diff import trace
+
+# The options accepted by verify(), and their defaults. They correspond to the
+# command-line options of the same names.
+DEFAULT_OPTIONS = {
+    "apt_options": (),
+    "ignore_conffiles": False,
+    "no_ignore_extras": False,
+    "no_override_cache": False,
+    "report_unverifiable": False,
+    "tempdir": None,
+    "no_remove_extracted": False,
+    "resume": False,
+    "io_limit": None,
+    "drop_cache": False,
+    "nice": None,
+    "idle_io": False,
+    "jobs": None,
+    "timeout": None,
+    "ordered_reads": False,
+    "max_diff_size": None,
+    "stats": False,
+    "trace": None,
+    "top_packages": 0,
+    "roots": (),
+    "fork_server": False,
+    "hash_threads": False,
+    "shards": 1,
+    "sample": 1,
+    "sample_run": None,
+    "always_check": (),
+}
+
+# How often the consumer wakes up while waiting for findings, so that it can
+# be interrupted.
+_WAIT_SECONDS = 1.0
+# The file in the tempdir with the run number for the next sampled check of
+# each set of targets and number of slices.
+_SAMPLE_RUNS_FILE = "sample-runs"
+
+class _QueueWriter:
+  """Stands in for a findings.Writer, handing the findings to the consumer."""
+
+  def __init__(self, queue):
+    self.__queue = queue
+
+  def write(self, rec):
+    self.__queue.put(findings.Finding(rec))
+
+  def write_encoded(self, line):
+    rec = findings.decode(line)
+    if rec:
+      self.write(rec)
+
+def _ensure_dir(path):
+  """Ensure that the given directory is owned by this user and is writeable
+     by us only."""
+  if not os.path.isdir(path):
+    os.mkdir(path, 0755)
+  else:
+    os.chmod(path, 0755)
+
+def _sample_run_key(sample, targets):
+  """Gets the key of the run counter of the checks of the given targets (as
+     from main.AptDiff.targets()) in sample slices. Other checks don't
+     advance it, so that every slice of these targets is checked in turn."""
+  return "%d %s" % (sample, hashlib.md5("\0".join(targets)).hexdigest())
+
+def _load_sample_runs(tempdir):
+  """Gets the run numbers kept in the tempdir, by key."""
+  try:
+    with open(os.path.join(tempdir, _SAMPLE_RUNS_FILE)) as f:
+      runs = json.load(f)
+  except (IOError, ValueError):
+    return {}
+  if not isinstance(runs, dict):
+    return {}
+  return runs
+
+def _load_sample_run(tempdir, key):
+  """Gets the run number kept in the tempdir for a key, or 0 if there is
+     none."""
+  run = _load_sample_runs(tempdir).get(key, 0)
+  if not isinstance(run, int):
+    return 0
+  return run
+
+def _save_sample_run(tempdir, key, run):
+  """Keeps the run number for the next sampled check with a key in the
+     tempdir."""
+  runs = _load_sample_runs(tempdir)
+  runs[key] = run
+  path = os.path.join(tempdir, _SAMPLE_RUNS_FILE)
+  with open(path + ".tmp", "w") as f:
+    json.dump(runs, f)
+  os.rename(path + ".tmp", path)
+
+def _check_options(options):
+  unknown = set(options) - set(DEFAULT_OPTIONS)
+  if unknown:
+    raise ValueError("Unknown options: %s" % ", ".join(sorted(unknown)))
+  if options["jobs"] is not None and options["jobs"] < 1:
+    raise ValueError("jobs must be at least 1")
+  if options["timeout"] is not None and options["timeout"] <= 0:
+    raise ValueError("timeout must be positive")
+  if options["max_diff_size"] is not None and options["max_diff_size"] < 0:
+    raise ValueError("max_diff_size must not be negative")
+  if options["top_packages"] < 0:
+    raise ValueError("top_packages must not be negative")
+  if options["shards"] < 1:
+    raise ValueError("shards must be at least 1")
+  if options["sample"] < 1:
+    raise ValueError("sample must be at least 1")
+  if options["sample_run"] is not None and options["sample_run"] < 0:
+    raise ValueError("sample_run must not be negative")
+  if options["hash_threads"] and options["ordered_reads"]:
+    raise ValueError("hash_threads cannot be combined with ordered_reads")
+  if options["hash_threads"] and (options["nice"] is not None or
+                                  options["idle_io"]):
+    # The priority is only applied to the processes that we launch, and the
+    # threads hash in the calling one.
+    raise ValueError("hash_threads cannot be combined with nice or idle_io")
+  for root in options["roots"]:
+    if not os.path.isdir(root):
+      raise ValueError("Root %s is not a directory" % root)
+    if root.find(" ") != -1:
+      # This would mess up our processing pipeline.
+      raise ValueError("Spaces are not supported in root paths")
+
+def _configure(apt_diff, paths, packages, options):
+  """Applies the options. Returns the tempdir."""
+  apt_helper.initialize()
+  for (name, value) in options["apt_options"]:
+    apt_helper.set_option(name, value)
+  for path in paths:
+    apt_diff.check_path(path)
+  for pkgname in packages:
+    apt_diff.check_package(pkgname)
+  for root in options["roots"]:
+    apt_diff.add_root(root)
+  for path in options["always_check"]:
+    apt_diff.always_check(path)
+  apt_diff.ignore_conffiles = options["ignore_conffiles"]
+  apt_diff.no_ignore_extras = options["no_ignore_extras"]
+  apt_diff.report_unverifiable = options["report_unverifiable"]
+  apt_diff.resume = options["resume"]
+  apt_diff.jobs = options["jobs"]
+  apt_diff.timeout = options["timeout"]
+  apt_diff.ordered_reads = options["ordered_reads"]
+  apt_diff.hash_threads = options["hash_threads"]
+  apt_diff.shards = options["shards"]
+  apt_diff.sample = options["sample"]
+  apt_diff.show_stats = options["stats"]
+  apt_diff.top_packages = options["top_packages"]
+  if options["io_limit"]:
+    io_helper.set_rate_limit(options["io_limit"])
+  io_helper.set_drop_cache(options["drop_cache"])
+  if options["idle_io"]:
+    ioprio_class = launch_helper.IOPRIO_CLASS_IDLE
+  else:
+    ioprio_class = None
+  launch_helper.set_priority(options["nice"], ioprio_class)
+  # The pipeline always passes findings along as records; it's up to the
+  # consumer how to present them.
+  findings.set_max_diff_size(options["max_diff_size"])
+  stats.set_enabled(options["stats"] or bool(options["top_packages"]))
+  # Create default tempdir if none specified.
+  tempdir = options["tempdir"]
+  if not tempdir:
+    tempdir = os.path.join(tempfile.gettempdir(),
+                           "apt-diff_" + str(os.getuid()))
+    _ensure_dir(tempdir)
+  if tempdir.find(" ") != -1:
+    # This would mess up our processing pipeline.
+    raise ValueError("Spaces are not supported in the tempdir path")
+  if not options["no_override_cache"] and (os.getuid() or
+                                           apt_diff.has_roots()):
+    # Set default archive dir to one we can actually write to, and that
+    # doesn't belong to any of the systems being checked.
+    archive_dir = os.path.join(tempdir, "archives")
+    _ensure_dir(archive_dir)
+    _ensure_dir(os.path.join(archive_dir, "partial"))
+    apt_helper.set_option("Dir::Cache::Archives", archive_dir)
+  extraction_dir = os.path.join(tempdir, "extracted")
+  if os.path.lexists(extraction_dir):
+    # Extractions are reused within a run, but the archives they came from
+    # may have changed since the last one.
+    shutil.rmtree(extraction_dir)
+  _ensure_dir(extraction_dir)
+  apt_diff.extraction_dir = extraction_dir
+  apt_diff.checkpoint_dir = os.path.join(tempdir, "checkpoint")
+  apt_diff.manifest_dir = os.path.join(tempdir, "manifests")
+  _ensure_dir(apt_diff.manifest_dir)
+  apt_diff.index_dir = os.path.join(tempdir, "index")
+  if options["sample_run"] is not None:
+    apt_diff.sample_run = options["sample_run"]
+  else:
+    apt_diff.sample_run = _load_sample_run(
+        tempdir, _sample_run_key(options["sample"], apt_diff.targets()))
+  if options["trace"]:
+    trace_dir = os.path.join(tempdir, "trace")
+    if os.path.lexists(trace_dir):
+      shutil.rmtree(trace_dir)
+    os.mkdir(trace_dir, 0755)
+    trace.set_trace_dir(trace_dir)
+  return tempdir
+
+def _execute(apt_diff, options, tempdir, queue):
+  """Runs the check, then tells the consumer that it is over by passing None
+     or the exception that ended it."""
+  try:
+    try:
+      try:
+        apt_diff.execute()
+      finally:
+        launch_helper.stop_fork_server()
+      if options["sample"] > 1 and options["sample_run"] is None:
+        # The next run checks the next slice.
+        _save_sample_run(tempdir,
+                         _sample_run_key(options["sample"], apt_diff.targets()),
+                         apt_diff.sample_run + 1)
+      if options["trace"]:
+        trace.merge(options["trace"])
+    finally:
+      if options["trace"]:
+        shutil.rmtree(os.path.join(tempdir, "trace"))
+        trace.set_trace_dir(None)
+      if not options["no_remove_extracted"]:
+        # Recursively delete the extracted packages.
+        shutil.rmtree(apt_diff.extraction_dir)
+    queue.put(None)
+  except main.Cancelled:
+    queue.put(None)
+  except BaseException:
+    queue.put(sys.exc_info())
+
+def verify(paths=(), packages=(), options=None, preloaded=None):
+  """Diffs paths (recursively) and the paths owned by packages against their
+     packages, yielding a findings.Finding for each discrepancy or error as
+     soon as it is found.
+
+  The options are a dict of any of the keys in DEFAULT_OPTIONS, such as
+  {"jobs": 4, "roots": ["/srv/chroot"]}. The last findings are the
+  statistics, if asked for, and then the SUMMARY, which has the counts of
+  discrepancies and errors and of whatever was skipped or ignored (see
+  main.format_summary()). Warnings and progress are printed as prose.
+
+  The check stops early if the generator is closed (such as by breaking out
+  of a loop over it).
+
+  If the dpkg and APT state of this system is already loaded, it can be
+  passed as preloaded, a pair of a dpkg_helper.DpkgHelper that includes every
+  path and an apt_helper.AptHelper. It is not used for other roots.
+  """
+  all_options = dict(DEFAULT_OPTIONS)
+  all_options.update(options or {})
+  _check_options(all_options)
+  apt_diff = main.AptDiff(False, False, False, None)
+  apt_diff.preloaded = preloaded
+  tempdir = _configure(apt_diff, paths, packages, all_options)
+  queue = Queue.Queue()
+  apt_diff.writer = _QueueWriter(queue)
+  if all_options["fork_server"]:
+    # Everything that the stages need to inherit is set up by now, and nothing
+    # large has been loaded yet. Better to fork before starting any threads,
+    # too.
+    launch_helper.start_fork_server()
+  thread = threading.Thread(target=_execute,
+                            args=(apt_diff, all_options, tempdir, queue))
+  thread.daemon = True
+  thread.start()
+  finished = False
+  try:
+    while True:
+      try:
+        item = queue.get(True, _WAIT_SECONDS)
+      except Queue.Empty:
+        continue
+      if isinstance(item, findings.Finding):
+        yield item
+        continue
+      finished = True
+      if item:
+        raise item[0], item[1], item[2]
+      return
+  finally:
+    if not finished:
+      # Stopped early, whether by the consumer or by an interruption.
+      apt_diff.cancel()
+      thread.join()
@@ -17,41 +17,179 @@
 
 """A helper process for downloading the packages to be diff'ed."""
 
+import collections
+import os
+import signal
 import sys
+import time
 
+from apt_diff import apt_helper
+from apt_diff import findings
+from apt_diff import launch_helper
 from apt_diff import pollingtools
+from apt_diff import stats
+from apt_diff import trace
+
+# Input lines that start with this say that a file has the same content as
+# another file whose md5sum is being checked, so if that one fails then this
+# one should be diff'ed too. The format is
+# "=<pkgname> <other pkgname> <other filename>\0<filename>".
+ALIAS_PREFIX = "="
+ALIAS_SEPARATOR = "\0"
+_POLL_TIMEOUT_MS = 1000
 
 class AptFetcher:
   """Processing pipeline element for fetching packages via APT."""
 
-  def __init__(self, apt_helper):
+  def __init__(self, apt_helper, timeout):
     self.__apt_helper = apt_helper
+    self.__timeout = timeout
     self.__pkg_paths = {}
+    # Files waiting for their package to be fetched, by package name.
+    self.__waiting = {}
+    # Packages waiting to be fetched, in order.
+    self.__fetch_queue = collections.deque()
+    # The package, source, pid and start time of the fetch in progress.
+    self.__fetch = None
+    # Files with the same content as a file whose md5sum is being checked,
+    # keyed by the package and filename of that check.
+    self.__aliases = {}
+    # The package and filename of failed md5sum checks.
+    self.__failed = set()
+    # The filenames of md5sum checks that timed out or could not be done.
+    self.__errored = set()
+    self.__stats = {"latencies": [], "bytes": 0, "failed": 0, "packages": {}}
+
+  def __write(self, line):
+    self.__output_file.write(line + "\n")
+    self.__output_file.flush()
+
+  def __write_record(self, rec):
+    self.__output_file.write(findings.encode(rec))
+    self.__output_file.flush()
+
+  def __diff_file(self, first, pkgname, filename):
+    path = self.__pkg_paths[pkgname]
+    if path:
+      # Tell the next stage that it can unpack the package and diff the file.
+      self.__write("%s %s %s %s" % (first, pkgname, path, filename))
 
   def __fetch_package(self, pkgname, filename):
-    if pkgname not in self.__pkg_paths:
+    if pkgname in self.__pkg_paths:
+      self.__diff_file("F", pkgname, filename)
+    elif pkgname in self.__waiting:
+      self.__waiting[pkgname].append(filename)
+    else:
       # Haven't downloaded this package archive yet. Get it now.
-      path = self.__apt_helper.fetch_archive(pkgname)
-      self.__pkg_paths[pkgname] = path
-      # Informs the next stage that this is the first file to check in this
-      # package.
-      first = "T"
+      self.__waiting[pkgname] = [filename]
+      self.__fetch_queue.append(pkgname)
+      self.__start_next_fetch()
+
+  def __start_next_fetch(self):
+    if self.__fetch or not self.__fetch_queue:
+      return
+    pkgname = self.__fetch_queue.popleft()
+    apt_helper = self.__apt_helper
+
+    def fetch(input_files, output_file):
+      trace.set_process_name("fetch " + pkgname)
+      path = apt_helper.fetch_archive(pkgname)
+      if path:
+        output_file.write(path)
+
+    # The fetch is done in a child process so that it can be abandoned if it
+    # hangs.
+    (out_read, pid) = launch_helper.launch(fetch, [], [])
+    result = []
+    source = pollingtools.LineSource(
+        os.fdopen(out_read, "r"), self.__poller,
+        lambda source, text: result.append(text),
+        lambda source: self.__on_fetched(pkgname, "".join(result)))
+    self.__fetch = (pkgname, source, pid, time.time())
+
+  def __finish_fetch(self, pkgname, path):
+    latency = time.time() - self.__fetch[3]
+    self.__stats["latencies"].append(latency)
+    self.__stats["packages"][pkgname] = latency
+    trace.complete("fetch", self.__fetch[3], package=pkgname)
+    if path:
+      self.__stats["bytes"] = self.__stats["bytes"] + os.path.getsize(path)
     else:
-      path = self.__pkg_paths[pkgname]
-      first = "F"
+      self.__stats["failed"] = self.__stats["failed"] + 1
+    self.__pkg_paths[pkgname] = path
+    filenames = self.__waiting.pop(pkgname)
+    self.__fetch = None
     if not path:
-      if first == "T":
-        print >> sys.stderr, (
-            "Unable to fully check package %s because it could not be fetched"
-            % pkgname)
+      print >> sys.stderr, (
+          "Unable to fully check package %s because it could not be fetched"
+          % pkgname)
     else:
-      # Tell the next stage that it can unpack the package and diff the file.
-      self.__output_file.write("%s %s %s %s\n" %
-                               (first, pkgname, path, filename))
-      self.__output_file.flush()
+      # Informs the next stage that this is the first file to check in this
+      # package.
+      self.__diff_file("T", pkgname, filenames[0])
+      for filename in filenames[1:]:
+        self.__diff_file("F", pkgname, filename)
+    self.__start_next_fetch()
+
+  def __on_fetched(self, pkgname, path):
+    os.waitpid(self.__fetch[2], 0)
+    self.__finish_fetch(pkgname, path)
 
-  def __on_check_files(self, source, lines):
+  def __check_fetch_timeout(self):
+    if not self.__fetch or not self.__timeout:
+      return
+    (pkgname, source, pid, start_time) = self.__fetch
+    if time.time() - start_time < self.__timeout:
+      return
+    message = "Timed out fetching package %s" % pkgname
+    try:
+      os.kill(pid, signal.SIGKILL)
+    except OSError:
+      # Already gone.
+      pass
+    os.waitpid(pid, 0)
+    source.close()
+    # Let the differ know so that it gets counted as an error.
+    self.__write_record(findings.record(findings.ERROR, message,
+                                        packages=[pkgname]))
+    self.__finish_fetch(pkgname, None)
+
+  def __on_alias(self, line):
+    parts = line[len(ALIAS_PREFIX):].split(" ", 2)
+    if len(parts) != 3 or parts[2].find(ALIAS_SEPARATOR) == -1:
+      print >> sys.stderr, "Invalid input line to APT fetch stage: " + line
+      return
+    (other_filename, filename) = parts[2].split(ALIAS_SEPARATOR, 1)
+    key = (parts[1], other_filename)
+    if key in self.__failed or other_filename in self.__errored:
+      self.__fetch_package(parts[0], filename)
+    else:
+      self.__aliases.setdefault(key, []).append((parts[0], filename))
+
+  def __on_record(self, line):
+    rec = findings.decode(line)
+    if not rec or rec.get("type") != findings.ERROR or "path" not in rec:
+      return
+    # The md5sum check of a file timed out or failed, so nothing is known
+    # about the files with the same content. Check them by diff'ing instead.
+    filename = rec["path"].encode("utf-8")
+    self.__errored.add(filename)
+    for key in [key for key in self.__aliases if key[1] == filename]:
+      for (alias_pkgname, alias_filename) in self.__aliases.pop(key):
+        self.__fetch_package(alias_pkgname, alias_filename)
+
+  def __on_check_files(self, source, lines, failed_md5sums=False):
     for line in lines.splitlines():
+      if findings.is_record(line) or stats.is_stats(line):
+        # Findings and statistics from earlier stages are passed along to the
+        # differ.
+        self.__write(line)
+        if findings.is_record(line):
+          self.__on_record(line)
+        continue
+      if line.startswith(ALIAS_PREFIX):
+        self.__on_alias(line)
+        continue
       parts = line.split(' ', 1)
       if len(parts) != 2:
         print >> sys.stderr, "Invalid input line to APT fetch stage: " + line
@@ -59,16 +197,43 @@ class AptFetcher:
       pkgname = parts[0]
       filename = parts[1]
       self.__fetch_package(pkgname, filename)
+      if failed_md5sums:
+        # Anything with the same content has failed too.
+        key = (pkgname, filename)
+        self.__failed.add(key)
+        for (alias_pkgname, alias_filename) in self.__aliases.pop(key, []):
+          self.__fetch_package(alias_pkgname, alias_filename)
+
+  def __on_failed_md5sums(self, source, lines):
+    self.__on_check_files(source, lines, True)
 
   def run(self, input_files, output_file):
     """Run this pipeline element."""
     failed_md5sums_input_file = input_files[0]
     missing_md5sums_input_file = input_files[1]
+    trace.set_process_name("APT fetcher")
     self.__output_file = output_file
-    poller = pollingtools.Poller()
-    pollingtools.LineSource(failed_md5sums_input_file, poller,
-                            self.__on_check_files)
-    pollingtools.LineSource(missing_md5sums_input_file, poller,
+    self.__poller = pollingtools.Poller()
+    pollingtools.LineSource(failed_md5sums_input_file, self.__poller,
+                            self.__on_failed_md5sums)
+    pollingtools.LineSource(missing_md5sums_input_file, self.__poller,
                             self.__on_check_files)
-    while poller.has_pollers():
-      poller.poll()
+    while self.__poller.has_pollers():
+      self.__poller.poll(_POLL_TIMEOUT_MS)
+      self.__check_fetch_timeout()
+    if stats.is_enabled():
+      self.__output_file.write(stats.encode(stats.FETCHER, self.__stats))
+
+def create(timeout, root=""):
+  """Creates a processing pipeline function for fetching packages that loads
+     the APT cache of the system at root (or this one if root is empty) itself.
+
+  This is for processes that weren't forked with the cache already loaded,
+  such as those launched by the fork server.
+  """
+  def run(input_files, output_file):
+    """Run this pipeline element."""
+    if root:
+      apt_helper.set_root(root)
+    AptFetcher(apt_helper.AptHelper(), timeout).run(input_files, output_file)
+  return run
@@ -22,15 +22,66 @@ import apt_pkg
 import os
 import sys
 
+from apt_diff import manifest
+
 def initialize():
   """Initialize the apt_pkg module. Must be called before using anything else in
      this class."""
   apt_pkg.init_config()
   apt_pkg.init_system()
+  del _options[:]
+
+# The options that have been set explicitly, which take precedence over the
+# configuration of any root that is switched to.
+_options = []
 
 def set_option(name, value):
   """Set an arbitrary APT option."""
   apt_pkg.config.set(name, value)
+  _options.append((name, value))
+
+def set_root(root):
+  """Switch to the APT configuration and dpkg database of the system installed
+     at root, keeping the options that have been set explicitly."""
+  apt_pkg.init_config()
+  apt_pkg.config.set("Dir", root)
+  # The default is an absolute path, so it doesn't follow Dir.
+  apt_pkg.config.set("Dir::State::status",
+                     os.path.join(root, "var/lib/dpkg/status"))
+  main_file = apt_pkg.config.find_file("Dir::Etc::main")
+  if os.path.exists(main_file):
+    apt_pkg.read_config_file(apt_pkg.config, main_file)
+  parts_dir = apt_pkg.config.find_dir("Dir::Etc::parts")
+  if os.path.isdir(parts_dir):
+    apt_pkg.read_config_dir(apt_pkg.config, parts_dir)
+  # Keep the package cache in memory rather than writing it into the root.
+  apt_pkg.config.set("Dir::Cache::pkgcache", "")
+  apt_pkg.config.set("Dir::Cache::srcpkgcache", "")
+  for (name, value) in _options:
+    apt_pkg.config.set(name, value)
+  apt_pkg.init_system()
+
+def dpkg_admin_dir():
+  """Gets the dpkg database directory that APT is configured to use."""
+  return os.path.dirname(apt_pkg.config.find_file("Dir::State::status"))
+
+def cache_version():
+  """Gets something that changes whenever the installed packages or the
+     package lists that APT is configured to use change."""
+  version = []
+  for path in (apt_pkg.config.find_file("Dir::State::status"),
+               apt_pkg.config.find_dir("Dir::State::lists"),
+               apt_pkg.config.find_file("Dir::Etc::sourcelist"),
+               apt_pkg.config.find_dir("Dir::Etc::sourceparts")):
+    try:
+      st = os.stat(path)
+    except OSError:
+      version.append(None)
+      continue
+    # Files in these are replaced rather than rewritten, which changes the
+    # inode of a file or the modification time of a directory.
+    version.append((st.st_mtime, st.st_size, st.st_ino))
+  return version
 
 class AptHelper:
   """Wrapper for the APT cache's state and package downloading capability."""
@@ -48,6 +99,15 @@ class AptHelper:
     """Checks if the given package is installed."""
     return pkgname in self.__cache and bool(self.__cache[pkgname].current_ver)
 
+  def manifest_key(self, pkgname):
+    """Gets the manifest key of the named package's currently-installed
+       version, or None if it is not installed."""
+    if not self.is_installed(pkgname):
+      return None
+    pkg = self.__cache[pkgname]
+    ver = pkg.current_ver
+    return manifest.key(pkg.name, ver.ver_str, ver.arch)
+
   def fetch_archive(self, pkgname):
     """Downloads the archive for the named package's currently-installed version
        and returns the path to the downloaded file."""
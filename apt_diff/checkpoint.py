@@ -0,0 +1,196 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Routines for checkpointing the progress of a run so that it can be resumed
+after an interruption."""
+
+import json
+import os
+import shutil
+import sys
+import time
+import urllib
+
+from apt_diff import dpkg_helper
+
+# Prefixes of the journal files written by the md5sum and diff stages. Every
+# process writes its own journal (suffixed with its pid) so that no locking is
+# needed.
+MD5SUMS_JOURNAL = "md5sums."
+DIFFS_JOURNAL = "diffs."
+_POSITION_FILE = "position"
+# Prefix of the files recording the state of each dpkg database when the run
+# first reached it.
+_DPKG_STATE_FILE = "dpkg."
+# How often journals and the traversal position are written out, in seconds.
+CHECKPOINT_INTERVAL = 5.0
+_OK = "OK"
+_BAD = "BAD"
+
+
+def reset(checkpoint_dir):
+  """Discard any existing checkpoint and start a new one."""
+  if os.path.lexists(checkpoint_dir):
+    shutil.rmtree(checkpoint_dir)
+  os.mkdir(checkpoint_dir, 0755)
+
+
+def remove(checkpoint_dir):
+  """Remove the checkpoint after a run has completed."""
+  if os.path.lexists(checkpoint_dir):
+    shutil.rmtree(checkpoint_dir)
+
+
+def _drop_torn_record(path):
+  """Truncates a journal after its last complete record, if it exists."""
+  try:
+    f = open(path, "r+")
+  except IOError:
+    return
+  with f:
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    while end > 0:
+      start = max(end - 4096, 0)
+      f.seek(start)
+      newline = f.read(end - start).rfind("\n")
+      if newline >= 0:
+        end = start + newline + 1
+        break
+      end = start
+    f.truncate(end)
+
+
+class Journal:
+  """An append-only record of completed work, flushed periodically."""
+
+  def __init__(self, checkpoint_dir, prefix):
+    path = os.path.join(checkpoint_dir, prefix + str(os.getpid()))
+    # A resumed run can have the pid of the interrupted one, whose last
+    # record the new ones must not run on from.
+    _drop_torn_record(path)
+    self.__file = open(path, "a")
+    self.__last_flush = time.time()
+
+  def record(self, *fields):
+    """Record one completed unit of work. The last field may contain spaces."""
+    self.__file.write(" ".join(fields) + "\n")
+    now = time.time()
+    if now - self.__last_flush >= CHECKPOINT_INTERVAL:
+      self.__file.flush()
+      self.__last_flush = now
+
+  def record_md5sum(self, md5sum, filename, ok):
+    """Record the verdict of an md5sum check."""
+    if ok:
+      verdict = _OK
+    else:
+      verdict = _BAD
+    self.record(verdict, md5sum, filename)
+
+  def record_diff(self, pkgname, filename, discrepancies):
+    """Record the outcome of diff'ing a file against a package."""
+    self.record(str(discrepancies), pkgname, filename)
+
+  def close(self):
+    """Flush and close the journal."""
+    self.__file.close()
+
+
+def _read_journals(checkpoint_dir, prefix):
+  """Yields the fields of every complete record in the given journals."""
+  for filename in sorted(os.listdir(checkpoint_dir)):
+    if not filename.startswith(prefix):
+      continue
+    with open(os.path.join(checkpoint_dir, filename)) as f:
+      for line in f:
+        if line[-1] != "\n":
+          # Truncated by the interruption.
+          continue
+        parts = line[:-1].split(" ", 2)
+        if len(parts) != 3:
+          print >> sys.stderr, "Invalid checkpoint record in %s: %s" % (
+              filename, line)
+          continue
+        yield parts
+
+
+def load_md5sum_verdicts(checkpoint_dir):
+  """Loads a map of (md5sum, filename) to True if the file matched."""
+  verdicts = {}
+  for (verdict, md5sum, filename) in _read_journals(checkpoint_dir,
+                                                    MD5SUMS_JOURNAL):
+    verdicts[(md5sum, filename)] = verdict == _OK
+  return verdicts
+
+
+def load_diff_results(checkpoint_dir):
+  """Loads a map of (pkgname, filename) to the discrepancies found."""
+  results = {}
+  for (discrepancies, pkgname, filename) in _read_journals(checkpoint_dir,
+                                                           DIFFS_JOURNAL):
+    results[(pkgname, filename)] = int(discrepancies)
+  return results
+
+
+def save_position(checkpoint_dir, paths, last_path):
+  """Atomically record the paths being checked and how far we have got."""
+  position_file = os.path.join(checkpoint_dir, _POSITION_FILE)
+  tmp_file = position_file + ".tmp"
+  with open(tmp_file, "w") as f:
+    for path in paths:
+      f.write(path + "\n")
+    # A blank line separates the paths from the position.
+    f.write("\n" + last_path + "\n")
+  os.rename(tmp_file, position_file)
+
+
+def load_position(checkpoint_dir):
+  """Loads the recorded paths and position, or None if there is none."""
+  position_file = os.path.join(checkpoint_dir, _POSITION_FILE)
+  if not os.path.exists(position_file):
+    return None
+  with open(position_file) as f:
+    lines = [line.rstrip("\n") for line in f]
+  if len(lines) < 2 or lines[-2] != "":
+    return None
+  return (lines[:-2], lines[-1])
+
+
+def changed_packages(checkpoint_dir, admin_dir):
+  """Gets the set of packages whose info files changed since the run first
+     reached the dpkg database at admin_dir. The work done for them before an
+     interruption may no longer apply. The first time, records the state of
+     the database and returns an empty set."""
+  state_file = os.path.join(checkpoint_dir,
+                            _DPKG_STATE_FILE + urllib.quote(admin_dir, ""))
+  snapshot = dpkg_helper.info_snapshot(admin_dir)
+  try:
+    with open(state_file) as f:
+      old_snapshot = dict([(filename, tuple(version)) for (filename, version)
+                           in json.load(f).iteritems()])
+  except IOError:
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w") as f:
+      json.dump(snapshot, f)
+    os.rename(tmp_file, state_file)
+    return set()
+  except ValueError:
+    # Unreadable, so we can't tell what changed.
+    old_snapshot = {}
+  (packages, _) = dpkg_helper.snapshot_changes(old_snapshot, snapshot)
+  return packages
@@ -0,0 +1,229 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""A resident process that keeps the dpkg and APT state of this system loaded
+and checks paths and packages on request over a Unix socket.
+
+Each request is a line of JSON with the "paths", "packages" and "options" to
+pass to api.verify(), and is answered with a line of JSON for each finding.
+The prose that the check prints, such as warnings, is answered with a
+findings.MESSAGE record for each line. Requests are handled one at a time.
+"""
+
+import errno
+import json
+import os
+import socket
+import stat
+import sys
+import time
+
+from apt_diff import api
+from apt_diff import apt_helper
+from apt_diff import dpkg_helper
+from apt_diff import findings
+
+# The options that the loaded state depends on, which can't be changed for a
+# single request.
+_FIXED_OPTIONS = ("apt_options",)
+
+def _to_str(value):
+  """Converts the text in a decoded JSON value to bytes, like our paths."""
+  if isinstance(value, unicode):
+    return value.encode("utf-8")
+  if isinstance(value, list):
+    return [_to_str(item) for item in value]
+  if isinstance(value, dict):
+    return dict([(_to_str(k), _to_str(v)) for (k, v) in value.iteritems()])
+  return value
+
+class _State:
+  """The dpkg and APT state of this system, kept up to date."""
+
+  def __init__(self, apt_options):
+    self.__apt_options = apt_options
+    self.__configure()
+    self.dpkg_helper = dpkg_helper.DpkgHelper(
+        dpkg_helper.PathFilter(["/"]), apt_helper.dpkg_admin_dir(),
+        track_changes=True)
+    self.__apt_version = apt_helper.cache_version()
+    self.apt_helper = apt_helper.AptHelper()
+
+  def __configure(self):
+    # Each request leaves its own configuration behind.
+    apt_helper.initialize()
+    for (name, value) in self.__apt_options:
+      apt_helper.set_option(name, value)
+
+  def refresh(self):
+    """Picks up changes to the dpkg database and the package lists."""
+    self.__configure()
+    packages = self.dpkg_helper.refresh()
+    if packages:
+      print "Reloaded %d changed packages" % len(packages)
+    apt_version = apt_helper.cache_version()
+    if apt_version != self.__apt_version:
+      self.__apt_version = apt_version
+      self.apt_helper = apt_helper.AptHelper()
+      print "Reloaded the APT cache"
+
+class _MessageFile:
+  """Stands in for stdout while a request is handled, writing each line of
+     prose as a findings.MESSAGE record."""
+
+  def __init__(self, writer):
+    self.__writer = writer
+    self.__partial = ""
+    self.softspace = 0
+
+  def write(self, data):
+    lines = (self.__partial + data).split("\n")
+    self.__partial = lines.pop()
+    for line in lines:
+      self.__writer.write(findings.record(findings.MESSAGE, line))
+
+  def flush(self):
+    pass
+
+  def close(self):
+    if self.__partial:
+      self.write("\n")
+
+def _remove_stale_socket(socket_path):
+  """Removes the socket of a daemon that is no longer running."""
+  try:
+    st = os.lstat(socket_path)
+  except OSError:
+    return
+  if not stat.S_ISSOCK(st.st_mode):
+    raise Exception("%s exists and is not a socket" % socket_path)
+  probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    probe.connect(socket_path)
+  except socket.error, e:
+    if e.errno != errno.ECONNREFUSED:
+      raise
+    os.remove(socket_path)
+    return
+  finally:
+    probe.close()
+  raise Exception("Another daemon is already listening on %s" % socket_path)
+
+def _handle(connection, state, defaults):
+  """Answers a request."""
+  writer = findings.Writer(connection.makefile("wb"))
+  try:
+    try:
+      request = _to_str(json.loads(connection.makefile("rb").readline()))
+      if not isinstance(request, dict):
+        raise ValueError("Request is not an object")
+      options = dict(defaults)
+      for (name, value) in request.get("options", {}).iteritems():
+        if name in _FIXED_OPTIONS:
+          raise ValueError("Option %s can't be changed per request" % name)
+        options[name] = value
+    except ValueError, e:
+      writer.write(findings.record(findings.ERROR, "Bad request: %s" % e))
+      return
+    # The prose is the client's, not ours.
+    sys.stdout.flush()
+    old_stdout = sys.stdout
+    sys.stdout = _MessageFile(writer)
+    try:
+      time1 = time.time()
+      state.refresh()
+      print "Checking %s (refreshed in %g seconds)" % (
+          " ".join(request.get("paths", []) + request.get("packages", [])),
+          time.time() - time1)
+      results = api.verify(request.get("paths", []),
+                           request.get("packages", []), options,
+                           (state.dpkg_helper, state.apt_helper))
+      try:
+        for finding in results:
+          writer.write(finding.record())
+      except Exception, e:
+        writer.write(findings.record(findings.ERROR,
+                                     "Check failed: %s: %s" % (type(e), e)))
+      finally:
+        # Stops the check if the client went away.
+        results.close()
+    finally:
+      sys.stdout.close()
+      sys.stdout = old_stdout
+  finally:
+    writer.close()
+
+def serve(socket_path, options=None):
+  """Loads the state of this system and answers requests on socket_path until
+     interrupted.
+
+  The options are the defaults for every request, in the form that
+  api.verify() takes. Requests may override any of them but the apt_options.
+  """
+  options = options or {}
+  _remove_stale_socket(socket_path)
+  time1 = time.time()
+  state = _State(options.get("apt_options", ()))
+  print "Loaded the dpkg database and APT cache in %g seconds" % (
+      time.time() - time1)
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  # Only our own user may ask us to read files.
+  old_umask = os.umask(077)
+  try:
+    listener.bind(socket_path)
+  finally:
+    os.umask(old_umask)
+  try:
+    listener.listen(5)
+    print "Listening on %s" % socket_path
+    sys.stdout.flush()
+    while True:
+      (connection, _) = listener.accept()
+      try:
+        _handle(connection, state, options)
+      except socket.error, e:
+        print >> sys.stderr, "Lost the client: %s" % e
+      finally:
+        connection.close()
+      sys.stdout.flush()
+  finally:
+    listener.close()
+    os.remove(socket_path)
+
+def request(socket_path, paths=(), packages=(), options=None):
+  """Asks the daemon listening on socket_path to check paths and packages,
+     yielding a findings.Finding for each discrepancy or error like
+     api.verify()."""
+  # The daemon may have a different working directory.
+  options = dict(options or {})
+  for name in ("tempdir", "trace"):
+    if options.get(name):
+      options[name] = os.path.abspath(options[name])
+  for name in ("roots", "always_check"):
+    if options.get(name):
+      options[name] = [os.path.abspath(path) for path in options[name]]
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    connection.connect(socket_path)
+    connection.sendall(json.dumps(
+        {"paths": [os.path.abspath(path) for path in paths],
+         "packages": list(packages), "options": options}) + "\n")
+    connection.shutdown(socket.SHUT_WR)
+    for line in connection.makefile("rb"):
+      yield findings.Finding(json.loads(line))
+  finally:
+    connection.close()
@@ -0,0 +1,193 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Helper routines for finding out what kind of storage paths live on."""
+
+import fcntl
+import multiprocessing
+import os
+import re
+import struct
+
+_MOUNTINFO = "/proc/self/mountinfo"
+_SYS_CLASS_BLOCK = "/sys/class/block/"
+
+# Kinds of storage.
+HDD = "hdd"
+SSD = "ssd"
+NVME = "nvme"
+NETWORK = "network"
+OTHER = "other"
+
+_NETWORK_FSTYPES = frozenset(["nfs", "nfs4", "cifs", "smb3", "smbfs", "ceph",
+                              "glusterfs", "9p", "afs", "fuse.sshfs",
+                              "fuse.glusterfs", "fuse.s3fs"])
+# Filesystems that never contain package-owned files.
+_PSEUDO_FSTYPES = frozenset(["proc", "sysfs", "devtmpfs", "devpts", "cgroup",
+                             "cgroup2", "securityfs", "debugfs", "tracefs",
+                             "pstore", "bpf", "mqueue", "hugetlbfs",
+                             "configfs", "fusectl", "binfmt_misc", "autofs",
+                             "efivarfs", "rpc_pipefs", "nsfs"])
+
+# The FIEMAP ioctl reports where a file's extents are on the device.
+_FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap: fm_start, fm_length, fm_flags, fm_mapped_extents,
+# fm_extent_count, fm_reserved.
+_FIEMAP_HEADER = "=QQLLLL"
+# struct fiemap_extent: fe_logical, fe_physical, fe_length, fe_reserved64[2],
+# fe_flags, fe_reserved[3].
+_FIEMAP_EXTENT = "=QQQ2QL3L"
+_FIEMAP_FLAG_SYNC = 1
+
+_OCTAL_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+
+def _unescape(field):
+  # mountinfo escapes spaces and other awkward characters in octal.
+  return _OCTAL_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+def _read_sysfs(path):
+  try:
+    with open(path) as f:
+      return f.read().strip()
+  except IOError:
+    return None
+
+
+def _block_device_kind(source):
+  """Classifies a block device given the source field of a mount."""
+  if not source.startswith("/dev/"):
+    return OTHER
+  name = os.path.basename(os.path.realpath(source))
+  sys_dir = os.path.realpath(_SYS_CLASS_BLOCK + name)
+  if not os.path.isdir(os.path.join(sys_dir, "queue")):
+    # It's a partition, so the queue belongs to the parent device.
+    sys_dir = os.path.dirname(sys_dir)
+  rotational = _read_sysfs(os.path.join(sys_dir, "queue", "rotational"))
+  if rotational is None:
+    return OTHER
+  if rotational == "1":
+    return HDD
+  if os.path.basename(sys_dir).startswith("nvme"):
+    return NVME
+  return SSD
+
+
+def physical_offset(filename):
+  """Gets the offset on its device of the start of a file, or None if it isn't
+     known (e.g., the file is empty or the filesystem doesn't support FIEMAP).
+  """
+  try:
+    fileno = os.open(filename, os.O_RDONLY | os.O_NONBLOCK)
+  except OSError:
+    return None
+  try:
+    # Ask for the first extent only.
+    request = (struct.pack(_FIEMAP_HEADER, 0, 0xFFFFFFFFFFFFFFFF,
+                           _FIEMAP_FLAG_SYNC, 0, 1, 0) +
+               "\0" * struct.calcsize(_FIEMAP_EXTENT))
+    try:
+      reply = fcntl.ioctl(fileno, _FS_IOC_FIEMAP, request)
+    except IOError:
+      return None
+  finally:
+    os.close(fileno)
+  header_size = struct.calcsize(_FIEMAP_HEADER)
+  mapped_extents = struct.unpack(_FIEMAP_HEADER, reply[:header_size])[3]
+  if not mapped_extents:
+    return None
+  return struct.unpack(_FIEMAP_EXTENT, reply[header_size:])[1]
+
+
+class Mount:
+  """A Mount describes one entry in the mount table."""
+
+  def __init__(self, dev, mount_point, fstype, source):
+    self.dev = dev
+    self.mount_point = mount_point
+    self.fstype = fstype
+    self.source = source
+    if fstype in _NETWORK_FSTYPES:
+      self.kind = NETWORK
+    else:
+      self.kind = _block_device_kind(source)
+
+  def suggested_workers(self):
+    """Suggests how many processes should read from this mount at once."""
+    cpus = multiprocessing.cpu_count()
+    if self.kind == HDD:
+      # More than one reader per spindle just causes seeking.
+      return 1
+    elif self.kind == NVME:
+      # Deep queues are needed to get the most out of NVMe.
+      return 2 * cpus
+    elif self.kind == NETWORK:
+      # Reads are latency-bound, but don't hammer the server.
+      return 4
+    else:
+      return cpus
+
+
+class MountTable:
+  """A snapshot of the mount table."""
+
+  def __init__(self):
+    self.__mounts = []
+    try:
+      f = open(_MOUNTINFO)
+    except IOError:
+      return
+    with f:
+      for line in f:
+        fields = line.split()
+        try:
+          separator = fields.index("-")
+          (major, minor) = fields[2].split(":")
+        except ValueError:
+          continue
+        fstype = fields[separator + 1]
+        if fstype in _PSEUDO_FSTYPES:
+          continue
+        self.__mounts.append(Mount(os.makedev(int(major), int(minor)),
+                                   _unescape(fields[4]),
+                                   fstype,
+                                   _unescape(fields[separator + 2])))
+    # Later mounts hide earlier ones at the same mount point.
+    by_mount_point = {}
+    for mount in self.__mounts:
+      by_mount_point[mount.mount_point] = mount
+    self.__mounts = sorted(by_mount_point.values(),
+                           key=lambda m: m.mount_point)
+
+  def multiply_mounted_devs(self):
+    """Gets the set of devices that are mounted in more than one place, such
+       as by bind mounts."""
+    seen = set()
+    result = set()
+    for mount in self.__mounts:
+      if mount.dev in seen:
+        result.add(mount.dev)
+      seen.add(mount.dev)
+    return result
+
+  def lookup_dev(self, dev):
+    """Finds a mount of the device with the given st_dev, if any."""
+    for mount in self.__mounts:
+      if mount.dev == dev:
+        return mount
+    return None
@@ -21,16 +21,169 @@ them to the ones on disk."""
 import os
 import subprocess
 import sys
+import time
 
+from apt_diff import checkpoint
 from apt_diff import dpkg_helper
+from apt_diff import findings
+from apt_diff import io_helper
+from apt_diff import manifest
+from apt_diff import path_index
+from apt_diff import root_helper
+from apt_diff import stats
+from apt_diff import trace
 
-def create(extraction_dir):
-  """Creates a processing pipeline function for running diff."""
+_READ_SIZE = 4096 * 16
+# Marks an archive whose extraction has completed.
+_EXTRACTED_SUFFIX = ".extracted"
+
+def _size(filename):
+  try:
+    return os.stat(filename).st_size
+  except OSError:
+    return 0
+
+def _capture_diff(extracted_filename, filename):
+  """Diffs two files, keeping the output up to the size limit for records.
+
+  Returns the exit status of diff, the output kept (or None if diffs are left
+  out of records) and whether it was truncated.
+  """
+  limit = findings.max_diff_size()
+  with open(os.devnull, "w") as devnull:
+    if limit == 0:
+      return (subprocess.call(["diff", "-q", extracted_filename, filename],
+                              stdout = devnull), None, False)
+    process = subprocess.Popen(["diff", "-u", extracted_filename, filename],
+                               stdout = subprocess.PIPE)
+  kept = []
+  kept_size = 0
+  truncated = False
+  while True:
+    data = process.stdout.read(_READ_SIZE)
+    if not data:
+      break
+    if limit is not None and kept_size + len(data) > limit:
+      # Keep reading so that diff can finish.
+      data = data[:limit - kept_size]
+      truncated = True
+    kept.append(data)
+    kept_size = kept_size + len(data)
+  process.stdout.close()
+  return (process.wait(), "".join(kept), truncated)
+
+def _open_index(index_path):
+  """Maps the records of the path_index.PathIndex in the directory
+     index_path, or returns None if there isn't a usable one."""
+  if not index_path:
+    return None
+  try:
+    return path_index.MappedIndex(index_path)
+  except (IOError, ValueError), e:
+    print >> sys.stderr, "Not using the path index: %s" % e
+    return None
+
+class _StateIndex:
+  """Looks the packages of a path up in a loaded dpkg state, like a
+     path_index.MappedIndex."""
+
+  def __init__(self, dpkg_state):
+    self.__dpkg_state = dpkg_state
+
+  def lookup(self, normpath):
+    node = self.__dpkg_state.lookup(normpath)
+    if not node:
+      return []
+    owners = node.owners()
+    package_info = node.package_info()
+    result = []
+    for pkgname in sorted(set(owners) | set(package_info)):
+      md5sum = None
+      if pkgname in package_info:
+        md5sum = package_info[pkgname].md5sum()
+      result.append((pkgname, pkgname in owners, md5sum))
+    return result
+
+  def close(self):
+    pass
+
+def create(extraction_dir, checkpoint_dir, manifest_dir, root="",
+           index_path=None, dpkg_state=None):
+  """Creates a processing pipeline function for running diff.
+
+  The files are those of the system installed at root. Archives are unpacked
+  into extraction_dir, where they are reused by later pipelines that need the
+  same archive. The manifest of every archive that is unpacked is recorded in
+  manifest_dir.
+
+  If the directory of an up-to-date path_index.PathIndex of the system is
+  given, the records of files that differ name every package that owns them
+  and the md5sum that the package has for them. So do they if the
+  dpkg_helper.DpkgHelper of the system is given instead, with every path
+  loaded, such as in the daemon.
+  """
   def run(input_files, output_file):
     """Run this pipeline element."""
+    trace.set_process_name("differ")
     input_file = input_files[0]
+    resolver = root_helper.Resolver(root)
+    journal = checkpoint.Journal(checkpoint_dir, checkpoint.DIFFS_JOURNAL)
+    if dpkg_state:
+      index = _StateIndex(dpkg_state)
+    else:
+      index = _open_index(index_path)
+    # The packages map to the seconds spent extracting and diff'ing each.
+    totals = {"extracted": 0, "extraction_seconds": 0.0, "diffs": 0,
+              "diff_seconds": 0.0, "packages": {}}
+    try:
+      (discrepancies, errors) = _run(input_file, output_file, journal, totals,
+                                     index, resolver)
+    finally:
+      journal.close()
+      if index:
+        index.close()
+    if stats.is_enabled():
+      output_file.write(stats.encode(stats.DIFFER, totals))
+    # Write the final counts to our output.
+    output_file.write("%d %d" % (discrepancies, errors))
+
+  def _report(output_file, rec):
+    output_file.write(findings.encode(rec))
+    output_file.flush()
+
+  def _modified(index, pkgname, filename, message, **fields):
+    """Creates the record of a file that differs from its package."""
+    packages = [pkgname]
+    if index:
+      for (owner, listed, md5sum) in index.lookup(filename[len(root):]):
+        if owner == pkgname:
+          if md5sum is not None:
+            fields["md5sum"] = md5sum
+        elif listed:
+          # Other packages that ship the file are concerned too.
+          packages.append(owner)
+    return findings.record(findings.MODIFIED, message, path=filename,
+                           packages=packages, **fields)
+
+  def _run(input_file, output_file, journal, totals, index, resolver):
     discrepancies = 0
-    for line in input_file:
+    errors = 0
+    # Not "for line in input_file", which reads ahead and would hold back
+    # findings until a whole block of input has arrived.
+    for line in iter(input_file.readline, ""):
+      if stats.is_stats(line):
+        # Pass it on to the main process.
+        output_file.write(line)
+        continue
+      if findings.is_record(line):
+        rec = findings.decode(line)
+        if rec and rec.get("type") == findings.ERROR:
+          # An earlier stage was unable to check something.
+          errors = errors + 1
+        # Pass it on to be written out.
+        output_file.write(line.rstrip("\n") + "\n")
+        output_file.flush()
+        continue
       if line[-1] != "\n":
         print >> sys.stderr, "Unexpected line from APT fetch stage: " + line
         continue
@@ -39,24 +192,62 @@ def create(extraction_dir):
       pkgname = parts[1]
       path = parts[2]
       filename = " ".join(parts[3:])
-      extract_path = os.path.join(extraction_dir, pkgname)
-      if first:
+      # Key the extraction by archive so that it can be shared with other
+      # roots that have the same version installed.
+      extract_path = os.path.join(extraction_dir,
+                                  os.path.splitext(os.path.basename(path))[0])
+      if first and not os.path.exists(extract_path + _EXTRACTED_SUFFIX):
         # Unpack the package.
+        io_helper.consume(_size(path))
+        start = time.time()
         dpkg_helper.extract_archive(path, extract_path)
+        elapsed = time.time() - start
+        totals["extracted"] = totals["extracted"] + 1
+        totals["extraction_seconds"] = totals["extraction_seconds"] + elapsed
+        cost = totals["packages"].setdefault(pkgname, [0.0, 0.0])
+        cost[0] = cost[0] + elapsed
+        trace.complete("extract", start, package=pkgname)
+        manifest.record_archive(manifest_dir, path)
+        open(extract_path + _EXTRACTED_SUFFIX, "w").close()
       # See if it actually contains this file. (It is possible that the
       # installed package came from a different repository and thus could have
       # a different set of files.)
-      extracted_filename = extract_path + filename
+      extracted_filename = extract_path + filename[len(root):]
       if not os.path.lexists(extracted_filename):
-        print ("File %s supposedly owned by package %s was not found in it" %
-               (filename, pkgname))
-        discrepancies = discrepancies + 1
+        message = ("File %s supposedly owned by package %s was not found in it"
+                   % (filename, pkgname))
+        _report(output_file, _modified(index, pkgname, filename, message))
+        found = 1
       else:
-        # Diff the file.
-        ret = subprocess.call(["diff", "-u", extracted_filename, filename])
+        try:
+          host_filename = resolver.host_path(filename)
+        except OSError:
+          # Left for diff to report.
+          host_filename = filename
+        # Diff the file. diff reads both files in full.
+        io_helper.consume(_size(extracted_filename) + _size(host_filename))
+        start = time.time()
+        (ret, diff, truncated) = _capture_diff(extracted_filename,
+                                               host_filename)
         if ret != 0:
-          # Increment the count of the number of discrepancies.
-          discrepancies = discrepancies + 1
-    # Write the final count to our output.
-    output_file.write(str(discrepancies))
+          fields = {}
+          if diff is not None:
+            fields["diff"] = diff
+            fields["diff_truncated"] = truncated
+          _report(output_file, _modified(
+              index, pkgname, filename,
+              "File %s differs from package %s" % (filename, pkgname),
+              **fields))
+        io_helper.done_reading_path(host_filename)
+        elapsed = time.time() - start
+        totals["diffs"] = totals["diffs"] + 1
+        totals["diff_seconds"] = totals["diff_seconds"] + elapsed
+        cost = totals["packages"].setdefault(pkgname, [0.0, 0.0])
+        cost[1] = cost[1] + elapsed
+        trace.complete("diff", start, path=filename, package=pkgname)
+        found = int(ret != 0)
+      journal.record_diff(pkgname, filename, found)
+      # Increment the count of the number of discrepancies.
+      discrepancies = discrepancies + found
+    return (discrepancies, errors)
   return run
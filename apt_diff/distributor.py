@@ -18,73 +18,276 @@
 """Routines for distributing line-based processing across different
 processes."""
 
+import collections
+import os
+import signal
+import time
+
 from apt_diff import pollingtools
+from apt_diff import stats
+
+DEFAULT_MAX_PROCESSES = 5
+# Another process is spawned once every process has this many lines queued.
+_SPAWN_QUEUE_DEPTH = 2
+# Processes that have had nothing queued for this long are retired.
+_IDLE_SECONDS = 2.0
+_POLL_TIMEOUT_MS = 1000
+# When sorting, input is gathered into batches of up to this many lines.
+_SORT_BATCH_SIZE = 50000
+# How often the queue depth is sampled when collecting statistics.
+_STATS_SAMPLE_SECONDS = 1.0
+
+def _split_lines(text):
+  """Splits text into lines, keeping the newlines."""
+  lines = [line + "\n" for line in text.split("\n")]
+  # The last element is either empty or a partial last line.
+  lines[-1] = lines[-1][:-1]
+  if not lines[-1]:
+    del lines[-1]
+  return lines
 
-_DEFAULT_MAX_PROCESSES = 5
+def _reap(pid):
+  """Waits for a process that has exited or been killed, so that it doesn't
+     linger as a zombie."""
+  try:
+    os.waitpid(pid, 0)
+  except OSError:
+    # Already waited for.
+    pass
+
+class _Process:
+  """Bookkeeping for a process that input is distributed to."""
+
+  def __init__(self, pid, sink, pool):
+    self.pid = pid
+    self.sink = sink
+    self.source = None
+    # The pool of processes that this one belongs to.
+    self.pool = pool
+    # The lines given to the process that it has not answered yet.
+    self.queued = collections.deque()
+    # When the process last answered a line, or was given one while idle.
+    self.since = time.time()
 
 def run(input_file, output_file, spawner_function,
-        max_processes=_DEFAULT_MAX_PROCESSES):
+        max_processes=DEFAULT_MAX_PROCESSES, key_function=None,
+        max_processes_function=None, timeout=None, timeout_function=None,
+        sort_key_function=None, max_queued=None):
   """Run a pipeline element to distribute processing of input across multiple
-     processes."""
+     processes.
+
+  The spawner_function must return the input and output pipes and the pid of
+  a new process. The processes must write exactly one line of output for each
+  line of input, in order. A blank line means that there is no output for
+  that input; these are dropped. This tells us how deep the queue of work is
+  for each process, which is used to spawn processes as needed, up to
+  max_processes, and to retire them again when they go idle.
+
+  If a key_function is given, each line is assigned to the pool of processes
+  for the key that it returns, and each pool is limited independently to
+  max_processes_function(key) processes (or max_processes if that is None).
+
+  If a timeout is given, a process that takes longer than that many seconds
+  to answer a line is killed and its other lines are given to other
+  processes. The output for the line that timed out is
+  timeout_function(line), if any.
+
+  If a sort_key_function is given, input is gathered into batches (until the
+  batch is full or the input ends) and each batch is distributed in order of
+  sort_key_function(line).
+
+  If max_queued is given, input is only read while fewer than that many lines
+  are waiting for an answer, so that a slow pool holds up its input rather
+  than piling it all up in memory.
+  """
   if max_processes < 1:
     raise ValueError("max_processes must be at least 1")
   poller = pollingtools.Poller()
   sink = pollingtools.LineSink(output_file, poller)
-  process_sources = []
+  # The processes that are still accepting input in each pool.
+  pools = {}
+  pool_limits = {}
+  # All processes whose output we are still reading.
+  live_processes = []
+  input_closed = [False]
+  batch = []
+  start_time = time.time()
+  # Samples of the elapsed time, the lines queued and the live processes.
+  queue_depth = []
+  # The number of lines given to processes that have not been answered yet.
+  queued = [0]
+  input_source = [None]
+
+  def spawn(processes):
+    """Spawns a new process and starts listening to its output."""
+    (in_pipe, out_pipe, pid) = spawner_function()
+    process = _Process(pid, pollingtools.LineSink(in_pipe, poller), processes)
 
-  def on_process_source_lines(source, lines):
-    """Called when there is output data available from a process."""
-    # Just write the lines to the output.
-    sink.write_lines(lines)
+    def on_process_source_lines(source, lines):
+      """Called when there is output data available from a process."""
+      lines = _split_lines(lines)
+      for line in lines:
+        if process.queued:
+          process.queued.popleft()
+          queued[0] = queued[0] - 1
+      process.since = time.time()
+      if max_queued and queued[0] < max_queued:
+        input_source[0].resume()
+      output = "".join([line for line in lines if line != "\n"])
+      if output:
+        sink.write_lines(output)
 
-  def on_process_source_closed(source):
-    """Called when a process's output pipe is closed."""
-    process_sources.remove(source)
-    if not process_sources:
+    def on_process_source_closed(source):
+      """Called when a process's output pipe is closed."""
+      # The process is exiting, whether its input ran out or it was retired.
+      _reap(process.pid)
+      live_processes.remove(process)
+      close_output_if_done()
+
+    process.source = pollingtools.LineSource(out_pipe, poller,
+                                             on_process_source_lines,
+                                             on_process_source_closed)
+    live_processes.append(process)
+    processes.append(process)
+    return process
+
+  def close_output_if_done():
+    if not live_processes and input_closed[0]:
+      if stats.is_enabled():
+        sample_queue_depth()
+        sink.write_lines(stats.encode(stats.DISTRIBUTOR,
+                                      {"queue_depth": queue_depth}))
       # No sources left, so close the output
       sink.close()
 
-  process_sinks = []
-  next_sink = [0]
+  def sample_queue_depth():
+    depth = 0
+    for process in live_processes:
+      depth = depth + len(process.queued)
+    queue_depth.append((time.time() - start_time, depth, len(live_processes)))
+
+  def get_pool(line):
+    """Gets the processes for the pool that a line belongs to."""
+    if key_function:
+      key = key_function(line)
+    else:
+      key = None
+    if key not in pools:
+      pools[key] = []
+      limit = max_processes
+      if max_processes_function:
+        limit = max(max_processes_function(key), 1)
+      pool_limits[key] = limit
+    return (pools[key], pool_limits[key])
+
+  def dispatch(line):
+    """Gives a line of input to the least busy process in its pool."""
+    (processes, limit) = get_pool(line)
+    best = None
+    for process in processes:
+      if not best or len(process.queued) < len(best.queued):
+        best = process
+    if (not best or len(best.queued) >= _SPAWN_QUEUE_DEPTH) and (
+        len(processes) < limit):
+      best = spawn(processes)
+    if not best.queued:
+      best.since = time.time()
+    best.sink.write_lines(line)
+    best.queued.append(line)
+    queued[0] = queued[0] + 1
+
+  def dispatch_batch():
+    """Distributes the gathered lines in sorted order."""
+    keyed = [(sort_key_function(line), line) for line in batch]
+    keyed.sort()
+    del batch[:]
+    for (_, line) in keyed:
+      dispatch(line)
 
   def on_source_lines(source, lines):
     """Called when there is input data available."""
-    if process_sinks:
-      # See if there is an existing process sink that is ready to accept more
-      # lines.
-      index = next_sink[0]
-      while True:
-        next_index = (index + 1) % len(process_sinks)
-        if not process_sinks[index].has_data_pending():
-          # This one is ready.
-          process_sinks[index].write_lines(lines)
-          next_sink[0] = next_index
-          return
-        index = next_index
-        if index == next_sink[0]:
-          # We went all the way around and none were ready.
-          break
-    # No process is ready, so spawn another one if possible.
-    if len(process_sinks) < max_processes:
-      (in_pipe, out_pipe) = spawner_function()
-      process_sources.append(pollingtools.LineSource(out_pipe,
-                                                     poller,
-                                                     on_process_source_lines,
-                                                     on_process_source_closed))
-      process_sinks.append(pollingtools.LineSink(in_pipe, poller))
-      index = len(process_sinks) - 1
-    else:
-      # Else simply queue up the lines on whichever process is next.
-      index = next_sink[0]
-    process_sinks[index].write_lines(lines)
-    next_sink[0] = (index + 1) % len(process_sinks)
+    for line in _split_lines(lines):
+      if sort_key_function:
+        batch.append(line)
+        if len(batch) >= _SORT_BATCH_SIZE:
+          dispatch_batch()
+      else:
+        dispatch(line)
+    if max_queued and queued[0] + len(batch) >= max_queued:
+      # Sort what we have rather than waiting for a batch that won't come.
+      if batch:
+        dispatch_batch()
+      source.pause()
+
+  def close_inputs():
+    """Closes the input of all processes."""
+    for processes in pools.itervalues():
+      for process in processes:
+        process.sink.close()
+      del processes[:]
 
   def on_source_closed(source):
     """Called when the input pipe is closed."""
-    # No more data to give to the process sinks, so close them all.
-    for process_sink in process_sinks:
-      process_sink.close()
+    input_closed[0] = True
+    if batch:
+      dispatch_batch()
+    # No more data to give to the processes, so close them all.
+    close_inputs()
+    close_output_if_done()
+
+  def retire_idle_processes():
+    """Closes the input of processes that have had nothing to do lately."""
+    now = time.time()
+    for processes in pools.itervalues():
+      for process in processes[:]:
+        if not process.queued and now - process.since >= _IDLE_SECONDS:
+          # The process exits once its input is closed, and its output is
+          # still collected until then.
+          process.sink.close()
+          processes.remove(process)
+
+  def kill(process):
+    """Kills a process that is stuck and hands its work to others."""
+    try:
+      os.kill(process.pid, signal.SIGKILL)
+    except OSError:
+      # Already gone.
+      pass
+    _reap(process.pid)
+    process.source.close()
+    process.sink.abort()
+    live_processes.remove(process)
+    if process in process.pool:
+      process.pool.remove(process)
+    queued[0] = queued[0] - len(process.queued)
+    stuck_line = process.queued.popleft()
+    if timeout_function:
+      output = timeout_function(stuck_line)
+      if output:
+        sink.write_lines(output)
+    for line in process.queued:
+      dispatch(line)
+    if max_queued and queued[0] < max_queued:
+      input_source[0].resume()
+    if input_closed[0]:
+      close_inputs()
+    close_output_if_done()
+
+  def kill_stuck_processes():
+    """Kills processes that have taken too long to answer."""
+    now = time.time()
+    for process in live_processes[:]:
+      if process.queued and now - process.since >= timeout:
+        kill(process)
 
-  pollingtools.LineSource(input_file, poller, on_source_lines, on_source_closed)
+  input_source[0] = pollingtools.LineSource(input_file, poller,
+                                            on_source_lines, on_source_closed)
   while poller.has_pollers():
-    poller.poll()
+    poller.poll(_POLL_TIMEOUT_MS)
+    retire_idle_processes()
+    if timeout:
+      kill_stuck_processes()
+    if stats.is_enabled() and (
+        not queue_depth or
+        time.time() - start_time - queue_depth[-1][0] >= _STATS_SAMPLE_SECONDS):
+      sample_queue_depth()
@@ -17,19 +17,25 @@
 
 """Helper routines for interacting with dpkg."""
 
+import bisect
 import os
 import shutil
 import subprocess
 import sys
+import zlib
 
 
-_DPKG_INFO_DIR = "/var/lib/dpkg/info/"
+DPKG_ADMIN_DIR = "/var/lib/dpkg"
+_INFO_SUBDIR = "info"
 _LIST_FILE_EXT = ".list"
 _LIST_FILE_EXT_LEN = len(_LIST_FILE_EXT)
 _MD5SUMS_FILE_EXT = ".md5sums"
 _MD5SUMS_FILE_EXT_LEN = len(_MD5SUMS_FILE_EXT)
+_STATUS_FILE = "status"
 _MORE_PACKAGES = "..."
 _MAX_DIR_OWNERS_TO_RECORD = 3
+# The depth below which each shard of the namespace is made of whole subtrees.
+SHARD_DEPTH = 4
 
 
 def extract_archive(archive_path, destdir):
@@ -42,13 +48,14 @@ def extract_archive(archive_path, destdir):
                           stdin = devnull)
 
 
-def expand_package_to_leaf_paths(pkgname):
+def expand_package_to_leaf_paths(pkgname, admin_dir=DPKG_ADMIN_DIR):
   """Expands a package name to all leaf paths owned by it.
 
-  Returns an array of all leaf paths owned by pkgname. A leaf path is defined as
-  a path for which the package does not own any subpath.
+  Returns an array of all leaf paths owned by pkgname according to the dpkg
+  database in admin_dir. A leaf path is defined as a path for which the package
+  does not own any subpath.
   """
-  listpath = _DPKG_INFO_DIR + pkgname + _LIST_FILE_EXT
+  listpath = os.path.join(admin_dir, _INFO_SUBDIR, pkgname + _LIST_FILE_EXT)
   paths = []
   if not os.path.lexists(listpath):
     return paths
@@ -88,49 +95,131 @@ class PathFilter:
   """
 
   def __init__(self, paths):
-    # We store the filter as a tree of the outermost paths (i.e., paths that are
-    # not subpaths of any other path in the filter). Non-outermost paths are
-    # superfluous because all subpaths are automatically included.
-    # First identify the outermost paths.
-    paths = sorted(paths)
-    last = None
-    outermost_paths = []
-    for p in paths:
-      if last and p.startswith(last):
+    # We store the filter as a sorted list of the outermost paths (i.e., paths
+    # that are not subpaths of any other path in the filter). Non-outermost
+    # paths are superfluous because all subpaths are automatically included.
+    # With a slash at the end of every path, a path sorts right before its
+    # subpaths and a path is included by another precisely if it starts with
+    # it, so the only path that can include a given path is the greatest one
+    # that sorts before it.
+    self.__prefixes = []
+    for prefix in sorted(set([p.rstrip("/") + "/" for p in paths])):
+      if self.__prefixes and prefix.startswith(self.__prefixes[-1]):
         continue
-      last = p
-      outermost_paths.append(p)
-    # Now build the tree.
-    if not outermost_paths:
-      # Special case where no paths were specified.
-      self.__paths = None
-      return
-    self.__paths = {}
-    for p in outermost_paths:
-      current = self.__paths
-      for component in _path_components(p):
-        if component not in current:
-          next_dict = current[component] = {}
-        else:
-          next_dict = current[component]
-        current = next_dict
+      self.__prefixes.append(prefix)
+    self.__outermost_paths = [prefix.rstrip("/") or "/"
+                              for prefix in self.__prefixes]
+    self.__includes_all = self.__prefixes == ["/"]
+
+  def outermost_paths(self):
+    """Gets the paths that are not subpaths of any other path in the filter,
+       in sorted order."""
+    return self.__outermost_paths
+
+  def includes_all(self):
+    """Checks if this filter includes every path."""
+    return self.__includes_all
 
   def includes(self, p):
     """Checks if this filter includes the given path."""
-    current = self.__paths
-    if current == None:
-      # Special case where no paths were specified.
-      return False
-    for component in _path_components(p):
-      if component not in current:
-        # If no more components, then this is an included path and we're a
-        # subpath of it. Otherwise, we're not an included path.
-        return not current
-      current = current[component]
-    # If we found all nodes, then either this is a parent of an included path or
-    # exactly equal to an included path. The latter is the case whenever there
-    # are no more children.
-    return not current
+    if self.__includes_all:
+      return True
+    p = p + "/"
+    i = bisect.bisect_right(self.__prefixes, p)
+    return bool(i) and p.startswith(self.__prefixes[i - 1])
+
+  def filter(self, paths):
+    """Gets the given paths that this filter includes, in order. If it
+       includes every path, that is the given iterable itself."""
+    if self.__includes_all:
+      return paths
+    prefixes = self.__prefixes
+    if not prefixes:
+      return []
+    bisect_right = bisect.bisect_right
+    included = []
+    for p in paths:
+      key = p + "/"
+      i = bisect_right(prefixes, key)
+      if i and key.startswith(prefixes[i - 1]):
+        included.append(p)
+    return included
+
+
+def path_depth(normpath):
+  """Gets the number of components in a normalized path."""
+  if normpath == "/":
+    return 0
+  return normpath.count("/")
+
+
+def shard_of(normpath, shards, depth=SHARD_DEPTH):
+  """Gets the shard that checks a normalized path, out of the given number of
+     shards.
+
+  Paths deeper than the given depth belong to the same shard as their
+  ancestor at that depth, so that a shard is made of whole subtrees. The
+  paths above them belong to the shard of their parent, which spreads them
+  over the shards too.
+  """
+  if normpath == "/":
+    return 0
+  prefix_depth = min(path_depth(normpath) - 1, depth)
+  prefix = "/".join(normpath.split("/", prefix_depth + 1)[:prefix_depth + 1])
+  return (zlib.crc32(prefix or "/") & 0xffffffff) % shards
+
+
+class ShardFilter:
+  """Narrows a PathFilter to the paths of one shard, for loading the dpkg state
+     one part at a time.
+
+  Each path is included only in the shard that checks it, and the outermost
+  paths of the PathFilter in every shard so that they can be looked up. The
+  directories above the paths of a shard are loaded as nodes without owners,
+  through which the shard is reached. The children of a directory no deeper
+  than the shard depth are in a different shard than it, so the filter notes
+  which of those directories have children as it filters the lists of paths.
+  """
+
+  def __init__(self, path_filter, shard, shards, depth=SHARD_DEPTH):
+    self.__path_filter = path_filter
+    self.__shard = shard
+    self.__shards = shards
+    self.__depth = depth
+    self.__outermost_paths = set(path_filter.outermost_paths())
+    self.__directories = set()
+
+  def outermost_paths(self):
+    """Gets the outermost paths of the narrowed PathFilter."""
+    return self.__path_filter.outermost_paths()
+
+  def includes_all(self):
+    """Checks if this filter includes every path."""
+    return False
+
+  def includes(self, p):
+    """Checks if this filter includes the given path."""
+    return self.__path_filter.includes(p) and self.__in_shard(p)
+
+  def filter(self, paths):
+    """Gets the given paths that this filter includes, in order. Every path
+       loaded into the dpkg state goes through this."""
+    included = []
+    for p in self.__path_filter.filter(paths):
+      if path_depth(p) <= self.__depth + 1:
+        self.__directories.add(os.path.dirname(p))
+      if self.__in_shard(p):
+        included.append(p)
+    return included
+
+  def has_children(self, p):
+    """Checks if a path no deeper than the shard depth has subpaths in any
+       shard, among the paths filtered so far."""
+    return p in self.__directories
+
+  def __in_shard(self, p):
+    return (p in self.__outermost_paths or
+            shard_of(p, self.__shards, self.__depth) == self.__shard)
 
 
 class PackageInfo:
@@ -159,14 +248,17 @@ class FilesystemNode:
 
   def __init__(self):
     self.__owners = []
+    # Including the owners beyond the cap.
+    self.__owner_count = 0
     self.__children = {}
     self.__package_info = {}
 
   def _record_owner(self, pkgname):
+    self.__owner_count = self.__owner_count + 1
     if self.__children and len(self.__owners) >= _MAX_DIR_OWNERS_TO_RECORD:
       # Cap the number of recorded owners for directories since that info is
       # only used for logging and there could be thousands.
-      if len(self.__owners) == _MAX_DIR_OWNERS_TO_RECORD:
+      if self.__owners[-1] != _MORE_PACKAGES:
         self.__owners.append(_MORE_PACKAGES)
       return
     self.__owners.append(pkgname)
@@ -179,6 +271,26 @@ class FilesystemNode:
     child = self.__children[name] = FilesystemNode()
     return child
 
+  def _forget_owner(self, pkgname):
+    self.__owner_count = self.__owner_count - 1
+    if pkgname in self.__owners:
+      self.__owners.remove(pkgname)
+    if (self.__owners and self.__owners[-1] == _MORE_PACKAGES and
+        len(self.__owners) - 1 >= self.__owner_count):
+      # The owners beyond the cap are all gone.
+      self.__owners.pop()
+
+  def _remove_child(self, name):
+    del self.__children[name]
+
+  def _is_empty(self):
+    return not (self.__owner_count or self.__children or self.__package_info)
+
+  def _forget_package_info(self, pkgname):
+    pkg_info = self.__package_info.get(pkgname)
+    if pkg_info and not (pkg_info._md5sum or pkg_info._conffile_status):
+      del self.__package_info[pkgname]
+
   def _get_package_info(self, pkgname):
     if pkgname in self.__package_info:
       return self.__package_info[pkgname]
@@ -210,122 +322,325 @@ def _bad_conffiles_line(package, line):
       (package, line))
 
 
+def _filtered(path_filter, entries, path_field=0):
+  """Gets the entries whose path (the given field) the path filter includes,
+     in order, giving the filter all of the paths at once."""
+  entries = list(entries)
+  included = path_filter.filter([entry[path_field] for entry in entries])
+  if len(included) == len(entries):
+    return entries
+  # The included paths are in the same order as the entries, and a path is
+  # either always included or never.
+  result = []
+  i = 0
+  for entry in entries:
+    if i < len(included) and entry[path_field] == included[i]:
+      result.append(entry)
+      i = i + 1
+  return result
+
+
+def read_list(path):
+  """Reads the paths in a package's .list file."""
+  with open(path) as f:
+    for line in f:
+      line = line.rstrip("\n")
+      if line == "/.":
+        yield "/"
+      else:
+        yield line
+
+
+def read_md5sums(path):
+  """Reads the paths and md5sums in a package's .md5sums file."""
+  with open(path) as f:
+    for line in f:
+      line = line.rstrip("\n")
+      yield ("/" + line[34:], line[:32])
+
+
+def read_conffiles(admin_dir=DPKG_ADMIN_DIR):
+  """Reads the conffiles of every package in the dpkg status file, including
+     those of packages that have been removed but not purged.
+
+  Yields the package name, path, md5sum and obsolete flag of each conffile.
+  The md5sum is as dpkg has it, which is not always valid.
+  """
+  # Annoyingly, the conffiles entries do not have a newline on the last line,
+  # so we ask dpkg-query to add one. Unfortunately this means that an empty
+  # entry will become a one-line entry, so we ignore blank lines in the
+  # output.
+  # In some dpkg-query versions the architecture-qualified name field is
+  # called PackageSpec, while in others it's called binary:Package.
+  # Non-existent field references expand to the empty string, so we just
+  # concatenate them as in
+  # https://code.launchpad.net/~lool/getlicenses/fix-for-newer-dpkg-query-format/+merge/169508
+  p = subprocess.Popen(
+      ["dpkg-query", "--admindir=" + admin_dir,
+       "-f=${PackageSpec}${binary:Package}\\n${Conffiles}\\n", "-W"],
+      stdout=subprocess.PIPE)
+  package = None
+  for line in p.stdout:
+    line = line.rstrip("\n")
+    if not line:
+      # Ignore blank lines.
+      continue
+    # The lines in the Conffiles field all start with a space, while lines
+    # in the binary:Package field all start with a non-space.
+    if line[0] != ' ':
+      # Next package.
+      package = line
+      continue
+    # Next conffile in current package.
+    if not package:
+      # Got conffile line before first package line. Should not happen.
+      print >> sys.stderr, ("Got malformed line in dpkg-query output: " +
+                            line)
+      continue
+    # This is reverse-engineered from the f_conffiles() dpkg function in
+    # lib/dpkg/fields.c.
+    pair = line.rsplit(' ', 1)
+    if len(pair) != 2:
+      _bad_conffiles_line(package, line)
+      continue
+    obsolete = pair[1] == "obsolete"
+    if obsolete:
+      pair = pair[0].rsplit(' ', 1)
+      if len(pair) != 2:
+        _bad_conffiles_line(package, line)
+        continue
+    yield (package, pair[0][1:], pair[1], obsolete)
+  if p.wait():
+    print >> sys.stderr, ("dpkg-query failed with exit status %s" %
+                          p.returncode)
+
+
+def info_snapshot(admin_dir=DPKG_ADMIN_DIR):
+  """Gets what identifies the current version of each of the files in the
+     dpkg database that we load, by filename."""
+  info_dir = os.path.join(admin_dir, _INFO_SUBDIR)
+  snapshot = {}
+  filenames = [os.path.join(info_dir, filename)
+               for filename in os.listdir(info_dir)
+               if filename.endswith(_LIST_FILE_EXT) or
+                  filename.endswith(_MD5SUMS_FILE_EXT)]
+  filenames.append(os.path.join(admin_dir, _STATUS_FILE))
+  for filename in filenames:
+    try:
+      st = os.stat(filename)
+    except OSError:
+      # Removed since the listing.
+      continue
+    # dpkg replaces these files rather than rewriting them, but the
+    # modification time alone may not have changed on coarse filesystems.
+    snapshot[filename] = (st.st_mtime, st.st_size, st.st_ino)
+  return snapshot
+
+
+def snapshot_changes(old_snapshot, new_snapshot):
+  """Compares two info_snapshot()s. Returns the set of packages whose info
+     files changed, and whether the status file changed."""
+  changed_files = set()
+  for (filename, version) in new_snapshot.iteritems():
+    if old_snapshot.get(filename) != version:
+      changed_files.add(filename)
+  changed_files.update(set(old_snapshot) - set(new_snapshot))
+  status_changed = False
+  packages = set()
+  for filename in changed_files:
+    if os.path.basename(filename) == _STATUS_FILE:
+      status_changed = True
+    else:
+      packages.add(os.path.splitext(os.path.basename(filename))[0])
+  return (packages, status_changed)
+
+
 class DpkgHelper:
   """Class for loading dpkg state."""
 
-  def __init__(self, path_filter):
+  def __init__(self, path_filter, admin_dir=DPKG_ADMIN_DIR,
+               track_changes=False, index=None):
+    """Loads the dpkg state of the paths included by path_filter.
+
+    If track_changes is True, refresh() can be used later on to pick up
+    changes to the dpkg database, at the cost of remembering which paths each
+    package has.
+
+    If an up-to-date path_index.PathIndex of the database is given, the state
+    is loaded from its records instead of the info files, and the conffiles
+    come from the index too.
+    """
     self.__root = FilesystemNode()
     self.__path_filter = path_filter
-    self.__load()
+    self.__admin_dir = admin_dir
+    self.__info_dir = os.path.join(admin_dir, _INFO_SUBDIR)
+    self.__track_changes = track_changes
+    # The paths of each package and the paths with conffiles, when tracking
+    # changes.
+    self.__package_paths = {}
+    self.__conffile_paths = []
+    if track_changes:
+      # Taken before loading so that changes made while we load are picked up
+      # by the next refresh.
+      self.__snapshot = info_snapshot(admin_dir)
+    if index:
+      self.__load_from_index(index)
+    else:
+      self.__load()
 
   def __load(self):
     # Load info from the dpkg info directory.
-    for filename in os.listdir(_DPKG_INFO_DIR):
+    for filename in os.listdir(self.__info_dir):
       if filename.endswith(_LIST_FILE_EXT):
         pkgname = filename[:-_LIST_FILE_EXT_LEN]
-        self.__load_list(_DPKG_INFO_DIR + filename, pkgname)
+        self.__load_list(os.path.join(self.__info_dir, filename), pkgname)
       elif filename.endswith(_MD5SUMS_FILE_EXT):
         pkgname = filename[:-_MD5SUMS_FILE_EXT_LEN]
-        self.__load_md5sums(_DPKG_INFO_DIR + filename, pkgname)
+        self.__load_md5sums(os.path.join(self.__info_dir, filename), pkgname)
     # Load conffiles info from the dpkg status file.
-    self.__load_conffiles()
+    self.__load_conffiles(read_conffiles(self.__admin_dir))
+
+  def __load_from_index(self, index):
+    mapped_index = index.open()
+    try:
+      for outermost_path in self.__path_filter.outermost_paths():
+        # Filtered such as for a ShardFilter.
+        for (normpath, pkgname, listed, md5sum) in _filtered(
+            self.__path_filter, mapped_index.scan(outermost_path)):
+          node = self.__get_node(normpath, True)
+          if listed:
+            node._record_owner(pkgname)
+          if md5sum is not None:
+            node._get_package_info(pkgname)._md5sum = md5sum
+          if self.__track_changes:
+            if listed:
+              self.__package_paths.setdefault(pkgname, []).append(
+                  (normpath, True))
+            if md5sum is not None:
+              self.__package_paths.setdefault(pkgname, []).append(
+                  (normpath, False))
+    finally:
+      mapped_index.close()
+    self.__load_conffiles(index.conffiles())
+
+  def __load_package(self, pkgname):
+    path = os.path.join(self.__info_dir, pkgname + _LIST_FILE_EXT)
+    if os.path.exists(path):
+      self.__load_list(path, pkgname)
+    path = os.path.join(self.__info_dir, pkgname + _MD5SUMS_FILE_EXT)
+    if os.path.exists(path):
+      self.__load_md5sums(path, pkgname)
+
+  def refresh(self):
+    """Picks up changes to the dpkg database since the state was loaded or
+       last refreshed. Only the packages whose info files changed are
+       reloaded, along with the conffiles if the status file changed. Returns
+       the names of the packages that were reloaded.
+
+    Requires track_changes.
+    """
+    if not self.__track_changes:
+      raise Exception("Not tracking changes to the dpkg database")
+    old_snapshot = self.__snapshot
+    self.__snapshot = info_snapshot(self.__admin_dir)
+    (packages, status_changed) = snapshot_changes(old_snapshot,
+                                                  self.__snapshot)
+    for pkgname in packages:
+      self.__forget_package(pkgname)
+    for pkgname in packages:
+      self.__load_package(pkgname)
+    if status_changed:
+      # Removed packages keep their conffiles until purged, so the whole
+      # Conffiles field is reloaded rather than that of the changed packages.
+      for (normpath, pkgname) in self.__conffile_paths:
+        self.__forget_conffile(normpath, pkgname)
+      self.__conffile_paths = []
+      self.__load_conffiles(read_conffiles(self.__admin_dir))
+    return sorted(packages)
+
+  def __forget_package(self, pkgname):
+    def forget(node):
+      pkg_info = node.package_info().get(pkgname)
+      if pkg_info:
+        pkg_info._md5sum = None
+        node._forget_package_info(pkgname)
+    for (normpath, owned) in self.__package_paths.pop(pkgname, []):
+      if owned:
+        self.__forget_path(normpath, lambda node: node._forget_owner(pkgname))
+      else:
+        self.__forget_path(normpath, forget)
+
+  def __forget_conffile(self, normpath, pkgname):
+    def forget(node):
+      pkg_info = node.package_info().get(pkgname)
+      if pkg_info:
+        pkg_info._conffile_status = None
+        node._forget_package_info(pkgname)
+    self.__forget_path(normpath, forget)
+
+  def __forget_path(self, normpath, forget):
+    """Applies forget to the node for a path, then removes the node and its
+       parents for as long as they are left empty."""
+    nodes = [self.__root]
+    components = _path_components(normpath)
+    for component in components:
+      node = nodes[-1].children().get(component)
+      if not node:
+        return
+      nodes.append(node)
+    forget(nodes[-1])
+    while components and nodes[-1]._is_empty():
+      nodes.pop()
+      nodes[-1]._remove_child(components.pop())
 
   def __load_list(self, path, pkgname):
-    with open(path) as f:
-      for line in f:
-        line = line.rstrip("\n")
-        if line == "/.":
-          normpath = "/"
-        else:
-          normpath = line
-        if not self.__path_filter.includes(normpath):
-          continue
-        node = self.__get_node(normpath, True)
-        if pkgname in node.owners():
-          print >> sys.stderr, "Got redundant entry for %s in %s" % (normpath,
-                                                                     path)
-          continue
-        node._record_owner(pkgname)
+    for normpath in self.__path_filter.filter(read_list(path)):
+      node = self.__get_node(normpath, True)
+      if pkgname in node.owners():
+        print >> sys.stderr, "Got redundant entry for %s in %s" % (normpath,
+                                                                   path)
+        continue
+      node._record_owner(pkgname)
+      if self.__track_changes:
+        self.__package_paths.setdefault(pkgname, []).append((normpath, True))
 
   def __load_md5sums(self, path, pkgname):
-    with open(path) as f:
-      for line in f:
-        line = line.rstrip("\n")
-        normpath = "/" + line[34:]
-        if not self.__path_filter.includes(normpath):
-          continue
-        md5sum = line[:32]
-        pkg_info = self.__get_node(normpath, True)._get_package_info(pkgname)
-        if pkg_info._md5sum:
-          print >> sys.stderr, "Got redundant entry for %s in %s" % (normpath,
-                                                                     path)
-        pkg_info._md5sum = md5sum
-
-  def __load_conffiles(self):
-    # Annoyingly, the conffiles entries do not have a newline on the last line,
-    # so we ask dpkg-query to add one. Unfortunately this means that an empty
-    # entry will become a one-line entry, so we ignore blank lines in the
-    # output.
-    # In some dpkg-query versions the architecture-qualified name field is
-    # called PackageSpec, while in others it's called binary:Package.
-    # Non-existent field references expand to the empty string, so we just
-    # concatenate them as in
-    # https://code.launchpad.net/~lool/getlicenses/fix-for-newer-dpkg-query-format/+merge/169508
-    p = subprocess.Popen(
-        ["dpkg-query", "-f=${PackageSpec}${binary:Package}\\n${Conffiles}\\n", "-W"],
-        stdout=subprocess.PIPE)
-    package = None
-    for line in p.stdout:
-      line = line.rstrip("\n")
-      if not line:
-        # Ignore blank lines.
+    for (normpath, md5sum) in _filtered(self.__path_filter,
+                                        read_md5sums(path)):
+      pkg_info = self.__get_node(normpath, True)._get_package_info(pkgname)
+      if pkg_info._md5sum:
+        print >> sys.stderr, "Got redundant entry for %s in %s" % (normpath,
+                                                                   path)
+      pkg_info._md5sum = md5sum
+      if self.__track_changes:
+        self.__package_paths.setdefault(pkgname, []).append(
+            (normpath, False))
+
+  def __load_conffiles(self, conffiles):
+    valid = []
+    for (package, normpath, md5sum, obsolete) in conffiles:
+      if md5sum != "newconffile" and len(md5sum) == 32:
+        valid.append((package, normpath, md5sum, obsolete))
+      elif not self.__path_filter.includes(normpath):
+        # The invalid entries are kept from filter() below, since a
+        # ShardFilter notes the paths that it is given.
         continue
-      # The lines in the Conffiles field all start with a space, while lines
-      # in the binary:Package field all start with a non-space.
-      if line[0] != ' ':
-        # Next package.
-        package = line
+      elif md5sum == "newconffile":
+        # It's not clear what this means or why it occurs.
+        print ("Warning: Ignoring Conffiles entry for package %s with hash of "
+               "\"newconffile\": %s" % (package, normpath))
       else:
-        # Next conffile in current package.
-        if not package:
-          # Got conffile line before first package line. Should not happen.
-          print >> sys.stderr, ("Got malformed line in dpkg-query output: " +
-                                line)
-          continue
-        # This is reverse-engineered from the f_conffiles() dpkg function in
-        # lib/dpkg/fields.c.
-        pair = line.rsplit(' ', 1)
-        if len(pair) != 2:
-          _bad_conffiles_line(package, line)
-          continue
-        obsolete = pair[1] == "obsolete"
-        if obsolete:
-          pair = pair[0].rsplit(' ', 1)
-          if len(pair) != 2:
-            _bad_conffiles_line(package, line)
-            continue
-        normpath = pair[0][1:]
-        if not self.__path_filter.includes(normpath):
-          continue
-        md5sum = pair[1]
-        if md5sum == "newconffile":
-          # It's not clear what this means or why it occurs.
-          print ("Warning: Ignoring Conffiles line for package %s with hash of "
-                 "\"newconffile\": %s" % (package, line))
-          continue
-        if len(md5sum) != 32:
-          _bad_conffiles_line(package, line)
-          continue
-        status = (md5sum, obsolete)
-        pkg_info = self.__get_node(normpath, True)._get_package_info(package)
-        if pkg_info._conffile_status:
-          print >> sys.stderr, (
-              "Got redundant dpkg-query output for file %s in package %s: %s" %
-              (normpath, package, line))
-        pkg_info._conffile_status = status
-    if p.wait():
-      print >> sys.stderr, ("dpkg-query failed with exit status %s" %
-                            p.returncode)
+        _bad_conffiles_line(package, "%s %s" % (normpath, md5sum))
+    for (package, normpath, md5sum, obsolete) in _filtered(self.__path_filter,
+                                                           valid, 1):
+      pkg_info = self.__get_node(normpath, True)._get_package_info(package)
+      if pkg_info._conffile_status:
+        print >> sys.stderr, (
+            "Got redundant conffile entry for file %s in package %s" %
+            (normpath, package))
+      pkg_info._conffile_status = (md5sum, obsolete)
+      if self.__track_changes:
+        self.__conffile_paths.append((normpath, package))
 
   def __get_node(self, normpath, create):
     node = self.__root
@@ -0,0 +1,169 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Routines for reporting findings as structured records.
+
+A finding is a dict with at least a "type" (one of the kinds below) and a
+human-readable "message". Records travel down the processing pipeline as
+lines starting with RECORD_PREFIX, and are written out by a single Writer in
+the main process.
+
+The limit on the size of diffs is module-level state like the APT options,
+and must be set before the processing pipeline is launched so that every
+forked process shares it.
+"""
+
+import json
+import threading
+
+# Kinds of findings.
+MISSING = "missing"
+EXTRA = "extra"
+MODIFIED = "modified"
+TYPE_MISMATCH = "type-mismatch"
+UNVERIFIABLE = "unverifiable"
+ERROR = "error"
+# Prose about a check, such as a warning, as sent back by the daemon.
+MESSAGE = "message"
+# Kinds of the records that end a run.
+STATISTICS = "stats"
+PACKAGE_COSTS = "packages"
+SUMMARY = "summary"
+
+# Output formats.
+TEXT = "text"
+NDJSON = "ndjson"
+FORMATS = (TEXT, NDJSON)
+
+RECORD_PREFIX = "@"
+
+_max_diff_size = None
+
+
+def set_max_diff_size(max_diff_size):
+  """Sets the most bytes of diff to include in each record (None for no
+     limit, 0 to leave diffs out)."""
+  global _max_diff_size
+  _max_diff_size = max_diff_size
+
+
+def max_diff_size():
+  """Gets the most bytes of diff to include in each record, or None."""
+  return _max_diff_size
+
+
+def _text(value):
+  # Paths are bytes, but JSON needs text.
+  if isinstance(value, str):
+    return value.decode("utf-8", "replace")
+  return value
+
+
+def record(kind, message, path=None, packages=None, **fields):
+  """Creates the record of a finding."""
+  result = {"type": kind, "message": _text(message)}
+  if path is not None:
+    result["path"] = _text(path)
+  if packages is not None:
+    result["packages"] = [_text(pkgname) for pkgname in packages]
+  for (name, value) in fields.iteritems():
+    result[name] = _text(value)
+  return result
+
+
+def encode(rec):
+  """Encodes a record as a line to pass down the pipeline."""
+  return RECORD_PREFIX + json.dumps(rec, sort_keys=True) + "\n"
+
+
+def is_record(line):
+  """Checks if a line from the pipeline is a record."""
+  return line.startswith(RECORD_PREFIX)
+
+
+def decode(line):
+  """Decodes a record line from the pipeline, or returns None if invalid."""
+  try:
+    rec = json.loads(line[len(RECORD_PREFIX):])
+  except ValueError:
+    return None
+  if not isinstance(rec, dict):
+    return None
+  return rec
+
+
+class Finding:
+  """A finding, as given to users of the library API.
+
+  The kind is one of the kinds above, the message is human-readable, the
+  path and packages are those concerned (None and an empty list if there are
+  none) and the fields are whatever else the record has, such as a "diff".
+  """
+
+  def __init__(self, rec):
+    rec = dict(rec)
+    self.kind = rec.pop("type")
+    self.message = rec.pop("message", u"")
+    self.path = rec.pop("path", None)
+    self.packages = rec.pop("packages", [])
+    self.fields = rec
+
+  def record(self):
+    """Gets the record of this finding."""
+    rec = dict(self.fields)
+    rec["type"] = self.kind
+    rec["message"] = self.message
+    if self.path is not None:
+      rec["path"] = self.path
+    if self.packages:
+      rec["packages"] = self.packages
+    return rec
+
+  def __repr__(self):
+    return "Finding(%r)" % self.record()
+
+
+class Writer:
+  """Writes records as newline-delimited JSON, one whole record at a time.
+
+  Safe to use from more than one thread. Each record is flushed as soon as it
+  is written so that a collector can consume the output as the run goes.
+  """
+
+  def __init__(self, fileobj):
+    self.__file = fileobj
+    self.__lock = threading.Lock()
+
+  def write(self, rec):
+    """Writes a record."""
+    self.__write_line(json.dumps(rec, sort_keys=True) + "\n")
+
+  def write_encoded(self, line):
+    """Writes a record line from the pipeline."""
+    self.__write_line(line[len(RECORD_PREFIX):].rstrip("\n") + "\n")
+
+  def __write_line(self, line):
+    self.__lock.acquire()
+    try:
+      self.__file.write(line)
+      self.__file.flush()
+    finally:
+      self.__lock.release()
+
+  def close(self):
+    """Flushes and closes the output."""
+    self.__file.close()
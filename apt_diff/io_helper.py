@@ -0,0 +1,173 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Helpers for limiting the impact of our disk reads on the rest of the
+system.
+
+The settings here are module-level state like the APT options, and must be
+configured before the processing pipeline is launched so that every forked
+process shares them.
+"""
+
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import time
+
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def _load_posix_fadvise():
+  if hasattr(os, "posix_fadvise"):
+    return os.posix_fadvise
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    # Use the 64-bit variant so that offsets are off64_t on every platform.
+    func = libc.posix_fadvise64
+  except (OSError, AttributeError):
+    return None
+  func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+  def posix_fadvise(fileno, offset, length, advice):
+    # Unlike most libc functions, this returns the error number directly.
+    err = func(fileno, offset, length, advice)
+    if err:
+      raise OSError(err, os.strerror(err))
+  return posix_fadvise
+
+_posix_fadvise = _load_posix_fadvise()
+
+
+def parse_rate(text):
+  """Parses a byte count with an optional K, M or G suffix."""
+  text = text.strip().upper()
+  if text.endswith("B"):
+    text = text[:-1]
+  unit = ""
+  if text and text[-1] in _UNITS:
+    unit = text[-1]
+    text = text[:-1]
+  value = float(text) * _UNITS[unit]
+  if value <= 0:
+    raise ValueError("rate must be positive")
+  return value
+
+
+def format_bytes(count):
+  """Formats a byte count for humans."""
+  for unit in ("", "K", "M"):
+    if count < 1024:
+      return "%.1f %sB" % (count, unit)
+    count = count / 1024.0
+  return "%.1f GB" % count
+
+
+class _Throttle:
+  """A bytes-per-second budget shared by all processes forked after it was
+     created."""
+
+  def __init__(self, bytes_per_second):
+    self.rate = float(bytes_per_second)
+    self.start_time = time.time()
+    self.__lock = multiprocessing.Lock()
+    # The time at which the budget next becomes available, and the total
+    # number of bytes that have been read.
+    self.__next_time = multiprocessing.RawValue("d", 0.0)
+    self.__total_bytes = multiprocessing.RawValue("d", 0.0)
+
+  def consume(self, nbytes):
+    self.__lock.acquire()
+    try:
+      now = time.time()
+      start = max(now, self.__next_time.value)
+      self.__next_time.value = start + nbytes / self.rate
+      self.__total_bytes.value = self.__total_bytes.value + nbytes
+    finally:
+      self.__lock.release()
+    if start > now:
+      time.sleep(start - now)
+
+  def total_bytes(self):
+    return self.__total_bytes.value
+
+_throttle = None
+_drop_cache = False
+
+
+def set_rate_limit(bytes_per_second):
+  """Limits the combined read rate of all processes to the given value."""
+  global _throttle
+  _throttle = _Throttle(bytes_per_second)
+
+
+def set_drop_cache(drop_cache):
+  """Sets whether to drop files from the page cache after reading them."""
+  global _drop_cache
+  _drop_cache = drop_cache
+
+
+def is_rate_limited():
+  """Checks if reads are subject to a rate limit."""
+  return bool(_throttle)
+
+
+def consume(nbytes):
+  """Accounts for nbytes of reads, sleeping as needed to honour the limit."""
+  if _throttle:
+    _throttle.consume(nbytes)
+
+
+def throughput():
+  """Gets the limit, the bytes read and the elapsed time under the limit."""
+  return (_throttle.rate, _throttle.total_bytes(),
+          time.time() - _throttle.start_time)
+
+
+def advise(fileno, advice, length=0):
+  """Gives the kernel advice about the first length bytes of an open file (or
+     all of it if length is 0), if possible."""
+  if not _posix_fadvise:
+    return
+  try:
+    _posix_fadvise(fileno, 0, length, advice)
+  except OSError:
+    # It's only a hint.
+    pass
+
+
+def done_reading(fileno):
+  """Called after a file has been read in full."""
+  if _drop_cache:
+    # Don't evict the working set of whatever else is running on this host.
+    advise(fileno, POSIX_FADV_DONTNEED)
+
+
+def done_reading_path(filename):
+  """Called after a file has been read in full by another process."""
+  if not _drop_cache:
+    return
+  try:
+    fileno = os.open(filename, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    advise(fileno, POSIX_FADV_DONTNEED)
+  finally:
+    os.close(fileno)
@@ -17,22 +17,104 @@
 
 """Helper function to launch child Python processes."""
 
+import cPickle
+import fcntl
+import importlib
 import os
+import signal
+import stat
+import subprocess
 import sys
 
-def launch(function, input_read_handles, close_in_child):
-  """Launch a child process to run the given function."""
-  (out_read, out_write) = os.pipe()
-  if os.fork() == 0:
+from apt_diff import trace
+
+_PROC_SELF_FD = "/proc/self/fd"
+
+# The idle I/O scheduling class understood by ionice.
+IOPRIO_CLASS_IDLE = 3
+
+_niceness = None
+_ioprio_class = None
+# The pid of the fork server, if one is running, and the files that requests
+# are sent to it on and replies come back on.
+_fork_server = None
+
+def set_priority(niceness, ioprio_class):
+  """Set the CPU niceness and I/O scheduling class for launched processes.
+
+  Either may be None to leave it unchanged.
+  """
+  global _niceness
+  global _ioprio_class
+  _niceness = niceness
+  _ioprio_class = ioprio_class
+
+def _apply_priority():
+  if _niceness is not None:
+    # os.nice() is relative, and we may already have inherited the niceness
+    # from a parent that was itself launched.
+    increment = _niceness - os.nice(0)
+    if increment:
+      try:
+        os.nice(increment)
+      except OSError, e:
+        print >> sys.stderr, "Unable to set niceness to %d: %s" % (_niceness,
+                                                                   e)
+  if _ioprio_class is not None:
+    with open(os.devnull, "w") as devnull:
+      try:
+        ret = subprocess.call(["ionice", "-c", str(_ioprio_class),
+                               "-p", str(os.getpid())],
+                              stdout = devnull)
+      except OSError, e:
+        # Such as when ionice is not installed.
+        print >> sys.stderr, "Unable to set I/O scheduling class: %s" % e
+        return
+    if ret:
+      print >> sys.stderr, "Unable to set I/O scheduling class"
+
+def _close_other_pipes(keep):
+  """Closes all inherited pipes other than the ones in keep.
+
+  Otherwise a child that hangs would keep the pipes of its parent and siblings
+  open, and the processes at the other ends would never see EOF.
+  """
+  try:
+    filenos = [int(name) for name in os.listdir(_PROC_SELF_FD)]
+  except OSError:
+    return
+  for fileno in filenos:
+    if fileno <= 2 or fileno in keep:
+      continue
+    try:
+      if stat.S_ISFIFO(os.fstat(fileno).st_mode):
+        os.close(fileno)
+    except OSError:
+      # Probably the fd that was used to list the directory.
+      pass
+
+def _fork(function, input_read_handles, out_write, close_in_child):
+  """Forks a child process to run the given function. Returns its pid."""
+  global _fork_server
+  pid = os.fork()
+  if pid == 0:
     # Child.
+    # The fork server's pipes are about to be closed, and are ours to use
+    # only in the process that started it.
+    _fork_server = None
     try:
       for fileno in close_in_child:
         os.close(fileno)
+      _close_other_pipes(input_read_handles + [out_write])
+      _apply_priority()
       inputs = []
       for in_read in input_read_handles:
         inputs.append(os.fdopen(in_read, "r"))
-      os.close(out_read)
-      function(inputs, os.fdopen(out_write, "w"))
+      output_file = os.fdopen(out_write, "w")
+      function(inputs, output_file)
+      # Write out our trace before the next stage can see that we're done.
+      trace.flush()
+      output_file.close()
       exitcode = 0
     except KeyboardInterrupt:
       exitcode = 130
@@ -50,10 +132,128 @@ def launch(function, input_read_handles, close_in_child):
                                                                         e)
       exitcode = 1
     finally:
+      trace.flush()
       os._exit(exitcode)
-  else:
-    # Parent.
+  return pid
+
+def launch(function, input_read_handles, close_in_child):
+  """Launch a child process to run the given function.
+
+  Returns the read end of the child's output pipe and the child's pid.
+  """
+  (out_read, out_write) = os.pipe()
+  pid = _fork(function, input_read_handles, out_write, close_in_child)
+  for in_read in input_read_handles:
+    os.close(in_read)
+  os.close(out_write)
+  return (out_read, pid)
+
+def _open_inherited(pid, fileno, flags):
+  """Opens our own copy of a pipe that another process has open."""
+  # Without O_NONBLOCK, opening a pipe waits for its other end to be opened.
+  fileno = os.open("/proc/%d/fd/%d" % (pid, fileno), flags | os.O_NONBLOCK)
+  fcntl.fcntl(fileno, fcntl.F_SETFL,
+              fcntl.fcntl(fileno, fcntl.F_GETFL, 0) & ~os.O_NONBLOCK)
+  return fileno
+
+def _make_stage(module_name, factory_name, args):
+  def run(input_files, output_file):
+    # Undo the fork server's setting, which would otherwise break waiting for
+    # our own children.
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    factory = getattr(importlib.import_module(module_name), factory_name)
+    factory(*args)(input_files, output_file)
+  return run
+
+def _serve(requests, replies):
+  """Runs the fork server until the requests end."""
+  # Nobody waits for the stages that we launch, so have them reaped
+  # automatically.
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+  parent = os.getppid()
+  while True:
+    try:
+      (module_name, factory_name, args, input_filenos,
+       output_fileno) = cPickle.load(requests)
+    except EOFError:
+      return
+    input_read_handles = [_open_inherited(parent, fileno, os.O_RDONLY)
+                          for fileno in input_filenos]
+    out_write = _open_inherited(parent, output_fileno, os.O_WRONLY)
+    pid = _fork(_make_stage(module_name, factory_name, args),
+                input_read_handles, out_write, [])
     for in_read in input_read_handles:
       os.close(in_read)
     os.close(out_write)
-    return out_read
+    cPickle.dump(pid, replies)
+    replies.flush()
+
+def start_fork_server():
+  """Starts a small template process that launch_stage() forks stages from.
+
+  Stages forked from the template start with a copy of its memory rather than
+  of ours, so this should be called before anything large is loaded. Module
+  settings like the priority must be configured before it is called.
+  """
+  global _fork_server
+  (request_read, request_write) = os.pipe()
+  (reply_read, reply_write) = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    # Child.
+    try:
+      os.close(request_write)
+      os.close(reply_read)
+      _close_other_pipes([request_read, reply_write])
+      _serve(os.fdopen(request_read, "r"), os.fdopen(reply_write, "w"))
+      exitcode = 0
+    except KeyboardInterrupt:
+      exitcode = 130
+    except BaseException, e:
+      print >> sys.stderr, "Exception in fork server: %s: %s" % (type(e), e)
+      exitcode = 1
+    finally:
+      os._exit(exitcode)
+  os.close(request_read)
+  os.close(reply_write)
+  _fork_server = (pid, os.fdopen(request_write, "w"),
+                  os.fdopen(reply_read, "r"))
+
+def stop_fork_server():
+  """Stops the fork server, if it is running. Stages that it launched keep
+     running."""
+  global _fork_server
+  if not _fork_server:
+    return
+  (pid, requests, replies) = _fork_server
+  _fork_server = None
+  requests.close()
+  replies.close()
+  os.waitpid(pid, 0)
+
+def has_fork_server():
+  """Checks if the fork server is running."""
+  return bool(_fork_server)
+
+def launch_stage(factory, args, input_read_handles, close_in_child):
+  """Launch a child process to run the function returned by factory(*args).
+
+  If the fork server is running, the child is forked from it rather than from
+  us, so factory must be a module-level function and args must be picklable.
+  Such a child is not ours to wait for, and has none of our pipes to close.
+  Returns the read end of the child's output pipe and the child's pid.
+  """
+  if not _fork_server:
+    return launch(factory(*args), input_read_handles, close_in_child)
+  (_, requests, replies) = _fork_server
+  (out_read, out_write) = os.pipe()
+  cPickle.dump((factory.__module__, factory.__name__, args,
+                input_read_handles, out_write), requests,
+               cPickle.HIGHEST_PROTOCOL)
+  requests.flush()
+  # The server has its own copies of our ends of the pipes once it replies.
+  pid = cPickle.load(replies)
+  for in_read in input_read_handles:
+    os.close(in_read)
+  os.close(out_write)
+  return (out_read, pid)
@@ -23,18 +23,30 @@ warnings.filterwarnings("ignore", "apt API not stable yet",
 
 import getopt
 import os
-import shutil
 import stat
 import sys
-import tempfile
+import threading
 import time
+import zlib
 
 from apt_diff import apt_fetcher_process
 from apt_diff import apt_helper
+from apt_diff import checkpoint
+from apt_diff import device_helper
 from apt_diff import differ_process
 from apt_diff import dpkg_helper
+from apt_diff import findings
+from apt_diff import io_helper
 from apt_diff import launch_helper
+from apt_diff import manifest
+from apt_diff import md5sums_checker
 from apt_diff import parallel_md5sums_checker
+from apt_diff import path_index
+from apt_diff import pipeline
+from apt_diff import root_helper
+from apt_diff import stats
+from apt_diff import threaded_md5sums_checker
+from apt_diff import trace
 
 VERSION = "0.9.7"
 
@@ -55,6 +67,30 @@ _NO_OVERRIDE_CACHE = "no-override-cache"
 _REPORT_UNVERIFIABLE = "report-unverifiable"
 _TEMPDIR = "tempdir"
 _NO_REMOVE_EXTRACTED = "no-remove-extracted"
+_RESUME = "resume"
+_IO_LIMIT = "io-limit"
+_DROP_CACHE = "drop-cache"
+_NICE = "nice"
+_IDLE_IO = "idle-io"
+_JOBS = "jobs"
+_SHORT_JOBS = "j"
+_AUTO = "auto"
+_TIMEOUT = "timeout"
+_ORDERED_READS = "ordered-reads"
+_FORMAT = "format"
+_MAX_DIFF_SIZE = "max-diff-size"
+_STATS = "stats"
+_TRACE = "trace"
+_TOP_PACKAGES = "top-packages"
+_ROOT = "root"
+_FORK_SERVER = "fork-server"
+_HASH_THREADS = "hash-threads"
+_SHARDS = "shards"
+_SAMPLE = "sample"
+_SAMPLE_RUN = "sample-run"
+_ALWAYS_CHECK = "always-check"
+_DAEMON = "daemon"
+_CONNECT = "connect"
 
 _USAGE = """
 Usage: apt-diff [OPTION]... [PATH|PACKAGE]...
@@ -67,6 +103,10 @@ Options:
     --package       -p <name>          Check the named package.
     --path          -f <path>          Check the given path (recursively).
     --apt-option    -o <name>=<value>  Set an arbitrary APT option.
+    --jobs          -j <count>|auto    Check up to <count> files at once on
+                                       each device, or size this
+                                       automatically based on the CPUs and
+                                       the kind of storage (the default).
     --help          -h                 Show this help.
     --version       -V                 Show the version.
 
@@ -79,26 +119,163 @@ Options:
     --tempdir          <dir>           Use <dir> as the temp directory instead
                                        of creating one automatically.
     --no-remove-extracted              Don't remove extracted packages from the
-                                       temp directory after completion."""
-
-def _launch_pipeline(apt_helper, extraction_dir):
-  (md5sum_in_read, md5sum_in_write) = os.pipe()
-  md5sum_out_read = launch_helper.launch(
-      parallel_md5sums_checker.run,
-      [md5sum_in_read],
-      [md5sum_in_write])
-  (apt_fetcher_in_read, apt_fetcher_in_write) = os.pipe()
-  apt_fetcher_out_read = launch_helper.launch(
-      apt_fetcher_process.AptFetcher(apt_helper).run,
-      [md5sum_out_read, apt_fetcher_in_read],
-      [md5sum_in_write, apt_fetcher_in_write])
-  differ_out_read = launch_helper.launch(
-      differ_process.create(extraction_dir),
-      [apt_fetcher_out_read],
-      [md5sum_in_write, apt_fetcher_in_write])
-  return (os.fdopen(md5sum_in_write, "w"),
-          os.fdopen(apt_fetcher_in_write, "w"),
-          os.fdopen(differ_out_read, "r"))
+                                       temp directory after completion.
+    --resume                           Resume an interrupted run from the
+                                       checkpoint in the temp directory.
+    --io-limit         <rate>          Limit the combined read rate of all
+                                       checks to <rate> bytes per second
+                                       (suffixes K, M and G are accepted).
+    --drop-cache                       Drop files from the page cache after
+                                       checking them.
+    --nice             <niceness>      Run the checks at the given niceness.
+    --idle-io                          Run the checks in the idle I/O
+                                       scheduling class.
+    --timeout          <seconds>       Give up on reading a file or fetching a
+                                       package after <seconds> and count it
+                                       as an error.
+    --ordered-reads                    Read the files on each device in the
+                                       order they are laid out on disk and
+                                       prefetch upcoming ones. Speeds up
+                                       checking many small files on
+                                       rotational disks.
+    --format           text|ndjson     Write findings as prose (the default)
+                                       or as one JSON record per line on
+                                       stdout. With ndjson, everything else
+                                       goes to stderr.
+    --max-diff-size    <bytes>         Include at most <bytes> of each diff in
+                                       the output, or none if 0.
+    --stats                            Report time and volume statistics for
+                                       each stage of the check.
+    --trace            <file>          Write a timeline of every process to
+                                       <file> in the Chrome trace event
+                                       format.
+    --top-packages     <count>         Report the <count> packages that took
+                                       the most time to check.
+    --root             <dir>           Check the system installed at <dir>,
+                                       using its dpkg database and APT
+                                       configuration. May be given more than
+                                       once to check several systems, which
+                                       then share downloaded and extracted
+                                       packages and the md5sums of shared
+                                       files. Paths are relative to each
+                                       root.
+    --fork-server                      Launch every stage of the check from a
+                                       small process started before the dpkg
+                                       database and APT cache are loaded, so
+                                       that the stages don't carry copies of
+                                       them.
+    --hash-threads                     Check md5sums with threads in the main
+                                       process rather than with worker
+                                       processes. Cannot be combined with
+                                       --ordered-reads, --nice or --idle-io.
+    --shards           <count>         Load the dpkg database in <count>
+                                       parts, checking the paths of each
+                                       part before loading the next, to
+                                       limit memory use. The results are
+                                       the same.
+    --sample           <count>         Check the content of only one in
+                                       <count> package files, chosen by the
+                                       run number so that <count>
+                                       consecutive runs check every file
+                                       once. Conffiles are always checked.
+    --sample-run       <number>        The run number for --sample. By
+                                       default a counter is kept in the
+                                       tempdir for each set of paths and
+                                       packages and <count>, and advanced
+                                       by each run that completes.
+    --always-check     <dir>           Check the content of every file under
+                                       <dir> even with --sample. May be
+                                       given more than once.
+    --daemon           <socket>        Keep the dpkg database and APT cache
+                                       loaded and check what is asked for
+                                       by clients on the Unix socket
+                                       <socket>. The other options are the
+                                       defaults for every request.
+    --connect          <socket>        Have the daemon listening on <socket>
+                                       do the check. The APT options are
+                                       those of the daemon."""
+
+class _Md5sumStage:
+  """Passes md5sum checks to the md5sum stage of the pipeline."""
+
+  def __init__(self, fileobj):
+    self.__file = fileobj
+
+  def check(self, pkgname, md5sum, st, expected_size, filename):
+    """Queues a check of a file against its md5sum."""
+    self.__file.write(md5sums_checker.format_job(pkgname, md5sum, st,
+                                                 expected_size, filename))
+    self.__file.flush()
+
+  def close(self):
+    """Tells the stage that there are no more checks."""
+    self.__file.close()
+
+def sample_slice(path, sample):
+  """Gets the slice of a path in a check of one in sample files, given by the
+     hash of the path."""
+  return (zlib.crc32(path) & 0xffffffff) % sample
+
+def _create_pipeline(apt_helper, extraction_dir, checkpoint_dir, manifest_dir,
+                     jobs, timeout, ordered_reads, hash_threads, root,
+                     index_path, dpkg_state):
+  """Creates the pipeline that checks files: md5sums are checked, the packages
+     of files that fail (or have no md5sum) are fetched, and the files are
+     diff'ed against them. The index_path is the directory of the
+     path_index.PathIndex of root, if any, and dpkg_state is the preloaded
+     dpkg_helper.DpkgHelper of this system, if any, to use instead."""
+  pipe = pipeline.Pipeline()
+  if not hash_threads:
+    md5sum = pipe.add(pipeline.Stage(
+        "md5sum", factory=parallel_md5sums_checker.create,
+        args=(checkpoint_dir, jobs, timeout, ordered_reads, root)))
+  if launch_helper.has_fork_server():
+    # The fetcher has to load its own APT cache.
+    fetcher = pipe.add(pipeline.Stage(
+        "fetcher", factory=apt_fetcher_process.create, args=(timeout, root),
+        inputs=2))
+  else:
+    fetcher = pipe.add(pipeline.Stage(
+        "fetcher",
+        function=apt_fetcher_process.AptFetcher(apt_helper, timeout).run,
+        inputs=2))
+  if dpkg_state:
+    # Inherited by the differ, like the APT cache by the fetcher.
+    differ = pipe.add(pipeline.Stage(
+        "differ",
+        function=differ_process.create(extraction_dir, checkpoint_dir,
+                                       manifest_dir, root,
+                                       dpkg_state=dpkg_state)))
+  else:
+    differ = pipe.add(pipeline.Stage(
+        "differ", factory=differ_process.create,
+        args=(extraction_dir, checkpoint_dir, manifest_dir, root,
+              index_path)))
+  if hash_threads:
+    # We check the md5sums ourselves, and write the failures straight to the
+    # fetcher.
+    pipe.feed(fetcher, 0)
+  else:
+    pipe.feed(md5sum)
+    pipe.connect(md5sum, fetcher, 0)
+  pipe.feed(fetcher, 1)
+  pipe.connect(fetcher, differ)
+  pipe.read(differ)
+  pipe.start()
+  if hash_threads:
+    md5sum_checker = threaded_md5sums_checker.ThreadedMd5sumsChecker(
+        checkpoint_dir, jobs, timeout, pipe.input_file(fetcher, 0), root)
+  else:
+    md5sum_checker = _Md5sumStage(pipe.input_file(md5sum))
+  return (pipe, md5sum_checker, pipe.input_file(fetcher, 1),
+          pipe.output_file(differ))
+
+# What to do with a path in a shard.
+_CHECK = "check"
+_WALK = "walk"
+
+class Cancelled(Exception):
+  """Raised by AptDiff.execute() when the run has been cancelled."""
 
 class AptDiff:
   """Class for managing the APT diff workflow."""
@@ -118,67 +295,399 @@ class AptDiff:
     self.ignored_conffiles_count = 0
     self.unverifiable_link_count = 0
     self.unverifiable_dir_count = 0
+    self.checkpoint_dir = None
+    self.manifest_dir = None
+    # Where to keep the path_index.PathIndex of each dpkg database, if any.
+    self.index_dir = None
+    self.jobs = None
+    self.timeout = None
+    self.ordered_reads = False
+    self.hash_threads = False
+    self.resume = False
+    self.resumed_count = 0
+    self.hardlink_bytes_saved = 0
+    self.manifest_count = 0
+    # The writer for findings, if they are to be written as records.
+    self.writer = None
+    self.show_stats = False
+    # The dpkg and APT state of this system if it is already loaded, as a
+    # pair of a DpkgHelper for every path and an AptHelper.
+    self.preloaded = None
+    # The number of parts to load the dpkg state in, one after the other.
+    self.shards = 1
+    # The content of only one in this many package files is checked, chosen
+    # by sample_run (see __sampled()).
+    self.sample = 1
+    self.sample_run = 0
+    # The package files whose content was checked, and those skipped by
+    # sampling.
+    self.sampled_file_count = 0
+    self.unsampled_file_count = 0
+    self.top_packages = 0
+    # Statistics from every process, if they are being collected.
+    self.stats = []
+    self.__syscalls = {"lstat": 0, "stat": 0, "listdir": 0, "access": 0}
+    self.__path_count = 0
+    self.__dpkg_seconds = 0.0
+    self.__apt_seconds = 0.0
+    self.__traversal_seconds = 0.0
     self.__paths = []
+    self.__packages = []
+    self.__roots = []
+    # The directories whose files are checked regardless of sampling.
+    self.__always_checked = []
+    # The root of the system currently being checked, or "" for this one, and
+    # the root_helper.Resolver that finds its files.
+    self.__root = ""
+    self.__resolver = root_helper.Resolver("")
+    # The shard currently being checked and its dpkg_helper.ShardFilter, if
+    # any.
+    self.__shard = None
+    self.__shard_filter = None
+    self.__md5sum_verdicts = {}
+    self.__diff_results = {}
+    self.__last_checkpoint = 0
+    # The first md5sum check of each inode that may be reachable by more than
+    # one path, keyed by (st_dev, st_ino, md5sum), along with the root it was
+    # made under.
+    self.__inode_checks = {}
+    self.__multiply_mounted_devs = set()
+    self.__pipeline = None
+    self.__cancelled = False
 
   def check_path(self, path):
     """Diff a path (recursively)."""
     normpath = os.path.normpath(os.path.join(os.getcwd(), path))
     self.__paths.append(normpath)
 
+  def always_check(self, path):
+    """Check the content of every file under a path, even when sampling."""
+    normpath = os.path.normpath(os.path.join(os.getcwd(), path))
+    self.__always_checked.append(normpath)
+
   def check_package(self, pkgname):
     """Diff all leaf paths owned by a package (recursively)."""
-    paths = dpkg_helper.expand_package_to_leaf_paths(pkgname)
-    if not paths:
-      print "Package %s does not own any installed paths" % pkgname
-      return
-    self.__paths.extend(paths)
+    # Expanded for each root in turn, since they may have different versions
+    # installed.
+    self.__packages.append(pkgname)
+
+  def add_root(self, root):
+    """Check the system installed at root rather than this one. Paths are
+       relative to each root that is added."""
+    # Keep no trailing slash so that root-relative paths can be appended.
+    self.__roots.append(os.path.abspath(root).rstrip("/"))
+
+  def cancel(self):
+    """Makes execute() stop as soon as it can by raising Cancelled. May be
+       called from another thread."""
+    self.__cancelled = True
+    pipe = self.__pipeline
+    if pipe:
+      pipe.cancel()
+
+  def has_roots(self):
+    """Checks if other systems are being checked rather than this one."""
+    return bool(self.__roots)
 
   def execute(self):
     """Execute the diff workflow."""
     time1 = time.time()
-    self.__dpkg_helper = dpkg_helper.DpkgHelper(dpkg_helper.PathFilter(
-        self.__paths))
-    self.__apt_helper = apt_helper.AptHelper()
-    # Start our processing pipeline.
-    (self.__md5sum_in,
-     self.__apt_fetcher_in,
-     self.__differ_out) = _launch_pipeline(
-        self.__apt_helper, self.extraction_dir)
-    # Perform all requested diffs.
-    if not self.__paths:
-      print "Warning: no paths to diff. This is a no-op."
+    trace.set_process_name("main")
+    self.__start_checkpoint()
+    self.__always_checked_filter = dpkg_helper.PathFilter(
+        self.__always_checked)
+    self.__multiply_mounted_devs = (
+        device_helper.MountTable().multiply_mounted_devs())
+    self.__manifests = manifest.ManifestStore(self.manifest_dir)
+    for root in self.__roots or [""]:
+      self.__execute_root(root)
+    # The run is complete, so the checkpoint is no longer needed.
+    checkpoint.remove(self.checkpoint_dir)
+    time2 = time.time()
+    if stats.is_enabled():
+      self.stats.append({
+          "stage": stats.MAIN, "pid": os.getpid(),
+          "dpkg_seconds": self.__dpkg_seconds,
+          "apt_seconds": self.__apt_seconds,
+          "traversal_seconds": self.__traversal_seconds,
+          "paths": self.__path_count,
+          "syscalls": self.__syscalls,
+          "memory": stats.memory_usage()})
+    records = []
+    if self.show_stats:
+      records.append(findings.record(findings.STATISTICS, "Statistics",
+                                     processes=self.stats))
+    if self.top_packages:
+      costs = stats.package_costs(self.stats)[:self.top_packages]
+      records.append(findings.record(findings.PACKAGE_COSTS,
+                                     "Slowest packages", costs=costs))
+    records.append(findings.record(findings.SUMMARY, "Finished",
+                                   **self.__summary(time2 - time1)))
+    for rec in records:
+      if self.writer:
+        # Written out as prose by whoever reads the records, so that it
+        # comes after the findings before it.
+        self.writer.write(rec)
+      else:
+        _write_summary(findings.Finding(rec))
+
+  def __summary(self, seconds):
+    """Gets the fields of the SUMMARY record of a check that took the given
+       seconds. The counts of what was left out are only given if not 0."""
+    fields = {"discrepancies": self.discrepancy_count,
+              "errors": self.error_count, "seconds": seconds}
+    counts = {"ignored_conffiles": self.ignored_conffiles_count,
+              "ignored_extras": self.ignored_extras_count,
+              "unverifiable_dirs": self.unverifiable_dir_count,
+              "unverifiable_links": self.unverifiable_link_count,
+              "hardlink_bytes_saved": self.hardlink_bytes_saved,
+              "manifest_verified": self.manifest_count,
+              "resumed": self.resumed_count}
+    for (name, count) in counts.iteritems():
+      if count:
+        fields[name] = count
+    sampling = self.__sampling()
+    if sampling:
+      fields["sampling"] = sampling
+    if io_helper.is_rate_limited():
+      (rate, total_bytes, elapsed) = io_helper.throughput()
+      fields["throughput"] = {"limit": rate, "bytes": total_bytes,
+                              "seconds": elapsed}
+    return fields
+
+  def __execute_root(self, root):
+    """Check the system installed at root, or this one if root is empty."""
+    time1 = time.time()
+    self.__root = root
+    self.__resolver = root_helper.Resolver(root)
+    if root:
+      print "Checking the system installed at %s" % root
+      apt_helper.set_root(root)
+    admin_dir = apt_helper.dpkg_admin_dir()
+    self.__forget_changed_diffs(admin_dir, root)
+    paths = list(self.__paths)
+    for pkgname in self.__packages:
+      package_paths = dpkg_helper.expand_package_to_leaf_paths(pkgname,
+                                                               admin_dir)
+      if not package_paths:
+        print "Package %s does not own any installed paths" % pkgname
+        continue
+      paths.extend(package_paths)
+    preloaded_dpkg_helper = None
+    if self.preloaded and not root:
+      self.__apt_helper = self.preloaded[1]
+      if not launch_helper.has_fork_server():
+        # Kept up to date by its owner, so there is no index to refresh.
+        preloaded_dpkg_helper = self.preloaded[0]
     else:
-      for path in self.__paths:
-        self.__do_check_path(path)
-    # Close processing input handles so that the pipeline knows the data is
-    # over and the processes will exit.
-    self.__md5sum_in.close()
-    self.__apt_fetcher_in.close()
-    # Wait for all summing to be finished and the count of modified files to be
-    # available.
-    self.discrepancy_count = (self.discrepancy_count +
-                              int(self.__differ_out.readline()))
+      self.__apt_helper = apt_helper.AptHelper()
+      trace.complete("load APT cache", time1, root=root)
+    apt_time = time.time()
+    dpkg_seconds = 0.0
+    index = None
+    index_path = None
+    if self.index_dir and not preloaded_dpkg_helper:
+      # Kept up to date for every check, since the stages look paths up in it
+      # too.
+      index = path_index.PathIndex(self.index_dir, admin_dir)
+      index.update()
+      index_path = index.path()
+      dpkg_seconds = time.time() - apt_time
+      trace.complete("update path index", apt_time, root=root)
+    # Start our processing pipeline. The dpkg state is loaded afterwards so
+    # that the stages don't get a copy of it.
+    (self.__pipeline,
+     self.__md5sum_checker,
+     self.__apt_fetcher_in,
+     self.__differ_out) = _create_pipeline(
+        self.__apt_helper, self.extraction_dir, self.checkpoint_dir,
+        self.manifest_dir, self.jobs, self.timeout, self.ordered_reads,
+        self.hash_threads, root, index_path, preloaded_dpkg_helper)
+    try:
+      # The differ's output must be read as we go, since it passes findings
+      # along.
+      differ_reader = threading.Thread(target=self.__read_differ_output)
+      differ_reader.daemon = True
+      differ_reader.start()
+      # Perform all requested diffs.
+      if not paths:
+        print "Warning: no paths to diff. This is a no-op."
+      elif self.shards > 1 and not (self.preloaded and not root):
+        for shard in xrange(self.shards):
+          self.__shard = shard
+          self.__shard_filter = dpkg_helper.ShardFilter(
+              dpkg_helper.PathFilter(paths), shard, self.shards)
+          dpkg_seconds = dpkg_seconds + self.__load_dpkg_state(
+              self.__shard_filter, admin_dir, root, index)
+          for path in paths:
+            self.__do_check_path(path)
+          # Free this shard's state before loading the next one.
+          self.__dpkg_helper = None
+        self.__shard = None
+        self.__shard_filter = None
+      else:
+        if self.preloaded and not root:
+          self.__dpkg_helper = self.preloaded[0]
+        else:
+          dpkg_seconds = dpkg_seconds + self.__load_dpkg_state(
+              dpkg_helper.PathFilter(paths), admin_dir, root, index)
+        for path in paths:
+          self.__do_check_path(path)
+      traversal_time = time.time()
+      trace.complete("traverse", apt_time, root=root)
+      # Close processing input handles so that the pipeline knows the data is
+      # over and the processes will exit.
+      self.__md5sum_checker.close()
+      self.__apt_fetcher_in.close()
+      # Wait for all summing to be finished and the count of modified files to
+      # be available, along with the count of files that couldn't be checked.
+      differ_reader.join()
+    except BaseException:
+      # Don't leave the stages running if we were interrupted or failed.
+      self.__pipeline.cancel()
+      raise
+    finally:
+      pipe = self.__pipeline
+      self.__pipeline = None
+      self.__dpkg_helper = None
+    pipe.wait()
+    if self.__cancelled:
+      # The pipeline was cut short, so there are no counts.
+      raise Cancelled()
+    trace.complete("wait for pipeline", traversal_time, root=root)
+    (discrepancies, errors) = self.__differ_counts
+    self.discrepancy_count = self.discrepancy_count + int(discrepancies)
+    self.error_count = self.error_count + int(errors)
     self.__differ_out.close()
-    # Summarize findings.
-    print "--------------------------------"
-    print ("Found %d differences between filesystem state and package state" %
-           self.discrepancy_count)
-    if 0 != self.error_count:
-      print ("Encountered %d errors that prevented a complete check" %
-             self.error_count)
-    if 0 != self.ignored_conffiles_count:
-      print "Ignored %d conffiles" % self.ignored_conffiles_count
-    if 0 != self.ignored_extras_count:
-      print ("Ignored %d extra paths not owned by any package" %
-             self.ignored_extras_count)
-    if 0 != self.unverifiable_dir_count:
-      print "Skipped %d unverifiable directories" % self.unverifiable_dir_count
-    if 0 != self.unverifiable_link_count:
-      print (
-          "Skipped %d unverifiable symbolic links"
-          % self.unverifiable_link_count)
-    time2 = time.time()
-    print "Finished in %g seconds" % (time2 - time1)
+    self.__dpkg_seconds = self.__dpkg_seconds + dpkg_seconds
+    self.__apt_seconds = self.__apt_seconds + apt_time - time1
+    self.__traversal_seconds = (self.__traversal_seconds + traversal_time -
+                                apt_time - dpkg_seconds)
+    if len(self.__roots) > 1:
+      # Pick up the verdicts from this root so that the roots after it can
+      # reuse them for the files they share.
+      self.__md5sum_verdicts.update(
+          checkpoint.load_md5sum_verdicts(self.checkpoint_dir))
+
+  def __load_dpkg_state(self, path_filter, admin_dir, root, index):
+    """Loads the dpkg state of the paths in path_filter, from the up-to-date
+       path_index.PathIndex if one is given. Returns the seconds that it
+       took."""
+    time1 = time.time()
+    # Even for a check of everything, the index is faster to load than the
+    # info files, which it has just read if it had to.
+    self.__dpkg_helper = dpkg_helper.DpkgHelper(path_filter, admin_dir,
+                                                index=index)
+    trace.complete("load dpkg database", time1, root=root,
+                   shard=self.__shard)
+    return time.time() - time1
+
+  def __sampling(self):
+    """Gets the parameters and coverage of the sampling, or None if every
+       file was checked."""
+    if self.sample <= 1:
+      return None
+    return {"slices": self.sample, "run": self.sample_run,
+            "slice": self.sample_run % self.sample,
+            "always_checked": self.__always_checked,
+            "checked_files": self.sampled_file_count,
+            "files": self.sampled_file_count + self.unsampled_file_count}
+
+  def __sampled(self, normpath, node):
+    """Checks if the content of a package file is to be checked in this
+       run."""
+    if self.sample <= 1:
+      return True
+    path = self.__root_path(normpath)
+    if self.__always_checked_filter.includes(path):
+      return True
+    for pkg_info in node.package_info().itervalues():
+      if pkg_info.conffile_status():
+        return True
+    # Each run checks the next slice. The path is that in its root so that
+    # every root has the same slices.
+    return sample_slice(path, self.sample) == self.sample_run % self.sample
+
+  def targets(self):
+    """Gets a description of what is being checked, for the checkpoint and
+       the sample run counter."""
+    return (["root " + root for root in self.__roots] + self.__paths +
+            ["package " + pkgname for pkgname in self.__packages])
+
+  def __host_path(self, normpath):
+    """Gets the path on this system of a path in the current root."""
+    if normpath == "/":
+      return self.__root or "/"
+    return self.__root + normpath
+
+  def __root_path(self, normpath):
+    """Gets the path in the current root of a path on this system."""
+    return normpath[len(self.__root):] or "/"
+
+  def __read_differ_output(self):
+    # Not "for line in self.__differ_out", which reads ahead and would hold
+    # back findings until a whole block of them has arrived.
+    for line in iter(self.__differ_out.readline, ""):
+      if findings.is_record(line):
+        if self.writer:
+          self.writer.write_encoded(line)
+      elif stats.is_stats(line):
+        values = stats.decode(line)
+        if values:
+          self.stats.append(values)
+      else:
+        # The last line has the counts.
+        self.__differ_counts = line.split()
+
+  def __report(self, kind, message, path, packages=None):
+    if self.writer:
+      self.writer.write(findings.record(kind, message, path, packages))
+    elif kind == findings.ERROR:
+      print >> sys.stderr, message
+    else:
+      print message
+
+  def __start_checkpoint(self):
+    if self.resume:
+      position = checkpoint.load_position(self.checkpoint_dir)
+      if not position:
+        print "Warning: No checkpoint to resume from. Starting over."
+      elif position[0] != self.targets():
+        print ("Warning: Checkpoint was made for a different set of paths. "
+               "Starting over.")
+      else:
+        print "Resuming interrupted run from %s" % position[1]
+        self.__md5sum_verdicts = checkpoint.load_md5sum_verdicts(
+            self.checkpoint_dir)
+        self.__diff_results = checkpoint.load_diff_results(
+            self.checkpoint_dir)
+        # The old journals stay in place so that a run that is interrupted
+        # again still has them.
+        return
+    checkpoint.reset(self.checkpoint_dir)
+
+  def __forget_changed_diffs(self, admin_dir, root):
+    """Forgets what was found by the diffs from before the interruption for
+       the packages of root that have changed since, so that their files are
+       diff'ed against what is installed now."""
+    changed = checkpoint.changed_packages(self.checkpoint_dir, admin_dir)
+    if not changed:
+      return
+    prefix = root + "/"
+    for key in [(pkgname, normpath)
+                for (pkgname, normpath) in self.__diff_results
+                if pkgname in changed and normpath.startswith(prefix)]:
+      del self.__diff_results[key]
+
+  def __save_checkpoint(self, normpath):
+    now = time.time()
+    if now - self.__last_checkpoint < checkpoint.CHECKPOINT_INTERVAL:
+      return
+    self.__last_checkpoint = now
+    # The traversal itself is cheap and is always redone when resuming so that
+    # the output and counts match an uninterrupted run; the position is
+    # recorded to validate and report on the resumption.
+    checkpoint.save_position(self.checkpoint_dir, self.targets(), normpath)
 
   def __discrepancy(self):
     self.discrepancy_count = self.discrepancy_count + 1
@@ -186,24 +695,53 @@ class AptDiff:
   def __error(self):
     self.error_count = self.error_count + 1
 
+  def __shard_role(self, normpath):
+    """Gets what to do with a path (relative to the root) in the current
+       shard: check it, or walk through it to get to the paths under it that
+       belong to this shard."""
+    if (self.__shard is None or
+        dpkg_helper.shard_of(normpath, self.shards) == self.__shard):
+      return _CHECK
+    return _WALK
+
   def __do_check_path(self, normpath):
     # Find the right node for this path.
     node = self.__dpkg_helper.lookup(normpath)
     # We do not check if a directory crossed in this step was a symlink--we
     # always use False. (This allows a user to effectively suppress the special
     # symlink logic by starting the traversal below the symlink.)
-    self.__do_check(normpath, node, False)
+    self.__do_check(self.__host_path(normpath), node, False)
 
   def __do_check(self,
                  normpath,
                  node,
                  within_symlink):
+    if self.__cancelled:
+      raise Cancelled()
+    if self.__shard_role(self.__root_path(normpath)) == _WALK:
+      self.__walk(normpath, node, within_symlink)
+      return
+    if (not node and self.__shard_filter and
+        self.__shard_filter.has_children(self.__root_path(normpath))):
+      # A directory above paths that were loaded into other shards only. It
+      # has no owners, but the check would find it in the dpkg state.
+      node = dpkg_helper.FilesystemNode()
+    self.__save_checkpoint(normpath)
+    self.__path_count = self.__path_count + 1
+    # Where the path is on this system.
+    location = None
+    self.__syscalls["lstat"] = self.__syscalls["lstat"] + 1
     try:
-      lst = os.lstat(normpath)
+      location = self.__resolver.host_path(normpath, False)
+      lst = os.lstat(location)
     except:
       lst = None
+    self.__syscalls["stat"] = self.__syscalls["stat"] + 1
     try:
-      st = os.stat(normpath)
+      if lst and stat.S_ISLNK(lst.st_mode):
+        # Followed the way it would be inside the root.
+        location = self.__resolver.host_path(normpath)
+      st = os.stat(location)
     except:
       st = None
     lexists = bool(lst)
@@ -217,7 +755,9 @@ class AptDiff:
       # files and directories in the output.
       path = path + "/"
     if node and not lexists:
-      print "Missing path %s owned by %s" % (path, node.owners_str())
+      self.__report(findings.MISSING,
+                    "Missing path %s owned by %s" % (path, node.owners_str()),
+                    normpath, node.owners())
       self.__discrepancy()
     elif not node and lexists:
       if within_symlink:
@@ -233,7 +773,9 @@ class AptDiff:
         # default we suppress printing a message about such paths.
         self.ignored_extras_count = self.ignored_extras_count + 1
         return
-      print "Extra path %s not owned by any package" % path
+      self.__report(findings.EXTRA,
+                    "Extra path %s not owned by any package" % path,
+                    normpath)
       self.__discrepancy()
     elif not node and not lexists:
       # (We will only reach this case if the user explicitly started us at this
@@ -247,6 +789,10 @@ class AptDiff:
       expect_file = bool(node.package_info())
       # If this path has children, then it must be shipped as a directory.
       expect_dir = bool(node.children())
+      if not expect_dir and self.__shard_filter:
+        # They may all be in other shards.
+        expect_dir = self.__shard_filter.has_children(
+            self.__root_path(normpath))
       # Sanity check that these are consistent.
       if expect_file and expect_dir:
         print ("Warning: Inconsistent dpkg state: path %s owned by %s has an "
@@ -269,10 +815,12 @@ class AptDiff:
             print ("Warning: Package content installed under %s crosses "
                    "unexpected symlink") % path
             within_symlink = True
+          self.__syscalls["listdir"] = self.__syscalls["listdir"] + 1
           try:
-            ents = os.listdir(normpath)
+            ents = os.listdir(location)
           except OSError, e:
-            print >> sys.stderr, "Can't recurse into %s: %s" % (path, e)
+            self.__report(findings.ERROR,
+                          "Can't recurse into %s: %s" % (path, e), normpath)
             self.__error()
             return
           ents.extend(node.children())
@@ -289,15 +837,21 @@ class AptDiff:
           # Not a directory on disk, so it's either a regular file, a special
           # file, or a symlink to a non-directory. Regardless, that's a
           # discrepancy
-          print "Non-directory %s is supposed to be a directory owned by %s" % (
-              path,
-              node.owners_str())
+          self.__report(
+              findings.TYPE_MISMATCH,
+              "Non-directory %s is supposed to be a directory owned by %s" % (
+                  path,
+                  node.owners_str()),
+              normpath, node.owners())
           self.__discrepancy()
       elif expect_file:
         if islink:
           if not exists:
-            print "Broken symlink %s is supposed to be a file owned by %s" % (
-                path, node.owners_str())
+            self.__report(
+                findings.TYPE_MISMATCH,
+                "Broken symlink %s is supposed to be a file owned by %s" % (
+                    path, node.owners_str()),
+                normpath, node.owners())
             self.__discrepancy()
           elif isfile:
             # Symlink-to-file, but expected to be a regular file. This is
@@ -308,25 +862,37 @@ class AptDiff:
                 path, node.owners_str())
             # If the target of the symlink compares as equal to the expected
             # content, then we don't count a discrepancy.
-            self.__check_file(normpath, node)
+            self.__check_file(normpath, node, st)
           elif isdir:
-            print ("Symlinked directory %s is supposed to be a file owned by "
-                   "%s") % (path, node.owners_str())
+            self.__report(
+                findings.TYPE_MISMATCH,
+                ("Symlinked directory %s is supposed to be a file owned by "
+                 "%s") % (path, node.owners_str()),
+                normpath, node.owners())
             self.__discrepancy()
           else:
-            print ("Symlinked special file %s is supposed to be a regular "
-                   "file owned by %s") % (path, node.owners_str())
+            self.__report(
+                findings.TYPE_MISMATCH,
+                ("Symlinked special file %s is supposed to be a regular "
+                 "file owned by %s") % (path, node.owners_str()),
+                normpath, node.owners())
             self.__discrepancy()
         elif isfile:
-          self.__check_file(normpath, node)
+          self.__check_file(normpath, node, st)
         elif isdir:
-          print "Directory %s is supposed to be a file owned by %s" % (
-              path,
-              node.owners_str())
+          self.__report(
+              findings.TYPE_MISMATCH,
+              "Directory %s is supposed to be a file owned by %s" % (
+                  path,
+                  node.owners_str()),
+              normpath, node.owners())
           self.__discrepancy()
         else:
-          print ("Special file %s is supposed to be a regular file owned by %s"
-                 % (path, node.owners_str()))
+          self.__report(
+              findings.TYPE_MISMATCH,
+              ("Special file %s is supposed to be a regular file owned by %s"
+               % (path, node.owners_str())),
+              normpath, node.owners())
           self.__discrepancy()
       else:
         # Else we have no way of knowing what filetype it should be. The lack
@@ -340,17 +906,23 @@ class AptDiff:
         if islink:
           self.unverifiable_link_count = self.unverifiable_link_count + 1
           if self.report_unverifiable:
-            print "Skipping unverifiable symbolic link %s owned by %s" % (
-                path,
-                node.owners_str())
+            self.__report(
+                findings.UNVERIFIABLE,
+                "Skipping unverifiable symbolic link %s owned by %s" % (
+                    path,
+                    node.owners_str()),
+                normpath, node.owners())
         elif isdir:
           self.unverifiable_dir_count = self.unverifiable_dir_count + 1
           if self.report_unverifiable:
-            print "Skipping unverifiable directory %s owned by %s" % (
-                path,
-                node.owners_str())
+            self.__report(
+                findings.UNVERIFIABLE,
+                "Skipping unverifiable directory %s owned by %s" % (
+                    path,
+                    node.owners_str()),
+                normpath, node.owners())
         elif isfile:
-          self.__check_file(normpath, node)
+          self.__check_file(normpath, node, st)
         else:
           # No way to know if it's actually supposed to be a special file, but
           # it's very likely not. Warn the user but don't count a discrepancy.
@@ -358,14 +930,53 @@ class AptDiff:
               path,
               node.owners_str())
 
+  def __walk(self, normpath, node, within_symlink):
+    """Goes through a path that is checked with another shard, into whatever
+       directories __do_check() would recurse into, without reporting
+       anything."""
+    if not node or not node.children():
+      return
+    self.__syscalls["lstat"] = self.__syscalls["lstat"] + 1
+    self.__syscalls["stat"] = self.__syscalls["stat"] + 1
+    try:
+      location = self.__resolver.host_path(normpath, False)
+      if stat.S_ISLNK(os.lstat(location).st_mode):
+        location = self.__resolver.host_path(normpath)
+        within_symlink = True
+      if not stat.S_ISDIR(os.stat(location).st_mode):
+        return
+      self.__syscalls["listdir"] = self.__syscalls["listdir"] + 1
+      ents = os.listdir(location)
+    except OSError:
+      # Reported by the shard that checks it.
+      return
+    ents.extend(node.children())
+    ents.sort()
+    last = None
+    for ent in ents:
+      if ent != last:
+        self.__do_check(os.path.join(normpath, ent), node.children().get(ent),
+                        within_symlink)
+      last = ent
+
   def __access(self, normpath):
-    if not os.access(normpath, os.R_OK):
-      print >> sys.stderr, "Don't have read permission for " + normpath
+    self.__syscalls["access"] = self.__syscalls["access"] + 1
+    try:
+      readable = os.access(self.__resolver.host_path(normpath), os.R_OK)
+    except OSError:
+      readable = False
+    if not readable:
+      self.__report(findings.ERROR,
+                    "Don't have read permission for " + normpath, normpath)
       self.__error()
       return False
     return True
 
-  def __check_file(self, normpath, node):
+  def __check_file(self, normpath, node, st):
+    if not self.__sampled(normpath, node):
+      self.unsampled_file_count = self.unsampled_file_count + 1
+      return
+    self.sampled_file_count = self.sampled_file_count + 1
     if not self.__access(normpath):
       return
     # For every md5sum that we have for this file, we check its md5sum against
@@ -380,11 +991,12 @@ class AptDiff:
     md5sums_so_far = {}
     for pkgname in node.owners():
       if pkgname in node.package_info():
-        self.__check_file_with_package_info(md5sums_so_far, normpath, pkgname,
+        self.__check_file_with_package_info(md5sums_so_far, normpath, st,
+                                            pkgname,
                                             node.package_info()[pkgname])
       else:
-        # No md5sum for this file in this package. Have to download it.
-        self.__check_file_without_md5sum(normpath, pkgname)
+        # No md5sum for this file in this package.
+        self.__check_file_with_manifest(normpath, st, pkgname)
     # Also check package info for packages not listed as owners in case the
     # .md5sums file or conffiles status are out of sync with the .list. 
     for pkgname in node.package_info():
@@ -406,16 +1018,16 @@ class AptDiff:
         continue
       print "Warning: Package %s has md5sum for file %s not owned by it" % (
           pkgname, normpath)
-      self.__check_file_with_package_info(md5sums_so_far, normpath, pkgname,
-                                          pkg_info)
+      self.__check_file_with_package_info(md5sums_so_far, normpath, st,
+                                          pkgname, pkg_info)
     # Report conflicting md5sums.
     if len(md5sums_so_far) > 1:
       # This may be due to dpkg-divert. Ideally we should check for diversions.
       print ("Warning: Conflicting md5sums for file %s in different packages: "
              "%s" % (normpath, md5sums_so_far))
 
-  def __check_file_with_package_info(self, md5sums_so_far, normpath, pkgname,
-      pkg_info):
+  def __check_file_with_package_info(self, md5sums_so_far, normpath, st,
+      pkgname, pkg_info):
     if self.ignore_conffiles and pkg_info.conffile_status():
       self.ignored_conffiles_count = self.ignored_conffiles_count + 1
       return
@@ -441,13 +1053,73 @@ class AptDiff:
       md5sums_so_far[md5sum].append(pkgname)
       return
     md5sums_so_far[md5sum] = [pkgname]
-    self.__check_file_with_md5sum(md5sum, normpath, pkgname)
+    # If we have seen the package's archive before then we also know the size
+    # the file should have.
+    expected_size = None
+    entry = self.__manifests.lookup(
+        self.__apt_helper.manifest_key(pkgname), self.__root_path(normpath))
+    if entry and entry[1] == md5sum:
+      expected_size = entry[0]
+    self.__check_file_with_md5sum(md5sum, normpath, st, pkgname, expected_size)
 
-  def __check_file_with_md5sum(self, md5sum, normpath, pkgname):
-    self.__md5sum_in.write("%s %s %s\n" % (pkgname, md5sum, normpath))
-    self.__md5sum_in.flush()
+  def __check_file_with_md5sum(self, md5sum, normpath, st, pkgname,
+                               expected_size):
+    if (st.st_nlink > 1 or st.st_dev in self.__multiply_mounted_devs or
+        len(self.__roots) > 1):
+      # This content may be reachable through other paths too (including in
+      # other roots, which may share it through overlay layers or hard links),
+      # and only needs to be hashed once.
+      key = (st.st_dev, st.st_ino, md5sum)
+      first = self.__inode_checks.get(key)
+      if first and first[2] != self.__root and (
+          self.__md5sum_verdicts.get((md5sum, first[1])) is None):
+        # The check under an earlier root didn't finish, so check it again.
+        first = None
+      if not first:
+        self.__inode_checks[key] = (pkgname, normpath, self.__root)
+      else:
+        self.hardlink_bytes_saved = self.hardlink_bytes_saved + st.st_size
+        (first_pkgname, first_normpath, _) = first
+        verdict = self.__md5sum_verdicts.get((md5sum, first_normpath))
+        if verdict is None:
+          # Diff this file too if the first one fails its check.
+          self.__apt_fetcher_in.write("%s%s %s %s%s%s\n" % (
+              apt_fetcher_process.ALIAS_PREFIX, pkgname, first_pkgname,
+              first_normpath, apt_fetcher_process.ALIAS_SEPARATOR, normpath))
+          self.__apt_fetcher_in.flush()
+        elif not verdict:
+          # The first one failed its check under an earlier root or before the
+          # interruption.
+          self.__check_file_without_md5sum(normpath, pkgname)
+        return
+    verdict = self.__md5sum_verdicts.get((md5sum, normpath))
+    if verdict is not None:
+      # Already checked before the interruption.
+      self.resumed_count = self.resumed_count + 1
+      if not verdict:
+        self.__check_file_without_md5sum(normpath, pkgname)
+      return
+    self.__md5sum_checker.check(pkgname, md5sum, st, expected_size, normpath)
+
+  def __check_file_with_manifest(self, normpath, st, pkgname):
+    # If we have seen the package's archive before then its manifest tells us
+    # what the file should be. Otherwise we have to download it.
+    entry = self.__manifests.lookup(
+        self.__apt_helper.manifest_key(pkgname), self.__root_path(normpath))
+    if not entry:
+      self.__check_file_without_md5sum(normpath, pkgname)
+      return
+    self.manifest_count = self.manifest_count + 1
+    (size, md5sum) = entry
+    self.__check_file_with_md5sum(md5sum, normpath, st, pkgname, size)
 
   def __check_file_without_md5sum(self, normpath, pkgname):
+    if self.__diff_results.get((pkgname, normpath)) == 0:
+      # Already found to match before the interruption. Files that differed
+      # are diff'ed again so that the diff is in the output, as it would be
+      # without the interruption.
+      self.resumed_count = self.resumed_count + 1
+      return
     self.__apt_fetcher_in.write("%s %s\n" % (pkgname, normpath))
     self.__apt_fetcher_in.flush()
 
@@ -460,16 +1132,105 @@ def usage(fileobj):
   version(fileobj)
   print >> fileobj, _USAGE
 
-def _ensure_dir(path):
-  """Ensure that the given directory is owned by this user and is writeable
-     by us only."""
-  if not os.path.isdir(path):
-    os.mkdir(path, 0755)
+def format_sampling(sampling):
+  """Gets the lines of the summary of a check that describe its sampling, as
+     given in the "sampling" field of the SUMMARY record."""
+  coverage = 100.0
+  if sampling["files"]:
+    coverage = 100.0 * sampling["checked_files"] / sampling["files"]
+  always = "every conffile"
+  if sampling["always_checked"]:
+    always = always + " and every file under " + ", ".join(
+        sampling["always_checked"])
+  return ["Sampled slice %d of %d (run %d): checked %d of %d package files "
+          "(%.1f%%), including %s" % (
+              sampling["slice"] + 1, sampling["slices"], sampling["run"],
+              sampling["checked_files"], sampling["files"], coverage, always)]
+
+def format_summary(summary):
+  """Gets the lines of the summary of a check, given the fields of its
+     SUMMARY record."""
+  lines = ["--------------------------------",
+           "Found %d differences between filesystem state and package state" %
+           summary["discrepancies"]]
+  if summary["errors"]:
+    lines.append("Encountered %d errors that prevented a complete check" %
+                 summary["errors"])
+  if summary.get("ignored_conffiles"):
+    lines.append("Ignored %d conffiles" % summary["ignored_conffiles"])
+  if summary.get("ignored_extras"):
+    lines.append("Ignored %d extra paths not owned by any package" %
+                 summary["ignored_extras"])
+  if summary.get("unverifiable_dirs"):
+    lines.append("Skipped %d unverifiable directories" %
+                 summary["unverifiable_dirs"])
+  if summary.get("unverifiable_links"):
+    lines.append("Skipped %d unverifiable symbolic links" %
+                 summary["unverifiable_links"])
+  if summary.get("hardlink_bytes_saved"):
+    lines.append("Skipped hashing %s of files already checked through "
+                 "another hard link, mount or root" %
+                 io_helper.format_bytes(summary["hardlink_bytes_saved"]))
+  if summary.get("manifest_verified"):
+    lines.append("Verified %d files without an md5sum against the manifests "
+                 "of previously fetched packages" %
+                 summary["manifest_verified"])
+  if summary.get("resumed"):
+    lines.append("Reused %d results from the checkpoint of an interrupted "
+                 "run" % summary["resumed"])
+  if summary.get("sampling"):
+    lines.extend(format_sampling(summary["sampling"]))
+  if summary.get("throughput"):
+    throughput = summary["throughput"]
+    lines.append("Read %s at %s/s under a limit of %s/s" % (
+        io_helper.format_bytes(throughput["bytes"]),
+        io_helper.format_bytes(throughput["bytes"] /
+                               max(throughput["seconds"], 0.001)),
+        io_helper.format_bytes(throughput["limit"])))
+  lines.append("Finished in %g seconds" % summary["seconds"])
+  return lines
+
+def _write_summary(finding):
+  """Writes out the statistics and summary of a check."""
+  if finding.kind == findings.STATISTICS:
+    print "Statistics:"
+    for line in stats.format_report(finding.fields["processes"]):
+      print "    " + line
+  elif finding.kind == findings.PACKAGE_COSTS:
+    print "Slowest packages:"
+    for line in stats.format_package_costs(finding.fields["costs"]):
+      print "    " + line
+  else:
+    for line in format_summary(finding.fields):
+      print line
+
+def _write_finding(finding):
+  """Writes out a finding as prose."""
+  if finding.kind in (findings.STATISTICS, findings.PACKAGE_COSTS,
+                      findings.SUMMARY):
+    _write_summary(finding)
+    return
+  if "diff" in finding.fields:
+    text = finding.fields["diff"]
+    if finding.fields.get("diff_truncated"):
+      if text and not text.endswith("\n"):
+        text = text + "\n"
+      text = text + "(Diff of %s truncated; see --%s)\n" % (
+          finding.path, _MAX_DIFF_SIZE)
+  else:
+    text = finding.message + "\n"
+  if finding.kind == findings.ERROR:
+    fileobj = sys.stderr
   else:
-    os.chmod(path, 0755)
+    fileobj = sys.stdout
+  fileobj.write(text.encode("utf-8"))
+  fileobj.flush()
 
 def main(args):
   """main() for apt-diff."""
+  # Imported here because these modules in turn need this one.
+  from apt_diff import api
+  from apt_diff import daemon
   try:
     try:
       opts, args = getopt.getopt(
@@ -477,11 +1238,13 @@ def main(args):
           _SHORT_PACKAGE + ":" +
           _SHORT_PATH + ":" +
           _SHORT_APT_OPTION + ":" +
+          _SHORT_JOBS + ":" +
           _SHORT_HELP +
           _SHORT_VERSION,
           [_PACKAGE + "=",
            _PATH + "=",
            _APT_OPTION + "=",
+           _JOBS + "=",
            _HELP,
            _VERSION,
            _IGNORE_CONFFILES,
@@ -489,28 +1252,62 @@ def main(args):
            _NO_OVERRIDE_CACHE,
            _REPORT_UNVERIFIABLE,
            _TEMPDIR + "=",
-           _NO_REMOVE_EXTRACTED])
+           _NO_REMOVE_EXTRACTED,
+           _RESUME,
+           _IO_LIMIT + "=",
+           _DROP_CACHE,
+           _NICE + "=",
+           _IDLE_IO,
+           _TIMEOUT + "=",
+           _ORDERED_READS,
+           _FORMAT + "=",
+           _MAX_DIFF_SIZE + "=",
+           _STATS,
+           _TRACE + "=",
+           _TOP_PACKAGES + "=",
+           _ROOT + "=",
+           _FORK_SERVER,
+           _HASH_THREADS,
+           _SHARDS + "=",
+           _SAMPLE + "=",
+           _SAMPLE_RUN + "=",
+           _ALWAYS_CHECK + "=",
+           _DAEMON + "=",
+           _CONNECT + "="])
     except getopt.GetoptError, err:
       print >> sys.stderr, str(err)
       usage(sys.stderr)
       return 2
-    apt_helper.initialize()
-    apt_diff = AptDiff(False,
-                       False,
-                       False,
-                       None)
-    no_override_cache = False
-    tempdir = None
-    no_remove_extracted = False
+    paths = []
+    packages = []
+    options = {}
+    apt_options = []
+    roots = []
+    always_checked = []
+    output_format = findings.TEXT
+    daemon_socket = None
+    connect_socket = None
     for (opt, arg) in opts:
       opt = opt.lstrip("-")
       if opt == _PACKAGE or opt == _SHORT_PACKAGE:
-        apt_diff.check_package(arg)
+        packages.append(arg)
       elif opt == _PATH or opt == _SHORT_PATH:
-        apt_diff.check_path(arg)
+        paths.append(arg)
       elif opt == _APT_OPTION or opt == _SHORT_APT_OPTION:
         parts = arg.split("=")
-        apt_helper.set_option(parts[0], "=".join(parts[1:]))
+        apt_options.append((parts[0], "=".join(parts[1:])))
+      elif opt == _JOBS or opt == _SHORT_JOBS:
+        if arg == _AUTO:
+          options["jobs"] = None
+        else:
+          try:
+            options["jobs"] = int(arg)
+          except ValueError:
+            options["jobs"] = 0
+          if options["jobs"] < 1:
+            print >> sys.stderr, "Invalid job count \"%s\"" % arg
+            usage(sys.stderr)
+            return 2
       elif opt == _HELP or opt == _SHORT_HELP:
         usage(sys.stdout)
         return 0
@@ -518,52 +1315,196 @@ def main(args):
         version(sys.stdout)
         return 0
       elif opt == _IGNORE_CONFFILES:
-        apt_diff.ignore_conffiles = True
+        options["ignore_conffiles"] = True
       elif opt == _NO_IGNORE_EXTRAS:
-        apt_diff.no_ignore_extras = True
+        options["no_ignore_extras"] = True
       elif opt == _NO_OVERRIDE_CACHE:
-        no_override_cache = True
+        options["no_override_cache"] = True
       elif opt == _REPORT_UNVERIFIABLE:
-        apt_diff.report_unverifiable = True
+        options["report_unverifiable"] = True
       elif opt == _TEMPDIR:
-        tempdir = arg
+        options["tempdir"] = arg
       elif opt == _NO_REMOVE_EXTRACTED:
-        no_remove_extracted = True
+        options["no_remove_extracted"] = True
+      elif opt == _RESUME:
+        options["resume"] = True
+      elif opt == _IO_LIMIT:
+        try:
+          options["io_limit"] = io_helper.parse_rate(arg)
+        except ValueError:
+          print >> sys.stderr, "Invalid I/O limit \"%s\"" % arg
+          usage(sys.stderr)
+          return 2
+      elif opt == _DROP_CACHE:
+        options["drop_cache"] = True
+      elif opt == _NICE:
+        try:
+          options["nice"] = int(arg)
+        except ValueError:
+          print >> sys.stderr, "Invalid niceness \"%s\"" % arg
+          usage(sys.stderr)
+          return 2
+      elif opt == _IDLE_IO:
+        options["idle_io"] = True
+      elif opt == _TIMEOUT:
+        try:
+          options["timeout"] = float(arg)
+        except ValueError:
+          options["timeout"] = 0
+        if options["timeout"] <= 0:
+          print >> sys.stderr, "Invalid timeout \"%s\"" % arg
+          usage(sys.stderr)
+          return 2
+      elif opt == _ORDERED_READS:
+        options["ordered_reads"] = True
+      elif opt == _TRACE:
+        options["trace"] = arg
+      elif opt == _STATS:
+        options["stats"] = True
+      elif opt == _TOP_PACKAGES:
+        try:
+          options["top_packages"] = int(arg)
+        except ValueError:
+          options["top_packages"] = 0
+        if options["top_packages"] < 1:
+          print >> sys.stderr, "Invalid package count \"%s\"" % arg
+          usage(sys.stderr)
+          return 2
+      elif opt == _ROOT:
+        if not os.path.isdir(arg):
+          print >> sys.stderr, "Invalid root \"%s\"" % arg
+          usage(sys.stderr)
+          return 2
+        if arg.find(" ") != -1:
+          # This would mess up our processing pipeline.
+          print >> sys.stderr, "Spaces are not supported in root paths"
+          return 2
+        roots.append(arg)
+      elif opt == _FORK_SERVER:
+        options["fork_server"] = True
+      elif opt == _HASH_THREADS:
+        options["hash_threads"] = True
+      elif opt == _SHARDS:
+        try:
+          options["shards"] = int(arg)
+        except ValueError:
+          options["shards"] = 0
+        if options["shards"] < 1:
+          print >> sys.stderr, "Invalid shard count \"%s\"" % arg
+          usage(sys.stderr)
+          return 2
+      elif opt == _SAMPLE:
+        try:
+          options["sample"] = int(arg)
+        except ValueError:
+          options["sample"] = 0
+        if options["sample"] < 1:
+          print >> sys.stderr, "Invalid sample count \"%s\"" % arg
+          usage(sys.stderr)
+          return 2
+      elif opt == _SAMPLE_RUN:
+        try:
+          options["sample_run"] = int(arg)
+        except ValueError:
+          options["sample_run"] = -1
+        if options["sample_run"] < 0:
+          print >> sys.stderr, "Invalid run number \"%s\"" % arg
+          usage(sys.stderr)
+          return 2
+      elif opt == _ALWAYS_CHECK:
+        always_checked.append(arg)
+      elif opt == _DAEMON:
+        daemon_socket = arg
+      elif opt == _CONNECT:
+        connect_socket = arg
+      elif opt == _FORMAT:
+        if arg not in findings.FORMATS:
+          print >> sys.stderr, "Invalid format \"%s\"" % arg
+          usage(sys.stderr)
+          return 2
+        output_format = arg
+      elif opt == _MAX_DIFF_SIZE:
+        try:
+          options["max_diff_size"] = int(arg)
+        except ValueError:
+          options["max_diff_size"] = -1
+        if options["max_diff_size"] < 0:
+          print >> sys.stderr, "Invalid diff size \"%s\"" % arg
+          usage(sys.stderr)
+          return 2
       else:
         # Shouldn't happen because getopt should have thrown an error.
         raise Exception("Unexpected option")
+    if options.get("hash_threads") and options.get("ordered_reads"):
+      print >> sys.stderr, ("--%s cannot be combined with --%s" %
+                            (_HASH_THREADS, _ORDERED_READS))
+      usage(sys.stderr)
+      return 2
+    if options.get("hash_threads") and (options.get("nice") is not None or
+                                        options.get("idle_io")):
+      # Run the whole command under nice and ionice instead.
+      print >> sys.stderr, ("--%s cannot be combined with --%s or --%s" %
+                            (_HASH_THREADS, _NICE, _IDLE_IO))
+      usage(sys.stderr)
+      return 2
+    if daemon_socket and connect_socket:
+      print >> sys.stderr, ("--%s cannot be combined with --%s" %
+                            (_DAEMON, _CONNECT))
+      usage(sys.stderr)
+      return 2
+    if connect_socket and apt_options:
+      print >> sys.stderr, ("--%s cannot be combined with --%s" %
+                            (_APT_OPTION, _CONNECT))
+      usage(sys.stderr)
+      return 2
+    if apt_options:
+      options["apt_options"] = apt_options
+    if roots:
+      options["roots"] = roots
+    if always_checked:
+      options["always_check"] = always_checked
     for arg in args:
       # Try to guess what the user meant by this.
       if arg[0] == "/":
         # Treat it like --path
-        apt_diff.check_path(arg)
+        paths.append(arg)
       elif arg[0].isalnum():
         # Treat it like --package
-        apt_diff.check_package(arg)
+        packages.append(arg)
       else:
         print >> sys.stderr, "Don't know what to do with \"%s\"" % arg
         usage(sys.stderr)
         return 2
-    # Create default tempdir if none specified.
-    if not tempdir:
-      tempdir = os.path.join(tempfile.gettempdir(),
-                             "apt-diff_" + str(os.getuid()))
-      _ensure_dir(tempdir)
-    if tempdir.find(" ") != -1:
-      # This would mess up our processing pipeline.
-      raise Exception("Spaces are not supported in the tempdir path")
-    if not no_override_cache and os.getuid():
-      # Set default archive dir to one we can actually write to.
-      archive_dir = os.path.join(tempdir, "archives")
-      _ensure_dir(archive_dir)
-      _ensure_dir(os.path.join(archive_dir, "partial"))
-      apt_helper.set_option("Dir::Cache::Archives", archive_dir)
-    extraction_dir = os.path.join(tempdir, "extracted")
-    _ensure_dir(extraction_dir)
-    apt_diff.extraction_dir = extraction_dir
-    apt_diff.execute()
-    if not no_remove_extracted:
-      # Recursively delete the extracted packages.
-      shutil.rmtree(extraction_dir)
+    if daemon_socket:
+      if paths or packages:
+        print >> sys.stderr, "The daemon is told what to check by its clients"
+        usage(sys.stderr)
+        return 2
+      daemon.serve(daemon_socket, options)
+      return
+    writer = None
+    if output_format == findings.NDJSON:
+      # Keep stdout for the records and send everything else, including the
+      # output of our child processes, to stderr.
+      sys.stdout.flush()
+      records_fileno = os.dup(1)
+      os.dup2(2, 1)
+      writer = findings.Writer(os.fdopen(records_fileno, "w"))
+    if connect_socket:
+      results = daemon.request(connect_socket, paths, packages, options)
+    else:
+      results = api.verify(paths, packages, options)
+    try:
+      for finding in results:
+        if writer and finding.kind != findings.MESSAGE:
+          # The daemon's prose goes with ours.
+          writer.write(finding.record())
+        else:
+          _write_finding(finding)
+    finally:
+      # Stops the check if we were interrupted.
+      results.close()
+    if writer:
+      writer.close()
   except KeyboardInterrupt:
     return 130
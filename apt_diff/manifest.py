@@ -0,0 +1,138 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Routines for recording the size and md5sum of every file in the package
+archives that we have seen, so that files can be verified against them in
+later runs without fetching the archive again.
+
+Manifests are stored one per package version in a directory that persists
+across runs. Each line of a manifest is "<size> <md5sum> <path>".
+"""
+
+import hashlib
+import os
+import subprocess
+import sys
+import tarfile
+
+_READ_SIZE = 4096 * 16
+
+
+def key(pkgname, version, arch):
+  """Gets the key of the manifest for a package version, which is also its
+     filename in the manifest directory."""
+  # Escape the epoch separator the same way that APT does for archive names.
+  return "%s_%s_%s" % (pkgname, version.replace(":", "%3a"), arch)
+
+
+def _archive_key(archive_path):
+  """Gets the manifest key of a package archive from its control fields."""
+  with open(os.devnull) as devnull:
+    fields = subprocess.Popen(
+        ["dpkg-deb", "--show",
+         "--showformat=${Package} ${Version} ${Architecture}",
+         archive_path],
+        stdin = devnull, stdout = subprocess.PIPE).communicate()[0].split(" ")
+  if len(fields) != 3:
+    raise Exception("Unexpected control fields in %s" % archive_path)
+  return key(*fields)
+
+
+def _read_entries(archive_path):
+  """Reads the size and md5sum of every regular file in a package archive."""
+  entries = {}
+  with open(os.devnull) as devnull:
+    process = subprocess.Popen(["dpkg-deb", "--fsys-tarfile", archive_path],
+                               stdin = devnull, stdout = subprocess.PIPE)
+    try:
+      # Stream the tar file so that the archive is only read once.
+      tar = tarfile.open(fileobj = process.stdout, mode = "r|")
+      for member in tar:
+        if not member.isfile():
+          continue
+        h = hashlib.md5()
+        f = tar.extractfile(member)
+        while True:
+          data = f.read(_READ_SIZE)
+          if not data:
+            break
+          h.update(data)
+        # Member names are relative to the root, like "./usr/bin/foo".
+        path = os.path.normpath("/" + member.name)
+        entries[path] = (member.size, h.hexdigest())
+    finally:
+      process.stdout.close()
+      if process.wait() != 0:
+        raise Exception("dpkg-deb failed to read %s" % archive_path)
+  return entries
+
+
+def record_archive(manifest_dir, archive_path):
+  """Records the manifest of a package archive, unless it is already known."""
+  try:
+    manifest_key = _archive_key(archive_path)
+    manifest_path = os.path.join(manifest_dir, manifest_key)
+    if os.path.exists(manifest_path):
+      return
+    entries = _read_entries(archive_path)
+    # Write it atomically so that an interrupted run never leaves a partial
+    # manifest behind.
+    tmp_path = "%s.tmp%d" % (manifest_path, os.getpid())
+    with open(tmp_path, "w") as f:
+      for (path, (size, md5sum)) in sorted(entries.iteritems()):
+        f.write("%d %s %s\n" % (size, md5sum, path))
+    os.rename(tmp_path, manifest_path)
+  except Exception, e:
+    # It's only an optimization for future runs.
+    print >> sys.stderr, "Failed to record manifest of %s: %s: %s" % (
+        archive_path, type(e), e)
+
+
+class ManifestStore:
+  """Read access to the recorded manifests."""
+
+  def __init__(self, manifest_dir):
+    self.__manifest_dir = manifest_dir
+    self.__manifests = {}
+
+  def __load(self, manifest_key):
+    entries = {}
+    try:
+      f = open(os.path.join(self.__manifest_dir, manifest_key))
+    except IOError:
+      return None
+    with f:
+      for line in f:
+        parts = line.rstrip("\n").split(" ", 2)
+        if len(parts) != 3:
+          print >> sys.stderr, "Invalid line in manifest %s: %s" % (
+              manifest_key, line)
+          continue
+        entries[parts[2]] = (int(parts[0]), parts[1])
+    return entries
+
+  def lookup(self, manifest_key, path):
+    """Gets the (size, md5sum) of a path in a package version, or None if the
+       package version or the path is not known."""
+    if not manifest_key:
+      return None
+    if manifest_key not in self.__manifests:
+      self.__manifests[manifest_key] = self.__load(manifest_key)
+    entries = self.__manifests[manifest_key]
+    if not entries:
+      return None
+    return entries.get(path)
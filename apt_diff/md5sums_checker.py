@@ -17,23 +17,70 @@
 
 """Python implementation of "md5sum --quiet -c"."""
 
+import collections
 import hashlib
 import mmap
 import os
+import select
 import stat
 import sys
+import time
+
+from apt_diff import checkpoint
+from apt_diff import findings
+from apt_diff import io_helper
+from apt_diff import root_helper
+from apt_diff import stats
+from apt_diff import trace
 
 _READ_SIZE = 4096 * 16
+# How much of each upcoming file to ask the kernel to read ahead.
+_PREFETCH_SIZE = 1024 * 1024
+
+def format_job(pkgname, md5sum, st, expected_size, filename):
+  """Formats an input line for this stage.
+
+  The expected_size is the size of the file in its package, or None if it is
+  not known.
+  """
+  # The device and inode are passed along so that the jobs can be scheduled
+  # according to where the files are.
+  if expected_size is None:
+    expected_size = -1
+  return "%s %s %d %d %d %s\n" % (pkgname, md5sum, st.st_dev, st.st_ino,
+                                   expected_size, filename)
+
+def parse_job(line):
+  """Parses an input line for this stage.
+
+  Returns a tuple of the package name, md5sum, device, inode, expected size
+  (or None) and filename, or None if the line is invalid.
+  """
+  parts = line.rstrip("\n").split(" ", 5)
+  if len(parts) != 6:
+    return None
+  try:
+    expected_size = int(parts[4])
+    if expected_size < 0:
+      expected_size = None
+    return (parts[0], parts[1], int(parts[2]), int(parts[3]), expected_size,
+            parts[5])
+  except ValueError:
+    return None
 
 def _compute_md5_by_syscalls(filename):
   with open(filename, "rb") as f:
     h = hashlib.md5()
+    size = 0
     while True:
       data = f.read(_READ_SIZE)
       if not data:
         break
+      io_helper.consume(len(data))
       h.update(data)
-    return h.hexdigest()
+      size = size + len(data)
+    io_helper.done_reading(f.fileno())
+    return (h.hexdigest(), size)
 
 def _compute_md5_by_mmap(filename):
   fileno = os.open(filename, os.O_RDONLY)
@@ -47,11 +94,16 @@ def _compute_md5_by_mmap(filename):
         h.update(mapping)
       finally:
         mapping.close()
-    return h.hexdigest()
+    io_helper.done_reading(fileno)
+    return (h.hexdigest(), size)
   finally:
     os.close(fileno)
 
 def _compute_md5(filename):
+  """Computes the md5sum of a file. Returns it and the number of bytes read."""
+  if io_helper.is_rate_limited():
+    # Read in chunks so that the rate limit can be applied as we go.
+    return _compute_md5_by_syscalls(filename)
   try:
     return _compute_md5_by_mmap(filename)
   except:
@@ -59,25 +111,125 @@ def _compute_md5(filename):
     # files on 32-bit machines).
     return _compute_md5_by_syscalls(filename)
 
-def _verify_md5(filename, expected_md5):
-  actual_md5 = _compute_md5(filename)
-  return actual_md5 == expected_md5
-
-def run(input_files, output_file):
-  """Run this pipeline element."""
-  for line in input_files[0]:
-    line = line.rstrip('\n')
-    parts = line.split(' ', 2)
-    if len(parts) != 3:
-      print >> sys.stderr, "Invalid input line to md5sum stage: " + line
-      continue
-    pkgname = parts[0]
-    expected_md5 = parts[1]
-    filename = parts[2]
+def verify_md5(filename, expected_md5, expected_size):
+  """Checks a file. Returns whether it matched and the number of bytes read."""
+  if expected_size is not None and os.stat(filename).st_size != expected_size:
+    # Certainly modified, so don't bother reading it.
+    return (False, 0)
+  (actual_md5, size) = _compute_md5(filename)
+  return (actual_md5 == expected_md5, size)
+
+def _read_lines(input_file, lookahead):
+  """Yields each input line along with up to lookahead of the lines after it
+     that have already arrived."""
+  fileno = input_file.fileno()
+  pending = collections.deque()
+  partial = ""
+  eof = False
+  while True:
+    # Block for more input only if there is nothing else to do.
+    while not eof and (not pending or
+                       select.select([fileno], [], [], 0)[0]):
+      data = os.read(fileno, _READ_SIZE)
+      if not data:
+        eof = True
+        if partial:
+          pending.append(partial)
+        break
+      lines = (partial + data).split("\n")
+      partial = lines.pop()
+      pending.extend(lines)
+      if len(pending) > lookahead:
+        break
+    if not pending:
+      return
+    line = pending.popleft()
+    upcoming = []
+    for i in xrange(min(lookahead, len(pending))):
+      upcoming.append(pending[i])
+    yield (line, upcoming)
+
+def _prefetch(resolver, filename):
+  try:
+    fileno = os.open(resolver.host_path(filename), os.O_RDONLY | os.O_NONBLOCK)
+  except OSError:
+    return
+  try:
+    io_helper.advise(fileno, io_helper.POSIX_FADV_WILLNEED, _PREFETCH_SIZE)
+  finally:
+    os.close(fileno)
+
+def create(checkpoint_dir, prefetch=0, root=""):
+  """Creates a processing pipeline function for checking md5sums of the files
+     of the system installed at root.
+
+  If prefetch is non-zero, the kernel is asked to start reading that many of
+  the upcoming files while the current one is hashed.
+  """
+  def run(input_files, output_file):
+    """Run this pipeline element.
+
+    Writes one line for every input line: either the package and filename of
+    a file that failed its check, or a blank line.
+    """
+    trace.set_process_name("md5sum worker")
+    resolver = root_helper.Resolver(root)
+    journal = checkpoint.Journal(checkpoint_dir, checkpoint.MD5SUMS_JOURNAL)
+    prefetched = set()
+    totals = {"files": 0, "bytes": 0, "seconds": 0.0}
+    # The bytes and seconds spent hashing for each package.
+    packages = {}
     try:
-      if not _verify_md5(filename, expected_md5):
-        output_file.write("%s %s\n" % (pkgname, filename))
+      for (line, upcoming) in _read_lines(input_files[0], prefetch):
+        job = parse_job(line)
+        if not job:
+          print >> sys.stderr, "Invalid input line to md5sum stage: " + line
+          output_file.write("\n")
+          output_file.flush()
+          continue
+        (pkgname, expected_md5, _, _, expected_size, filename) = job
+        prefetched.discard(filename)
+        for upcoming_line in upcoming:
+          upcoming_job = parse_job(upcoming_line)
+          if upcoming_job and upcoming_job[5] not in prefetched:
+            prefetched.add(upcoming_job[5])
+            _prefetch(resolver, upcoming_job[5])
+        start = time.time()
+        try:
+          (ok, size) = verify_md5(resolver.host_path(filename), expected_md5,
+                                  expected_size)
+        except Exception, e:
+          message = "Failed to compute md5sum for %s: %s: %s" % (
+              filename, type(e), e)
+          ok = None
+          size = 0
+        elapsed = time.time() - start
+        totals["files"] = totals["files"] + 1
+        totals["bytes"] = totals["bytes"] + size
+        totals["seconds"] = totals["seconds"] + elapsed
+        if stats.is_enabled():
+          cost = packages.setdefault(pkgname, [0, 0.0])
+          cost[0] = cost[0] + size
+          cost[1] = cost[1] + elapsed
+        trace.complete("hash", start, path=filename, package=pkgname)
+        if ok is not None:
+          # Journal the verdict before passing it on so that a resumed run
+          # never loses a mismatch.
+          journal.record_md5sum(expected_md5, filename, ok)
+        if ok is False:
+          output_file.write("%s %s\n" % (pkgname, filename))
+        elif ok is None:
+          # Let the later stages know so that it gets counted as an error.
+          output_file.write(findings.encode(findings.record(
+              findings.ERROR, message, path=filename, packages=[pkgname])))
+        else:
+          output_file.write("\n")
         output_file.flush()
-    except Exception, e:
-      print >> sys.stderr, "Failed to compute md5sum for %s: %s: %s" % (
-          filename, type(e), e)
+    finally:
+      journal.close()
+    if stats.is_enabled():
+      # Every job has been answered by now, so the distributor won't mistake
+      # this for an answer.
+      totals["packages"] = packages
+      output_file.write(stats.encode(stats.MD5SUM, totals))
+  return run
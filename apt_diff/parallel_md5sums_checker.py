@@ -20,15 +20,98 @@ across different processes."""
 
 import os
 
+from apt_diff import device_helper
 from apt_diff import distributor
+from apt_diff import findings
 from apt_diff import launch_helper
 from apt_diff import md5sums_checker
+from apt_diff import trace
 
-def _spawner():
-  (in_read, in_write) = os.pipe()
-  out_read = launch_helper.launch(md5sums_checker.run, [in_read], [in_write])
-  return (os.fdopen(in_write, "w"), os.fdopen(out_read, "r"))
+# How many upcoming files each worker asks the kernel to start reading when
+# reads are ordered.
+_PREFETCH_FILES = 8
+# How many jobs may be waiting for a worker before we stop taking more, which
+# holds up the traversal rather than letting it queue the whole system.
+_MAX_QUEUED_JOBS = 100000
 
-def run(input_files, output_file):
-  """Run this pipeline element."""
-  distributor.run(input_files[0], output_file, _spawner)
+def _device(line):
+  job = md5sums_checker.parse_job(line)
+  if not job:
+    return None
+  return job[2]
+
+def _on_timeout(line):
+  job = md5sums_checker.parse_job(line)
+  if not job:
+    return None
+  filename = job[5]
+  message = "Timed out computing md5sum for %s" % filename
+  # Let the later stages know so that it gets counted as an error.
+  return findings.encode(findings.record(findings.ERROR, message,
+                                         path=filename))
+
+def create(checkpoint_dir, jobs, timeout, ordered, root=""):
+  """Creates a processing pipeline function for checking md5sums in parallel.
+
+  Files on each device are checked by a separate pool of processes so that
+  slow storage doesn't hold up the rest. Each pool is limited to jobs
+  processes, or if jobs is None, to a number that suits the kind of storage.
+  A worker that takes longer than timeout seconds (if not None) on one file is
+  killed and replaced.
+
+  If ordered is True, the files on each device are read in the order that
+  they are laid out on it (as far as we can tell) rather than in traversal
+  order, and each worker prefetches the files after the one it is reading.
+
+  The files are those of the system installed at root.
+  """
+  if ordered:
+    prefetch = _PREFETCH_FILES
+  else:
+    prefetch = 0
+
+  def spawner():
+    (in_read, in_write) = os.pipe()
+    (out_read, pid) = launch_helper.launch(
+        md5sums_checker.create(checkpoint_dir, prefetch, root), [in_read],
+        [in_write])
+    return (os.fdopen(in_write, "w"), os.fdopen(out_read, "r"), pid)
+
+  def run(input_files, output_file):
+    """Run this pipeline element."""
+    trace.set_process_name("md5sum distributor")
+    mount_table = device_helper.MountTable()
+
+    def max_processes(dev):
+      if jobs:
+        return jobs
+      mount = mount_table.lookup_dev(int(dev))
+      if not mount:
+        return distributor.DEFAULT_MAX_PROCESSES
+      return mount.suggested_workers()
+
+    def disk_order(line):
+      job = md5sums_checker.parse_job(line)
+      if not job:
+        return None
+      (_, _, dev, ino, _, filename) = job
+      mount = mount_table.lookup_dev(dev)
+      offset = None
+      if mount and mount.kind == device_helper.HDD:
+        # Only worth the extra syscalls where seeks are expensive. Elsewhere,
+        # inode order is a good enough approximation.
+        offset = device_helper.physical_offset(filename)
+      return (dev, offset, ino)
+
+    if ordered:
+      sort_key_function = disk_order
+    else:
+      sort_key_function = None
+    distributor.run(input_files[0], output_file, spawner,
+                    key_function=_device,
+                    max_processes_function=max_processes,
+                    timeout=timeout,
+                    timeout_function=_on_timeout,
+                    sort_key_function=sort_key_function,
+                    max_queued=_MAX_QUEUED_JOBS)
+  return run
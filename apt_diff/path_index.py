@@ -0,0 +1,394 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""An index of the paths in a dpkg database, kept on disk between runs so that
+checks of a few paths or packages don't need to read the info files, and so
+that any process can look up the packages and md5sums of a path.
+
+The index is a directory with:
+- records: what the .list and .md5sums files of every package say about each
+  path, in a binary file that is mapped into memory to be searched (see
+  MappedIndex).
+- changes: the same for the packages that changed since the records file was
+  written, which replace whatever the records file says about them. Once
+  these are a sizeable part of the records, they are merged into a new
+  records file.
+- conffiles: the Conffiles field of every package in the status file.
+- snapshot: the dpkg_helper.info_snapshot() that the index is up to date
+  with.
+Each is replaced atomically, the records before the changes and the snapshot
+last, so an interrupted update is redone by the next one.
+
+A records file has a header, the names of the packages, a fixed-width record
+for each path of each package, and the paths that the records point to. The
+records are sorted by path and then package, so a path and its subpaths are a
+range of them that can be found by binary search. The names in a changes file
+are those of every package that it replaces, including those that are gone.
+"""
+
+import heapq
+import json
+import mmap
+import os
+import struct
+import tempfile
+import urllib
+
+from apt_diff import dpkg_helper
+
+_RECORDS_FILE = "records"
+_CHANGES_FILE = "changes"
+_CONFFILES_FILE = "conffiles"
+_SNAPSHOT_FILE = "snapshot"
+_SEPARATOR = "\0"
+_MAGIC = "apt-diff index 1\n"
+# The magic, the number of packages, the size of their names, the number of
+# records and the size of the paths.
+_HEADER = struct.Struct("<%dsIIII" % len(_MAGIC))
+# The offset of the path, the package's number, the flags and the md5sum (as
+# the hex digits in the .md5sums file, padded with NULs).
+_RECORD = struct.Struct("<IIB32s")
+# Flags of a record.
+_LISTED = 1
+_HAS_MD5SUM = 2
+# The records file is rewritten once the changes have this many records for
+# every one in it.
+_MAX_CHANGES_RATIO = 0.125
+
+def _replace(path, lines):
+  """Atomically replaces the file at path with the given lines."""
+  (fileno, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+  try:
+    with os.fdopen(fileno, "w") as f:
+      f.writelines(lines)
+    os.rename(tmp_path, path)
+  except:
+    os.remove(tmp_path)
+    raise
+
+def _package_entries(info_dir, pkgname):
+  """Gets the paths in the info files of a package, mapped to whether they are
+     in the .list file and their md5sum, if any."""
+  entries = {}
+  path = os.path.join(info_dir, pkgname + ".list")
+  if os.path.exists(path):
+    for normpath in dpkg_helper.read_list(path):
+      entries[normpath] = (True, None)
+  path = os.path.join(info_dir, pkgname + ".md5sums")
+  if os.path.exists(path):
+    for (normpath, md5sum) in dpkg_helper.read_md5sums(path):
+      entries[normpath] = (entries.get(normpath, (False, None))[0], md5sum)
+  return entries
+
+def _merge(old_entries, changed, info_dir):
+  """Yields the entries of the records file with the packages in changed
+     reread from their info files, in order."""
+  new_entries = []
+  for pkgname in changed:
+    for (normpath, (listed, md5sum)) in _package_entries(info_dir,
+                                                         pkgname).iteritems():
+      new_entries.append((normpath, pkgname, listed, md5sum))
+  new_entries.sort()
+  i = 0
+  for entry in old_entries:
+    if entry[1] in changed:
+      continue
+    while i < len(new_entries) and new_entries[i][:2] < entry[:2]:
+      yield new_entries[i]
+      i = i + 1
+    yield entry
+  for entry in new_entries[i:]:
+    yield entry
+
+def _format(entries, packages=()):
+  """Gets the content of a records file with the given entries, in order, and
+     the names of the given packages too."""
+  entries = list(entries)
+  packages = sorted(set([pkgname for (_, pkgname, _, _) in entries]) |
+                    set(packages))
+  package_ids = dict([(pkgname, i) for (i, pkgname) in enumerate(packages)])
+  records = []
+  paths = []
+  paths_size = 0
+  last_path = None
+  for (normpath, pkgname, listed, md5sum) in entries:
+    if normpath != last_path:
+      offset = paths_size
+      paths.append(normpath + _SEPARATOR)
+      paths_size = paths_size + len(normpath) + 1
+      last_path = normpath
+    flags = 0
+    if listed:
+      flags = flags | _LISTED
+    if md5sum is not None:
+      flags = flags | _HAS_MD5SUM
+    records.append(_RECORD.pack(offset, package_ids[pkgname], flags,
+                                md5sum or ""))
+  names = "".join([pkgname + _SEPARATOR for pkgname in packages])
+  return ([_HEADER.pack(_MAGIC, len(packages), len(names), len(records),
+                        paths_size), names] + records + paths)
+
+class PathIndex:
+  """The index of a dpkg database, kept under index_dir."""
+
+  def __init__(self, index_dir, admin_dir=dpkg_helper.DPKG_ADMIN_DIR):
+    # Each database has its own index, such as for each root.
+    self.__dir = os.path.join(index_dir, urllib.quote(admin_dir, ""))
+    self.__admin_dir = admin_dir
+    self.__info_dir = os.path.join(admin_dir, "info")
+
+  def __path(self, name):
+    return os.path.join(self.__dir, name)
+
+  def update(self):
+    """Brings the index up to date with the database, reading only the info
+       files that changed since the last update. Returns the number of
+       packages that were reread."""
+    if not os.path.isdir(self.__dir):
+      os.makedirs(self.__dir, 0755)
+    snapshot = dpkg_helper.info_snapshot(self.__admin_dir)
+    try:
+      with open(self.__path(_SNAPSHOT_FILE)) as f:
+        old_snapshot = dict([(filename, tuple(version)) for (filename, version)
+                             in json.load(f).iteritems()])
+    except (IOError, ValueError):
+      # No index yet, or one that we can't trust.
+      old_snapshot = {}
+    if old_snapshot:
+      try:
+        old_index = self.open()
+      except (IOError, ValueError):
+        old_snapshot = {}
+    (changed, status_changed) = dpkg_helper.snapshot_changes(old_snapshot,
+                                                             snapshot)
+    if not old_snapshot:
+      # Rebuild from scratch, including the conffiles.
+      status_changed = True
+      old_index = None
+    try:
+      if not old_index:
+        self.__rewrite([], changed)
+      elif changed:
+        # Only the changes are rewritten, unless they have grown too large.
+        replaced = old_index.replaced_packages() | changed
+        changes = list(_merge(old_index.changes(), changed, self.__info_dir))
+        if len(changes) > old_index.record_count() * _MAX_CHANGES_RATIO:
+          self.__rewrite(old_index.scan("/"), changed)
+        else:
+          _replace(self.__path(_CHANGES_FILE), _format(changes, replaced))
+    finally:
+      if old_index:
+        old_index.close()
+    if status_changed:
+      _replace(self.__path(_CONFFILES_FILE),
+               [_SEPARATOR.join([package, normpath, md5sum,
+                                 str(int(obsolete))]) + "\n"
+                for (package, normpath, md5sum, obsolete)
+                in dpkg_helper.read_conffiles(self.__admin_dir)])
+    if changed or status_changed:
+      _replace(self.__path(_SNAPSHOT_FILE), [json.dumps(snapshot)])
+    return len(changed)
+
+  def __rewrite(self, old_entries, changed):
+    """Writes the records file with the packages in changed reread, and no
+       changes."""
+    _replace(self.__path(_RECORDS_FILE),
+             _format(_merge(old_entries, changed, self.__info_dir)))
+    _replace(self.__path(_CHANGES_FILE), _format([]))
+
+  def path(self):
+    """Gets the directory of the index, for MappedIndex."""
+    return self.__dir
+
+  def records_path(self):
+    """Gets the path of the records file."""
+    return self.__path(_RECORDS_FILE)
+
+  def open(self):
+    """Maps the records of the index into memory. Returns a MappedIndex."""
+    return MappedIndex(self.__dir)
+
+  def owners(self, paths):
+    """Gets the set of packages that own any of the given paths or their
+       subpaths."""
+    packages = set()
+    index = self.open()
+    try:
+      for path in paths:
+        for (_, pkgname, _, _) in index.scan(path):
+          packages.add(pkgname)
+    finally:
+      index.close()
+    return packages
+
+  def conffiles(self):
+    """Yields the conffiles in the status file, like
+       dpkg_helper.read_conffiles()."""
+    with open(self.__path(_CONFFILES_FILE)) as f:
+      for line in f:
+        (package, normpath, md5sum, obsolete) = line.rstrip("\n").split(
+            _SEPARATOR)
+        yield (package, normpath, md5sum, obsolete == "1")
+
+class _MappedRecords:
+  """A records file, mapped read-only into memory.
+
+  The mapping is shared, so every process that opens the same records file
+  uses the same pages, and it stays valid when the index is updated, since
+  updates replace the file rather than rewriting it.
+  """
+
+  def __init__(self, records_path):
+    with open(records_path, "rb") as f:
+      self.__mapping = mmap.mmap(f.fileno(), 0, mmap.MAP_SHARED,
+                                 mmap.PROT_READ)
+    try:
+      if len(self.__mapping) < _HEADER.size:
+        raise ValueError("Truncated index %s" % records_path)
+      (magic, package_count, names_size, self.__count,
+       paths_size) = _HEADER.unpack_from(self.__mapping)
+      self.__records_offset = _HEADER.size + names_size
+      self.__paths_offset = (self.__records_offset +
+                             self.__count * _RECORD.size)
+      if (magic != _MAGIC or
+          len(self.__mapping) != self.__paths_offset + paths_size):
+        raise ValueError("Invalid index %s" % records_path)
+      self.__packages = self.__mapping[_HEADER.size:
+                                       self.__records_offset].split(
+                                           _SEPARATOR)[:package_count]
+    except:
+      self.__mapping.close()
+      raise
+
+  def close(self):
+    self.__mapping.close()
+
+  def packages(self):
+    """Gets the names of the packages in the header."""
+    return self.__packages
+
+  def record_count(self):
+    return self.__count
+
+  def __record(self, i):
+    return _RECORD.unpack_from(self.__mapping,
+                               self.__records_offset + i * _RECORD.size)
+
+  def __path_at(self, offset):
+    start = self.__paths_offset + offset
+    return self.__mapping[start:self.__mapping.find(_SEPARATOR, start)]
+
+  def __search(self, path):
+    """Finds the first record whose path is not less than path."""
+    low = 0
+    high = self.__count
+    while low < high:
+      middle = (low + high) // 2
+      if self.__path_at(self.__record(middle)[0]) < path:
+        low = middle + 1
+      else:
+        high = middle
+    return low
+
+  def __entries(self, low, high):
+    """Yields the entries of the records whose paths are in [low, high)."""
+    i = self.__search(low)
+    last_offset = None
+    while i < self.__count:
+      (offset, package_id, flags, md5sum) = self.__record(i)
+      if offset != last_offset:
+        normpath = self.__path_at(offset)
+        if normpath >= high:
+          break
+        last_offset = offset
+      if flags & _HAS_MD5SUM:
+        md5sum = md5sum.rstrip(_SEPARATOR)
+      else:
+        md5sum = None
+      yield (normpath, self.__packages[package_id], bool(flags & _LISTED),
+             md5sum)
+      i = i + 1
+
+  def lookup(self, normpath):
+    """Gets the packages that have a path in their info files, as a list of
+       the package name, whether the path is in its .list file and its md5sum
+       (or None)."""
+    return [(pkgname, listed, md5sum) for (_, pkgname, listed, md5sum)
+            in self.__entries(normpath, normpath + _SEPARATOR)]
+
+  def scan(self, normpath):
+    """Yields the path, package name, whether it is listed and md5sum of every
+       record for a path and its subpaths, in order."""
+    # The path itself, then its subpaths, which sort between path + "/" and
+    # path + "0" (the next character after "/").
+    prefix = normpath.rstrip("/") + "/"
+    if prefix != normpath:
+      for entry in self.__entries(normpath, normpath + _SEPARATOR):
+        yield entry
+    for entry in self.__entries(prefix, prefix[:-1] + "0"):
+      yield entry
+
+class MappedIndex:
+  """The records of a PathIndex, mapped read-only into memory, with those of
+     the packages that changed since the records file was written taking the
+     place of theirs."""
+
+  def __init__(self, index_path):
+    self.__records = _MappedRecords(os.path.join(index_path, _RECORDS_FILE))
+    try:
+      self.__changes = _MappedRecords(os.path.join(index_path, _CHANGES_FILE))
+    except:
+      self.__records.close()
+      raise
+    self.__replaced = set(self.__changes.packages())
+
+  def close(self):
+    self.__records.close()
+    self.__changes.close()
+
+  def record_count(self):
+    """Gets the number of records in the records file."""
+    return self.__records.record_count()
+
+  def replaced_packages(self):
+    """Gets the set of packages that the changes replace."""
+    return self.__replaced
+
+  def changes(self):
+    """Yields the path, package name, whether it is listed and md5sum of every
+       record in the changes, in order."""
+    return self.__changes.scan("/")
+
+  def lookup(self, normpath):
+    """Gets the packages that have a path in their info files, as a list of
+       the package name, whether the path is in its .list file and its md5sum
+       (or None)."""
+    result = [entry for entry in self.__records.lookup(normpath)
+              if entry[0] not in self.__replaced]
+    changes = self.__changes.lookup(normpath)
+    if changes:
+      result = sorted(result + changes)
+    return result
+
+  def scan(self, normpath):
+    """Yields the path, package name, whether it is listed and md5sum of every
+       record for a path and its subpaths, in order."""
+    records = self.__records.scan(normpath)
+    if self.__replaced:
+      records = (entry for entry in records
+                 if entry[1] not in self.__replaced)
+    return heapq.merge(records, self.__changes.scan(normpath))
@@ -0,0 +1,159 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Routines for wiring up processing pipelines.
+
+A pipeline is a graph of stages, each of which runs in its own process,
+reading lines from its inputs and writing lines to its output. The stages'
+inputs are fed either by other stages or by us. The pipeline creates the
+pipes between them, makes sure that every process holds only its own ends of
+them (so that the end of each input is seen), and can take the whole
+pipeline down if it is cancelled.
+"""
+
+import errno
+import os
+import signal
+
+from apt_diff import launch_helper
+
+class Stage:
+  """A stage of a pipeline.
+
+  The stage runs function, or if that is None, the function returned by
+  factory(*args), which is launched as by launch_helper.launch_stage(). The
+  function is called with a list of the given number of input files and the
+  output file.
+  """
+
+  def __init__(self, name, function=None, factory=None, args=(), inputs=1):
+    self.name = name
+    self.function = function
+    self.factory = factory
+    self.args = args
+    self.inputs = inputs
+    # Set once the stage is running.
+    self.pid = None
+
+class Pipeline:
+  """A graph of stages that is started and stopped as a whole.
+
+  Stages must be added after the stages that feed them.
+  """
+
+  def __init__(self):
+    self.__stages = []
+    # The stage that feeds each (stage, input index), or None if we do.
+    self.__sources = {}
+    # The stages whose output is read by us.
+    self.__read_by_us = set()
+    # Our ends of the pipes, once started.
+    self.__input_files = {}
+    self.__output_files = {}
+
+  def add(self, stage):
+    """Adds a stage. Returns it."""
+    self.__stages.append(stage)
+    return stage
+
+  def connect(self, source, destination, index=0):
+    """Feeds the output of the source stage to an input of the destination."""
+    if self.__stages.index(source) >= self.__stages.index(destination):
+      raise ValueError("Stage %s must be added before stage %s" % (
+          source.name, destination.name))
+    self.__sources[(destination, index)] = source
+
+  def feed(self, destination, index=0):
+    """Arranges for an input of the destination stage to be fed by us."""
+    self.__sources[(destination, index)] = None
+
+  def read(self, source):
+    """Arranges for the output of the source stage to be read by us."""
+    self.__read_by_us.add(source)
+
+  def start(self):
+    """Launches every stage."""
+    consumed = set(self.__read_by_us)
+    for source in self.__sources.itervalues():
+      consumed.add(source)
+    # Our ends of the pipes to the inputs fed by us, which no stage may keep.
+    our_write_ends = []
+    # The read ends of the outputs of the stages launched so far that are yet
+    # to be given to the stages that they feed.
+    pending_outputs = {}
+    for stage in self.__stages:
+      if stage not in consumed:
+        raise ValueError("Nothing reads the output of stage %s" % stage.name)
+      input_read_handles = []
+      for index in xrange(stage.inputs):
+        if (stage, index) not in self.__sources:
+          raise ValueError("Nothing feeds input %d of stage %s" % (
+              index, stage.name))
+        source = self.__sources[(stage, index)]
+        if source:
+          input_read_handles.append(pending_outputs.pop(source))
+        else:
+          (in_read, in_write) = os.pipe()
+          input_read_handles.append(in_read)
+          our_write_ends.append(in_write)
+          self.__input_files[(stage, index)] = in_write
+      (out_read, stage.pid) = self.__launch(stage, input_read_handles,
+                                            our_write_ends)
+      if stage in self.__read_by_us:
+        self.__output_files[stage] = os.fdopen(out_read, "r")
+      else:
+        pending_outputs[stage] = out_read
+    for (key, fileno) in self.__input_files.items():
+      self.__input_files[key] = os.fdopen(fileno, "w")
+
+  def __launch(self, stage, input_read_handles, close_in_child):
+    if stage.function:
+      return launch_helper.launch(stage.function, input_read_handles,
+                                  close_in_child)
+    return launch_helper.launch_stage(stage.factory, stage.args,
+                                      input_read_handles, close_in_child)
+
+  def input_file(self, stage, index=0):
+    """Gets the file to write to an input of a stage that is fed by us."""
+    return self.__input_files[(stage, index)]
+
+  def output_file(self, stage):
+    """Gets the file to read the output of a stage that is read by us."""
+    return self.__output_files[stage]
+
+  def cancel(self):
+    """Kills every stage. Their own children exit when their input ends."""
+    for stage in self.__stages:
+      if stage.pid:
+        try:
+          os.kill(stage.pid, signal.SIGTERM)
+        except OSError:
+          # Already gone.
+          pass
+
+  def wait(self):
+    """Waits for the stages that are our children to exit."""
+    for stage in self.__stages:
+      if not stage.pid:
+        continue
+      try:
+        os.waitpid(stage.pid, 0)
+      except OSError, e:
+        # Stages launched by the fork server are not our children.
+        if e.errno != errno.ECHILD:
+          raise
+      stage.pid = None
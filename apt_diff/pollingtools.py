@@ -21,6 +21,9 @@ import fcntl
 import os
 import select
 import sys
+import time
+
+from apt_diff import trace
 
 # Max size of data to read from pipes at once
 _READ_SIZE = 4096
@@ -44,9 +47,13 @@ class Poller:
 
   def poll(self, timeout=None):
     """Execute one poll iteration."""
-    for fileno, event in self.__poll.poll(timeout):
+    events = self.__poll.poll(timeout)
+    start_time = time.time()
+    for fileno, event in events:
       # Call handler
       self.__map[fileno](fileno, event)
+    if events:
+      trace.complete("poll wakeup", start_time, events=len(events))
 
   def has_pollers(self):
     """Check if there are any listeners registered."""
@@ -67,6 +74,8 @@ class LineSource:
     self.__consumer_function = consumer_function
     self.__close_function = close_function
     self.__partial_input = ""
+    self.__closed = False
+    self.__paused = False
     _set_non_blocking(self.__fileobj)
     self.__poller.register(self.__fileobj,
                            select.POLLIN,
@@ -76,6 +85,7 @@ class LineSource:
     text = os.read(self.__fileobj.fileno(), _READ_SIZE)
     if not text:
       # fd is ready but returns no data. This means it's EOF.
+      self.__closed = True
       self.__poller.unregister(self.__fileobj)
       self.__fileobj.close()
       # If we have a partial final line, give it to our consumer.
@@ -95,6 +105,34 @@ class LineSource:
       self.__consumer_function(self, self.__partial_input[:last_newline])
       self.__partial_input = self.__partial_input[last_newline:]
 
+  def pause(self):
+    """Stop reading for now, leaving further data queued in the file."""
+    if self.__closed or self.__paused:
+      return
+    self.__paused = True
+    self.__poller.unregister(self.__fileobj)
+
+  def resume(self):
+    """Start reading again after pause()."""
+    if self.__closed or not self.__paused:
+      return
+    self.__paused = False
+    self.__poller.register(self.__fileobj,
+                           select.POLLIN,
+                           self.__on_pollin)
+
+  def close(self):
+    """Stop reading and close the file object, discarding any partial line.
+
+    The close function is not called.
+    """
+    if self.__closed:
+      return
+    self.__closed = True
+    if not self.__paused:
+      self.__poller.unregister(self.__fileobj)
+    self.__fileobj.close()
+
 class LineSink:
   """Event-driven line-oriented write."""
 
@@ -112,6 +150,7 @@ class LineSink:
       # Probably broken pipe. Have to force-close the file. :(
       print >> sys.stderr, "Unable to write to pipe: %s" % e
       self.__closed = True
+      self.__partial_output = ""
       self.__poller.unregister(self.__fileobj)
       self.__fileobj.close()
       return
@@ -139,6 +178,17 @@ class LineSink:
                              select.POLLOUT,
                              self.__on_pollout)
 
+  def abort(self):
+    """Close the file object immediately, discarding any pending data."""
+    if self.has_data_pending():
+      self.__poller.unregister(self.__fileobj)
+      self.__partial_output = ""
+    elif self.__closed:
+      # Already closed.
+      return
+    self.__closed = True
+    self.__fileobj.close()
+
   def close(self):
     """Close the file object asynchronously after all data is written."""
     if self.__closed:
@@ -0,0 +1,116 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Helpers for finding the files of a system installed under a root directory
+on this system, such as a chroot or the filesystem of a container.
+
+Symlinks in the root are followed the way they would be from inside it:
+absolute targets start at the root, and ".." goes no higher than it. Followed
+on this system instead, an absolute symlink would lead to the content of this
+system.
+"""
+
+import errno
+import os
+
+# The most symlinks followed in resolving a path, like the kernel's limit.
+_MAX_SYMLINKS = 40
+
+def _resolve(root, resolved, relpath):
+  """Resolves relpath relative to resolved, a path in root without symlinks
+     ("" for the root itself). Returns the resolved path, or None if there are
+     too many levels of symlinks."""
+  pending = [part for part in relpath.split("/") if part]
+  pending.reverse()
+  links = 0
+  while pending:
+    part = pending.pop()
+    if part == ".":
+      continue
+    if part == "..":
+      resolved = resolved[:resolved.rfind("/") + 1].rstrip("/")
+      continue
+    candidate = resolved + "/" + part
+    try:
+      target = os.readlink(root + candidate)
+    except OSError:
+      # Not a symlink, or not there.
+      resolved = candidate
+      continue
+    links = links + 1
+    if links > _MAX_SYMLINKS:
+      return None
+    if target.startswith("/"):
+      resolved = ""
+    parts = [part for part in target.split("/") if part]
+    parts.reverse()
+    pending.extend(parts)
+  return resolved
+
+def resolve(root, normpath):
+  """Resolves the symlinks in a path of the system installed at root. Returns
+     the resolved path (relative to the root), or None if there are too many
+     levels of symlinks."""
+  resolved = _resolve(root, "", normpath)
+  if resolved is None:
+    return None
+  return resolved or "/"
+
+class Resolver:
+  """Finds the files of the system installed at root on this system.
+
+  The files are named by their paths on this system as if no symlink in the
+  root led out of it: the root followed by their path inside it. With no
+  root, they are used as they are. The directories are resolved once each, so
+  finding a file costs no more than a readlink() of it.
+  """
+
+  def __init__(self, root):
+    self.__root = root
+    # The resolved path of each directory, relative to the root.
+    self.__directories = {"/": ""}
+
+  def __directory(self, normpath):
+    if normpath in self.__directories:
+      return self.__directories[normpath]
+    parent = self.__directory(os.path.dirname(normpath))
+    resolved = None
+    if parent is not None:
+      resolved = _resolve(self.__root, parent, os.path.basename(normpath))
+    self.__directories[normpath] = resolved
+    return resolved
+
+  def host_path(self, filename, follow=True):
+    """Gets the path on this system of a file of the root, following it too
+       if it is a symlink and follow is True.
+
+    Raises OSError if there are too many levels of symlinks.
+    """
+    if not self.__root:
+      return filename
+    normpath = filename[len(self.__root):] or "/"
+    if normpath == "/":
+      return self.__root
+    resolved = self.__directory(os.path.dirname(normpath))
+    if resolved is not None:
+      if follow:
+        resolved = _resolve(self.__root, resolved, os.path.basename(normpath))
+      else:
+        resolved = resolved + "/" + os.path.basename(normpath)
+    if resolved is None:
+      raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), filename)
+    return self.__root + resolved
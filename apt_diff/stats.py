@@ -0,0 +1,224 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Routines for collecting performance statistics from each stage of the
+processing pipeline.
+
+Every process keeps its own statistics and writes them to its output as a
+single line starting with STATS_PREFIX when it is done. The later stages
+pass these lines along, so they all end up in the main process.
+
+Whether statistics are collected is module-level state like the APT options,
+and must be set before the processing pipeline is launched so that every
+forked process shares it.
+"""
+
+import json
+import os
+
+from apt_diff import io_helper
+
+STATS_PREFIX = "#"
+
+# Names of the stages.
+MAIN = "main"
+MD5SUM = "md5sum"
+DISTRIBUTOR = "distributor"
+FETCHER = "fetcher"
+DIFFER = "differ"
+
+_SMAPS_ROLLUP = "/proc/self/smaps_rollup"
+# The fields of smaps_rollup that memory_usage() reports, by the name they are
+# reported under. Private memory is the sum of the fields.
+_MEMORY_FIELDS = {"Rss:": "rss", "Pss:": "pss", "Private_Clean:": "private",
+                  "Private_Dirty:": "private"}
+
+_enabled = False
+
+
+def set_enabled(enabled):
+  """Sets whether statistics are collected."""
+  global _enabled
+  _enabled = enabled
+
+
+def is_enabled():
+  """Checks if statistics are collected."""
+  return _enabled
+
+
+def memory_usage():
+  """Gets the resident, proportional and private memory of this process in
+     bytes, or None if they are not available."""
+  usage = {"rss": 0, "pss": 0, "private": 0}
+  try:
+    with open(_SMAPS_ROLLUP) as f:
+      for line in f:
+        parts = line.split()
+        if parts[0] in _MEMORY_FIELDS:
+          name = _MEMORY_FIELDS[parts[0]]
+          usage[name] = usage[name] + int(parts[1]) * 1024
+  except (IOError, ValueError, IndexError):
+    return None
+  return usage
+
+
+def encode(stage, values):
+  """Encodes the statistics of this process as a line for the pipeline."""
+  values = dict(values)
+  values["stage"] = stage
+  values["pid"] = os.getpid()
+  values["memory"] = memory_usage()
+  return STATS_PREFIX + json.dumps(values, sort_keys=True) + "\n"
+
+
+def is_stats(line):
+  """Checks if a line from the pipeline carries statistics."""
+  return line.startswith(STATS_PREFIX)
+
+
+def decode(line):
+  """Decodes a statistics line, or returns None if it is invalid."""
+  try:
+    values = json.loads(line[len(STATS_PREFIX):])
+  except ValueError:
+    return None
+  if not isinstance(values, dict) or "stage" not in values:
+    return None
+  return values
+
+
+def _format_main(values):
+  syscalls = ", ".join(["%s %d" % (name, count) for (name, count)
+                        in sorted(values["syscalls"].iteritems())])
+  return [
+      "Loaded the dpkg database in %.2f s and the APT cache in %.2f s" % (
+          values["dpkg_seconds"], values["apt_seconds"]),
+      "Traversed %d paths in %.2f s (%s)" % (
+          values["paths"], values["traversal_seconds"], syscalls)]
+
+
+def _format_md5sum(values):
+  return ["md5sum worker %d: checked %d files, %s in %.2f s" % (
+      values["pid"], values["files"], io_helper.format_bytes(values["bytes"]),
+      values["seconds"])]
+
+
+def _format_distributor(values):
+  samples = values["queue_depth"]
+  if not samples:
+    return ["md5sum distributor: no jobs"]
+  depths = [depth for (_, depth, _) in samples]
+  return [
+      "md5sum distributor: queue depth mean %.1f, max %d over %.1f s; "
+      "up to %d workers" % (
+          float(sum(depths)) / len(depths), max(depths), samples[-1][0],
+          max([workers for (_, _, workers) in samples]))]
+
+
+def _format_fetcher(values):
+  latencies = values["latencies"]
+  if not latencies:
+    return ["APT fetcher: no packages fetched"]
+  return [
+      "APT fetcher: fetched %d packages (%d failed), %s; latency mean %.2f s, "
+      "max %.2f s" % (
+          len(latencies), values["failed"],
+          io_helper.format_bytes(values["bytes"]),
+          sum(latencies) / len(latencies), max(latencies))]
+
+
+def _format_differ(values):
+  return [
+      "Differ: extracted %d packages in %.2f s, ran %d diffs in %.2f s" % (
+          values["extracted"], values["extraction_seconds"], values["diffs"],
+          values["diff_seconds"])]
+
+_FORMATTERS = [(MAIN, _format_main),
+               (MD5SUM, _format_md5sum),
+               (DISTRIBUTOR, _format_distributor),
+               (FETCHER, _format_fetcher),
+               (DIFFER, _format_differ)]
+
+
+def package_costs(all_values):
+  """Attributes the costs recorded by all processes to packages.
+
+  Returns a list of dicts, one per package, most expensive first.
+  """
+  costs = {}
+
+  def cost(pkgname):
+    if pkgname not in costs:
+      costs[pkgname] = {"package": pkgname, "hash_bytes": 0,
+                        "hash_seconds": 0.0, "fetch_seconds": 0.0,
+                        "extraction_seconds": 0.0, "diff_seconds": 0.0}
+    return costs[pkgname]
+
+  for values in all_values:
+    packages = values.get("packages", {})
+    if values["stage"] == MD5SUM:
+      for (pkgname, (nbytes, seconds)) in packages.iteritems():
+        cost(pkgname)["hash_bytes"] += nbytes
+        cost(pkgname)["hash_seconds"] += seconds
+    elif values["stage"] == FETCHER:
+      for (pkgname, seconds) in packages.iteritems():
+        cost(pkgname)["fetch_seconds"] += seconds
+    elif values["stage"] == DIFFER:
+      for (pkgname, (extraction_seconds, diff_seconds)) in (
+          packages.iteritems()):
+        cost(pkgname)["extraction_seconds"] += extraction_seconds
+        cost(pkgname)["diff_seconds"] += diff_seconds
+  for c in costs.itervalues():
+    c["total_seconds"] = (c["hash_seconds"] + c["fetch_seconds"] +
+                          c["extraction_seconds"] + c["diff_seconds"])
+  return sorted(costs.values(), key=lambda c: (-c["total_seconds"],
+                                               c["package"]))
+
+
+def format_package_costs(costs):
+  """Formats package costs as a table for humans, as a list of lines."""
+  lines = ["%-32s %8s %10s %8s %8s %8s %8s" % (
+      "Package", "Total s", "Hashed", "Hash s", "Fetch s", "Unpack s",
+      "Diff s")]
+  for c in costs:
+    lines.append("%-32s %8.2f %10s %8.2f %8.2f %8.2f %8.2f" % (
+        c["package"], c["total_seconds"],
+        io_helper.format_bytes(c["hash_bytes"]), c["hash_seconds"],
+        c["fetch_seconds"], c["extraction_seconds"], c["diff_seconds"]))
+  return lines
+
+
+def format_report(all_values):
+  """Formats the statistics of all processes for humans, as a list of lines."""
+  lines = []
+  memory_lines = []
+  for (stage, formatter) in _FORMATTERS:
+    for values in sorted(all_values, key=lambda v: v["pid"]):
+      if values["stage"] == stage:
+        lines.extend(formatter(values))
+        memory = values.get("memory")
+        if memory:
+          memory_lines.append(
+              "%s %d: resident %s, proportional %s, private %s" % (
+                  stage, values["pid"], io_helper.format_bytes(memory["rss"]),
+                  io_helper.format_bytes(memory["pss"]),
+                  io_helper.format_bytes(memory["private"])))
+  if memory_lines:
+    lines.append("Memory at exit:")
+    lines.extend(["    " + line for line in memory_lines])
+  return lines
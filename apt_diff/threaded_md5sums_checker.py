@@ -0,0 +1,190 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""An in-process alternative to the md5sum stage that checks md5sums with
+threads.
+
+hashlib and file reads release the GIL, so threads can keep the disks and
+CPUs busy without forking workers or passing every job through pipes as text.
+"""
+
+import Queue
+import threading
+import time
+
+from apt_diff import checkpoint
+from apt_diff import device_helper
+from apt_diff import distributor
+from apt_diff import findings
+from apt_diff import md5sums_checker
+from apt_diff import root_helper
+from apt_diff import stats
+from apt_diff import trace
+
+# How often stuck threads are looked for while waiting for the checks to
+# finish, in seconds.
+_POLL_SECONDS = 1.0
+
+class ThreadedMd5sumsChecker:
+  """Checks md5sums with a pool of threads for each device.
+
+  The output is the same as that of the md5sum stage of the pipeline: the
+  package and filename of each file that fails its check is written to
+  output_file. Each pool is limited to jobs threads, or if jobs is None, to a
+  number that suits the kind of storage. A thread that takes longer than
+  timeout seconds (if not None) on one file is abandoned and replaced. The
+  files are those of the system installed at root.
+  """
+
+  def __init__(self, checkpoint_dir, jobs, timeout, output_file, root=""):
+    self.__jobs = jobs
+    self.__timeout = timeout
+    self.__output_file = output_file
+    self.__resolver = root_helper.Resolver(root)
+    self.__journal = checkpoint.Journal(checkpoint_dir,
+                                        checkpoint.MD5SUMS_JOURNAL)
+    self.__mount_table = device_helper.MountTable()
+    # Guards everything below, and the output and journal.
+    self.__lock = threading.Lock()
+    # The queue of jobs for each device.
+    self.__queues = {}
+    # The queue that each thread takes its jobs from.
+    self.__threads = {}
+    # The filename that each busy thread is checking and when it started.
+    self.__current = {}
+    # Threads that took too long and whose results are to be dropped.
+    self.__abandoned = set()
+    self.__last_poll = time.time()
+    self.__totals = {"files": 0, "bytes": 0, "seconds": 0.0}
+    # The bytes and seconds spent hashing for each package.
+    self.__packages = {}
+
+  def __pool_size(self, dev):
+    if self.__jobs:
+      return self.__jobs
+    mount = self.__mount_table.lookup_dev(dev)
+    if not mount:
+      return distributor.DEFAULT_MAX_PROCESSES
+    return mount.suggested_workers()
+
+  def __start_thread(self, queue):
+    thread = threading.Thread(target=self.__work, args=(queue,))
+    thread.daemon = True
+    self.__threads[thread] = queue
+    thread.start()
+
+  def __write(self, text):
+    self.__output_file.write(text)
+    self.__output_file.flush()
+
+  def __work(self, queue):
+    me = threading.current_thread()
+    while True:
+      job = queue.get()
+      if not job:
+        return
+      (pkgname, expected_md5, expected_size, filename) = job
+      start = time.time()
+      with self.__lock:
+        self.__current[me] = (filename, start, queue)
+      try:
+        (ok, size) = md5sums_checker.verify_md5(
+            self.__resolver.host_path(filename), expected_md5, expected_size)
+      except Exception, e:
+        message = "Failed to compute md5sum for %s: %s: %s" % (
+            filename, type(e), e)
+        ok = None
+        size = 0
+      elapsed = time.time() - start
+      with self.__lock:
+        del self.__current[me]
+        if me in self.__abandoned:
+          # Already reported, and replaced by another thread.
+          return
+        self.__totals["files"] = self.__totals["files"] + 1
+        self.__totals["bytes"] = self.__totals["bytes"] + size
+        self.__totals["seconds"] = self.__totals["seconds"] + elapsed
+        if stats.is_enabled():
+          cost = self.__packages.setdefault(pkgname, [0, 0.0])
+          cost[0] = cost[0] + size
+          cost[1] = cost[1] + elapsed
+        trace.complete("hash", start, path=filename, package=pkgname)
+        if ok is not None:
+          # Journal the verdict before passing it on so that a resumed run
+          # never loses a mismatch.
+          self.__journal.record_md5sum(expected_md5, filename, ok)
+        if ok is False:
+          self.__write("%s %s\n" % (pkgname, filename))
+        elif ok is None:
+          # Let the later stages know so that it gets counted as an error.
+          self.__write(findings.encode(findings.record(
+              findings.ERROR, message, path=filename, packages=[pkgname])))
+
+  def __abandon_stuck_threads(self):
+    now = time.time()
+    self.__last_poll = now
+    with self.__lock:
+      for (thread, (filename, start, queue)) in self.__current.items():
+        if thread in self.__abandoned or now - start < self.__timeout:
+          continue
+        self.__abandoned.add(thread)
+        message = "Timed out computing md5sum for %s" % filename
+        # Let the later stages know so that it gets counted as an error.
+        self.__write(findings.encode(findings.record(findings.ERROR, message,
+                                                     path=filename)))
+        # The thread can't be killed, but it can be replaced.
+        self.__start_thread(queue)
+
+  def check(self, pkgname, md5sum, st, expected_size, filename):
+    """Queues a check of a file against its md5sum.
+
+    The expected_size is the size of the file in its package, or None if it
+    is not known.
+    """
+    queue = self.__queues.get(st.st_dev)
+    if not queue:
+      queue = Queue.Queue()
+      self.__queues[st.st_dev] = queue
+      for _ in xrange(max(self.__pool_size(st.st_dev), 1)):
+        self.__start_thread(queue)
+    queue.put((pkgname, md5sum, expected_size, filename))
+    if self.__timeout and time.time() - self.__last_poll >= _POLL_SECONDS:
+      self.__abandon_stuck_threads()
+
+  def close(self):
+    """Waits for the queued checks to finish, then closes the output."""
+    with self.__lock:
+      # Tell every thread to exit. Any replacements started later take the
+      # place of the ones they replace.
+      for (thread, queue) in self.__threads.iteritems():
+        if thread not in self.__abandoned:
+          queue.put(None)
+    while True:
+      with self.__lock:
+        threads = [thread for thread in self.__threads
+                   if thread not in self.__abandoned and thread.is_alive()]
+      if not threads:
+        break
+      threads[0].join(_POLL_SECONDS)
+      if self.__timeout:
+        self.__abandon_stuck_threads()
+    self.__journal.close()
+    if stats.is_enabled():
+      totals = dict(self.__totals)
+      totals["packages"] = self.__packages
+      self.__write(stats.encode(stats.MD5SUM, totals))
+    self.__output_file.close()
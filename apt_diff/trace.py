@@ -0,0 +1,127 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Routines for recording a timeline of what every process is doing, in the
+Chrome trace event format (which Perfetto can also read).
+
+Each process appends its events to its own file in the trace directory, so no
+locking is needed, and the main process merges them into one trace at the
+end. The trace directory is module-level state like the APT options, and
+must be set before the processing pipeline is launched so that every forked
+process shares it.
+"""
+
+import json
+import os
+import threading
+import time
+
+# Events are written out in batches of this many.
+_FLUSH_EVENTS = 1000
+
+_trace_dir = None
+# The events of this process that have not been written out yet, and the pid
+# they belong to. After a fork, the child must not write its parent's events.
+_events = []
+_events_pid = None
+# Guards the events against threads that hash files in the main process.
+_lock = threading.Lock()
+
+
+def set_trace_dir(trace_dir):
+  """Enables tracing, with per-process events written to trace_dir."""
+  global _trace_dir
+  _trace_dir = trace_dir
+
+
+def is_enabled():
+  """Checks if tracing is enabled."""
+  return bool(_trace_dir)
+
+
+def _timestamp(t):
+  # Microseconds, as the format expects.
+  return int(t * 1000000)
+
+
+def _add(event):
+  global _events_pid
+  pid = os.getpid()
+  thread = threading.current_thread()
+  event["pid"] = pid
+  if thread.name == "MainThread":
+    event["tid"] = pid
+  else:
+    # Give other threads tracks of their own.
+    event["tid"] = thread.ident
+  with _lock:
+    if _events_pid != pid:
+      # We're a new child, and anything inherited is our parent's to write.
+      del _events[:]
+      _events_pid = pid
+    _events.append(event)
+    full = len(_events) >= _FLUSH_EVENTS
+  if full:
+    flush()
+
+
+def set_process_name(name):
+  """Names the track of this process."""
+  if not _trace_dir:
+    return
+  _add({"name": "process_name", "ph": "M", "args": {"name": name}})
+
+
+def complete(name, start_time, **args):
+  """Records an event that started at start_time and has just finished."""
+  if not _trace_dir:
+    return
+  now = time.time()
+  _add({"name": name, "ph": "X", "ts": _timestamp(start_time),
+        "dur": _timestamp(now - start_time),
+        "args": dict([(key, str(value).decode("utf-8", "replace"))
+                      for (key, value) in args.iteritems()])})
+
+
+def flush():
+  """Writes out the events of this process recorded so far."""
+  with _lock:
+    if not _trace_dir or _events_pid != os.getpid() or not _events:
+      return
+    data = "".join([json.dumps(event) + "\n" for event in _events])
+    del _events[:]
+  fileno = os.open(os.path.join(_trace_dir, str(os.getpid())),
+                   os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+  try:
+    os.write(fileno, data)
+  finally:
+    os.close(fileno)
+
+
+def merge(trace_file):
+  """Merges the events written by all processes into one trace file."""
+  flush()
+  events = []
+  for filename in sorted(os.listdir(_trace_dir)):
+    with open(os.path.join(_trace_dir, filename)) as f:
+      for line in f:
+        if line[-1] != "\n":
+          # Cut off by a process that was killed.
+          continue
+        events.append(json.loads(line))
+  with open(trace_file, "w") as f:
+    json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Benchmark of the md5sum stage with and without --ordered-reads.
+
+Creates a tree of many small files in an order unrelated to their names, so
+that traversal order (by name) differs from the order they were allocated on
+disk, then times checking all of them from a cold page cache in each mode.
+
+Usage: bench_ordered_reads.py [<dir> [<file count> [<file size>]]]
+
+The directory should be on the storage to be measured (ideally a rotational
+disk). Dropping the page cache only works for files we can open, and is best
+done as root.
+"""
+
+import hashlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from apt_diff import checkpoint
+from apt_diff import io_helper
+from apt_diff import launch_helper
+from apt_diff import md5sums_checker
+from apt_diff import parallel_md5sums_checker
+
+_DEFAULT_FILE_COUNT = 20000
+_DEFAULT_FILE_SIZE = 4096
+_FILES_PER_DIR = 500
+
+
+def _create_tree(root, file_count, file_size):
+  """Creates the files and returns a list of (path, md5sum) by name."""
+  rng = random.Random(0)
+  numbers = range(file_count)
+  # Allocate the files in a random order relative to their names.
+  rng.shuffle(numbers)
+  files = []
+  for n in numbers:
+    subdir = os.path.join(root, "d%04d" % (n / _FILES_PER_DIR))
+    if not os.path.isdir(subdir):
+      os.mkdir(subdir)
+    path = os.path.join(subdir, "f%06d" % n)
+    data = os.urandom(file_size)
+    with open(path, "wb") as f:
+      f.write(data)
+    files.append((path, hashlib.md5(data).hexdigest()))
+  os.system("sync")
+  files.sort()
+  return files
+
+
+def _drop_from_cache(files):
+  for (path, _) in files:
+    fileno = os.open(path, os.O_RDONLY)
+    try:
+      io_helper.advise(fileno, io_helper.POSIX_FADV_DONTNEED)
+    finally:
+      os.close(fileno)
+
+
+def _time_check(files, checkpoint_dir, ordered):
+  checkpoint.reset(checkpoint_dir)
+  _drop_from_cache(files)
+  (in_read, in_write) = os.pipe()
+  (out_read, pid) = launch_helper.launch(
+      parallel_md5sums_checker.create(checkpoint_dir, None, None, ordered),
+      [in_read], [in_write])
+  start = time.time()
+  md5sum_in = os.fdopen(in_write, "w")
+  for (path, md5sum) in files:
+    md5sum_in.write(md5sums_checker.format_job("pkg", md5sum, os.lstat(path),
+                                               None, path))
+  md5sum_in.close()
+  mismatches = os.fdopen(out_read, "r").read()
+  elapsed = time.time() - start
+  os.waitpid(pid, 0)
+  if mismatches:
+    raise Exception("Unexpected mismatches:\n" + mismatches)
+  return elapsed
+
+
+def main(args):
+  if args:
+    parent = args[0]
+  else:
+    parent = tempfile.gettempdir()
+  file_count = _DEFAULT_FILE_COUNT
+  if len(args) > 1:
+    file_count = int(args[1])
+  file_size = _DEFAULT_FILE_SIZE
+  if len(args) > 2:
+    file_size = int(args[2])
+  workdir = tempfile.mkdtemp(prefix="apt-diff-bench_", dir=parent)
+  try:
+    tree = os.path.join(workdir, "tree")
+    os.mkdir(tree)
+    print "Creating %d files of %s in %s" % (
+        file_count, io_helper.format_bytes(file_size), tree)
+    files = _create_tree(tree, file_count, file_size)
+    checkpoint_dir = os.path.join(workdir, "checkpoint")
+    for (name, ordered) in (("traversal order", False),
+                            ("ordered reads", True)):
+      elapsed = _time_check(files, checkpoint_dir, ordered)
+      print "%-16s %8.2f s  %10.1f files/s" % (name, elapsed,
+                                               file_count / elapsed)
+  finally:
+    shutil.rmtree(workdir)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,609 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Benchmark suite for apt-diff, run against a synthetic system.
+
+Generates a dpkg database, a filesystem tree and an APT archive source (see
+synthetic.py), times each part of a check, and writes the results to a JSON
+file so that they can be compared across commits. The end-to-end benchmark
+needs python-apt and apt-get; it is skipped if they are not available.
+"""
+
+import getopt
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+_SOURCE_DIR = os.path.dirname(_BENCHMARKS_DIR)
+sys.path.insert(0, _SOURCE_DIR)
+
+from apt_diff import checkpoint
+from apt_diff import differ_process
+from apt_diff import dpkg_helper
+from apt_diff import findings
+from apt_diff import launch_helper
+from apt_diff import md5sums_checker
+from apt_diff import parallel_md5sums_checker
+from apt_diff import path_index
+from apt_diff import stats
+from apt_diff import threaded_md5sums_checker
+
+import synthetic
+
+_USAGE = """
+Usage: run_benchmarks.py [OPTION]...
+
+Options:
+    --packages          <count>    Number of synthetic packages.
+    --files-per-package <count>    Number of files in each package.
+    --file-size         <bytes>    Size of each file.
+    --modified          <fraction> Fraction of files to modify.
+    --missing           <fraction> Fraction of files to remove.
+    --extra             <fraction> Number of extra files to add, as a
+                                   fraction of the packaged files.
+    --repeat            <count>    Run each benchmark <count> times and keep
+                                   the fastest.
+    --only              <names>    Run only the comma-separated benchmarks.
+    --output            <file>     Write the results to <file> (default
+                                   benchmark-results.json).
+    --workdir           <dir>      Generate the system in <dir> and keep it,
+                                   replacing any left by an earlier run.
+    --help                         Show this help."""
+
+# Number of paths given to the PathFilter benchmark's filter.
+_FILTER_PATHS = 100
+# The huge files that the md5sum backends are compared on.
+_HUGE_FILES = 4
+_HUGE_FILE_SIZE = 64 * 1024 * 1024
+# Timeout for the end-to-end run, in seconds.
+_END_TO_END_TIMEOUT = 3600
+
+
+def _best_time(repeat, function):
+  """Runs function repeat times. Returns the shortest time taken and the
+     result of the last run."""
+  best = None
+  result = None
+  for _ in xrange(repeat):
+    start = time.time()
+    result = function()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return (best, result)
+
+
+def _run_stage(function, input_data):
+  """Runs a pipeline stage in a child process on the given input and returns
+     its output."""
+  (in_read, in_write) = os.pipe()
+  (out_read, pid) = launch_helper.launch(function, [in_read], [in_write])
+  output = _feed_stage(in_write, out_read, input_data)
+  os.waitpid(pid, 0)
+  return output
+
+
+def _feed_stage(in_write, out_read, input_data):
+  """Writes the input of a launched stage and returns its output."""
+  # Write from a child so that a full output pipe can't deadlock us.
+  writer_pid = os.fork()
+  if writer_pid == 0:
+    try:
+      os.close(out_read)
+      with os.fdopen(in_write, "w") as f:
+        f.write(input_data)
+    finally:
+      os._exit(0)
+  os.close(in_write)
+  with os.fdopen(out_read, "r") as f:
+    output = f.read()
+  os.waitpid(writer_pid, 0)
+  return output
+
+
+def _quiet(function):
+  """Wraps a pipeline stage so that whatever it prints is discarded."""
+  def run(input_files, output_file):
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    function(input_files, output_file)
+  return run
+
+
+def _stats_lines(output):
+  return [stats.decode(line) for line in output.splitlines()
+          if stats.is_stats(line)]
+
+
+def bench_dpkg_load(system, work_dir, repeat):
+  """Loading the dpkg database for the whole synthetic root."""
+  def load():
+    return dpkg_helper.DpkgHelper(dpkg_helper.PathFilter([system.root]),
+                                  system.admin_dir)
+  (seconds, _) = _best_time(repeat, load)
+  return {"seconds": seconds, "packages": len(system.package_files),
+          "files": len(system.md5sums)}
+
+
+class _TreePathFilter:
+  """The PathFilter from before it was compiled into a sorted list, as a
+     baseline: a tree of the outermost paths' components."""
+
+  def __init__(self, paths):
+    self.__paths = None
+    last = None
+    for p in sorted(paths):
+      if last and p.startswith(last):
+        continue
+      last = p
+      current = self.__paths = self.__paths or {}
+      for component in self.__components(p):
+        current = current.setdefault(component, {})
+
+  def __components(self, p):
+    if p == "/":
+      return []
+    return p.lstrip("/").split("/")
+
+  def includes(self, p):
+    current = self.__paths
+    if current == None:
+      return False
+    for component in self.__components(p):
+      if component not in current:
+        return not current
+      current = current[component]
+    return not current
+
+
+def bench_path_filter(system, work_dir, repeat):
+  """PathFilter lookups of every packaged path against a filter of many
+     directories, one at a time and in a batch, compared with the tree that
+     the filter used to be and with a filter that includes everything."""
+  rng = random.Random(0)
+  paths = sorted(system.md5sums)
+  # The order of .list files, where each directory comes before its contents
+  # but packages are interleaved.
+  rng.shuffle(paths)
+  filter_paths = [os.path.dirname(path) for path in
+                  rng.sample(paths, min(_FILTER_PATHS, len(paths)))]
+  (build_seconds, path_filter) = _best_time(
+      repeat, lambda: dpkg_helper.PathFilter(filter_paths))
+  tree_filter = _TreePathFilter(filter_paths)
+  everything_filter = dpkg_helper.PathFilter(["/"])
+
+  def lookups(path_filter):
+    included = 0
+    for path in paths:
+      if path_filter.includes(path):
+        included = included + 1
+    return included
+  (seconds, included) = _best_time(repeat, lambda: lookups(path_filter))
+  (tree_seconds, tree_included) = _best_time(repeat,
+                                             lambda: lookups(tree_filter))
+  if tree_included != included:
+    raise Exception("The filters disagree: %d paths against %d" %
+                    (included, tree_included))
+  if path_filter.filter(paths) != [p for p in paths if tree_filter.includes(p)]:
+    raise Exception("The filters include different paths")
+  (batch_seconds, _) = _best_time(repeat, lambda: path_filter.filter(paths))
+  (everything_seconds, _) = _best_time(
+      repeat, lambda: [p for p in everything_filter.filter(paths)])
+  lookup_count = max(len(paths), 1)
+  return {"seconds": seconds, "build_seconds": build_seconds,
+          "tree_seconds": tree_seconds, "batch_seconds": batch_seconds,
+          "everything_seconds": everything_seconds,
+          "lookups": len(paths), "included": included,
+          "microseconds_per_lookup": seconds * 1e6 / lookup_count,
+          "tree_microseconds_per_lookup": tree_seconds * 1e6 / lookup_count,
+          "batch_microseconds_per_lookup": batch_seconds * 1e6 / lookup_count}
+
+
+def bench_targeted_load(system, work_dir, repeat):
+  """Loading the dpkg state of a single package, with and without the path
+     index, and looking up every packaged path in the mapped index."""
+  pkgname = system.package_names()[0]
+  paths = dpkg_helper.expand_package_to_leaf_paths(pkgname, system.admin_dir)
+  index = path_index.PathIndex(os.path.join(work_dir, "index"),
+                               system.admin_dir)
+  start = time.time()
+  index.update()
+  build_seconds = time.time() - start
+  (update_seconds, _) = _best_time(repeat, index.update)
+
+  def load(index):
+    return dpkg_helper.DpkgHelper(dpkg_helper.PathFilter(paths),
+                                  system.admin_dir, index=index)
+  (seconds, _) = _best_time(repeat, lambda: load(index))
+  (unindexed_seconds, _) = _best_time(repeat, lambda: load(None))
+  all_paths = sorted(system.md5sums)
+  mapped_index = index.open()
+  try:
+    (lookup_seconds, _) = _best_time(
+        repeat, lambda: [mapped_index.lookup(path) for path in all_paths])
+  finally:
+    mapped_index.close()
+  return {"seconds": seconds, "unindexed_seconds": unindexed_seconds,
+          "index_build_seconds": build_seconds,
+          "index_update_seconds": update_seconds, "paths": len(paths),
+          "index_bytes": os.path.getsize(index.records_path()),
+          "lookup_seconds": lookup_seconds / max(len(all_paths), 1)}
+
+
+def _count_nodes(node):
+  count = 1
+  for child in node.children().itervalues():
+    count = count + _count_nodes(child)
+  return count
+
+
+def bench_sharded_load(system, work_dir, repeat):
+  """Loading the dpkg database for the whole synthetic root in shards, against
+     loading it all at once: the most nodes held at a time, and the total
+     time."""
+  shards = 4
+  path_filter = dpkg_helper.PathFilter([system.root])
+  # The packages' files are only four levels deep under root/, which would
+  # all be in the shard of its ancestor at the shard depth, so shard them as
+  # if root/ were /.
+  depth = dpkg_helper.path_depth(system.root) + dpkg_helper.SHARD_DEPTH - 1
+
+  def load(path_filter):
+    helper = dpkg_helper.DpkgHelper(path_filter, system.admin_dir)
+    return _count_nodes(helper.lookup(system.root))
+
+  def load_shards():
+    return [load(dpkg_helper.ShardFilter(path_filter, shard, shards, depth))
+            for shard in xrange(shards)]
+  (seconds, shard_nodes) = _best_time(repeat, load_shards)
+  (unsharded_seconds, nodes) = _best_time(repeat, lambda: load(path_filter))
+  return {"seconds": seconds, "unsharded_seconds": unsharded_seconds,
+          "shards": shards, "max_shard_nodes": max(shard_nodes),
+          "nodes": nodes}
+
+
+def _md5_jobs(system):
+  jobs = []
+  for (path, md5sum) in sorted(system.md5sums.iteritems()):
+    if os.path.exists(path):
+      jobs.append(md5sums_checker.format_job("pkg", md5sum, os.stat(path),
+                                             None, path))
+  return jobs
+
+
+def bench_md5_pool(system, work_dir, repeat):
+  """Checking every file on disk that has an md5sum with the md5sum pool."""
+  checkpoint_dir = os.path.join(work_dir, "checkpoint")
+  jobs = _md5_jobs(system)
+  input_data = "".join(jobs)
+
+  def check():
+    checkpoint.reset(checkpoint_dir)
+    return _run_stage(parallel_md5sums_checker.create(checkpoint_dir, None,
+                                                      None, False),
+                      input_data)
+  (seconds, output) = _best_time(repeat, check)
+  workers = [values for values in _stats_lines(output)
+             if values["stage"] == stats.MD5SUM]
+  mismatches = [line for line in output.splitlines()
+                if line and not stats.is_stats(line)]
+  return {"seconds": seconds, "files": len(jobs),
+          "bytes": sum([values["bytes"] for values in workers]),
+          "workers": len(workers), "mismatches": len(mismatches)}
+
+
+def bench_extract_diff(system, work_dir, repeat):
+  """Extracting the package of every modified file and diff'ing it."""
+  checkpoint_dir = os.path.join(work_dir, "checkpoint")
+  extraction_dir = os.path.join(work_dir, "extracted")
+  manifest_dir = os.path.join(work_dir, "manifests")
+  by_package = {}
+  for pkgname in system.package_names():
+    for path in system.package_files[pkgname]:
+      if path in system.modified_paths:
+        by_package.setdefault(pkgname, []).append(path)
+  lines = []
+  for (pkgname, paths) in sorted(by_package.iteritems()):
+    first = "T"
+    for path in paths:
+      lines.append("%s %s %s %s\n" % (first, pkgname,
+                                      system.deb_path(pkgname), path))
+      first = "F"
+  input_data = "".join(lines)
+
+  def extract_and_diff():
+    for d in (checkpoint_dir, extraction_dir, manifest_dir):
+      checkpoint.reset(d)
+    # The diffs themselves aren't interesting here.
+    return _run_stage(_quiet(differ_process.create(extraction_dir,
+                                                   checkpoint_dir,
+                                                   manifest_dir)),
+                      input_data)
+  (seconds, output) = _best_time(repeat, extract_and_diff)
+  result = {"seconds": seconds, "packages": len(by_package),
+            "files": len(lines)}
+  for values in _stats_lines(output):
+    if values["stage"] == stats.DIFFER:
+      result["extraction_seconds"] = values["extraction_seconds"]
+      result["diff_seconds"] = values["diff_seconds"]
+  return result
+
+
+def _check_with_threads(checkpoint_dir, jobs):
+  checkpoint.reset(checkpoint_dir)
+  with open(os.devnull, "w") as devnull:
+    checker = threaded_md5sums_checker.ThreadedMd5sumsChecker(
+        checkpoint_dir, None, None, devnull)
+    for line in jobs:
+      (pkgname, md5sum, _, _, expected_size, path) = (
+          md5sums_checker.parse_job(line))
+      checker.check(pkgname, md5sum, os.stat(path), expected_size, path)
+    checker.close()
+
+
+def _check_with_processes(checkpoint_dir, jobs):
+  checkpoint.reset(checkpoint_dir)
+  _run_stage(parallel_md5sums_checker.create(checkpoint_dir, None, None,
+                                             False),
+             "".join(jobs))
+
+
+def bench_md5_backends(system, work_dir, repeat):
+  """The md5sum pool's worker processes against threads, on the many small
+     files of the synthetic system and on a few huge ones. The files are all
+     in the page cache, so this compares the overheads."""
+  checkpoint_dir = os.path.join(work_dir, "checkpoint")
+  small_jobs = _md5_jobs(system)
+  huge_jobs = []
+  for i in xrange(_HUGE_FILES):
+    path = os.path.join(work_dir, "huge%d" % i)
+    with open(path, "wb") as f:
+      for _ in xrange(_HUGE_FILE_SIZE / (1024 * 1024)):
+        f.write(os.urandom(1024 * 1024))
+    # A wrong md5sum, so that every file is hashed in full.
+    huge_jobs.append(md5sums_checker.format_job("pkg", "0" * 32, os.stat(path),
+                                                None, path))
+  result = {}
+  for (name, jobs) in (("small", small_jobs), ("huge", huge_jobs)):
+    (processes, _) = _best_time(
+        repeat, lambda: _check_with_processes(checkpoint_dir, jobs))
+    (threads, _) = _best_time(
+        repeat, lambda: _check_with_threads(checkpoint_dir, jobs))
+    result[name] = {"files": len(jobs), "process_seconds": processes,
+                    "thread_seconds": threads}
+  return result
+
+
+def _memory_summary(all_values):
+  """Summarizes the memory of the processes of each stage."""
+  summary = {}
+  for values in all_values:
+    if not values.get("memory"):
+      continue
+    stage = summary.setdefault(values["stage"], {"processes": 0})
+    stage["processes"] = stage["processes"] + 1
+    for (name, value) in values["memory"].iteritems():
+      stage["max_" + name] = max(stage.get("max_" + name, 0), value)
+  return summary
+
+
+def bench_fork_server(system, work_dir, repeat):
+  """The memory of the md5sum pool's processes when they are forked after the
+     dpkg database has been loaded, with and without the fork server."""
+  checkpoint_dir = os.path.join(work_dir, "checkpoint")
+  input_data = "".join(_md5_jobs(system))
+
+  def check():
+    checkpoint.reset(checkpoint_dir)
+    (in_read, in_write) = os.pipe()
+    (out_read, _) = launch_helper.launch_stage(
+        parallel_md5sums_checker.create, (checkpoint_dir, None, None, False),
+        [in_read], [in_write])
+    return _memory_summary(_stats_lines(_feed_stage(in_write, out_read,
+                                                    input_data)))
+
+  result = {}
+  # Like apt-diff, start the server before loading anything.
+  launch_helper.start_fork_server()
+  try:
+    dpkg = dpkg_helper.DpkgHelper(dpkg_helper.PathFilter([system.root]),
+                                  system.admin_dir)
+    (result["with_seconds"], result["with"]) = _best_time(repeat, check)
+  finally:
+    launch_helper.stop_fork_server()
+  (result["without_seconds"], result["without"]) = _best_time(repeat, check)
+  del dpkg
+  return result
+
+
+def _have_apt():
+  try:
+    import apt_pkg
+  except ImportError:
+    return False
+  with open(os.devnull, "w") as devnull:
+    return subprocess.call(["which", "apt-get"], stdout = devnull) == 0
+
+
+def bench_end_to_end(system, work_dir, repeat):
+  """A complete run of apt-diff over the synthetic root, fetching from the
+     synthetic archive source."""
+  if not _have_apt():
+    return {"skipped": "python-apt or apt-get is not available"}
+  system.update_apt_lists()
+  tempdir = os.path.join(work_dir, "apt-diff")
+  args = [sys.executable, os.path.join(_SOURCE_DIR, "apt-diff"),
+          "--format=" + findings.NDJSON, "--stats", "--tempdir", tempdir,
+          "--timeout", str(_END_TO_END_TIMEOUT)]
+  for (name, value) in system.apt_options():
+    args.extend(["-o", "%s=%s" % (name, value)])
+  args.append(system.root)
+  env = dict(os.environ)
+  env["PYTHONPATH"] = _SOURCE_DIR
+
+  def run():
+    if os.path.lexists(tempdir):
+      shutil.rmtree(tempdir)
+    os.mkdir(tempdir)
+    with open(os.devnull, "w") as devnull:
+      process = subprocess.Popen(args, stdout = subprocess.PIPE,
+                                 stderr = devnull, env = env)
+      output = process.communicate()[0]
+    return [json.loads(line) for line in output.splitlines()]
+  (seconds, records) = _best_time(repeat, run)
+  result = {"seconds": seconds,
+            "expected_discrepancies": (len(system.modified_paths) +
+                                       len(system.missing_paths))}
+  for rec in records:
+    if rec["type"] == "summary":
+      result["discrepancies"] = rec["discrepancies"]
+      result["errors"] = rec["errors"]
+    elif rec["type"] == "stats":
+      for values in rec["processes"]:
+        if values["stage"] == stats.MAIN:
+          result["dpkg_seconds"] = values["dpkg_seconds"]
+          result["apt_seconds"] = values["apt_seconds"]
+          result["traversal_seconds"] = values["traversal_seconds"]
+        elif values["stage"] == stats.FETCHER:
+          result["fetches"] = len(values["latencies"])
+          result["fetch_seconds"] = sum(values["latencies"])
+        elif values["stage"] == stats.DIFFER:
+          result["extraction_seconds"] = values["extraction_seconds"]
+          result["diff_seconds"] = values["diff_seconds"]
+  return result
+
+_BENCHMARKS = [("dpkg_load", bench_dpkg_load),
+               ("targeted_load", bench_targeted_load),
+               ("sharded_load", bench_sharded_load),
+               ("path_filter", bench_path_filter),
+               ("md5_pool", bench_md5_pool),
+               ("md5_backends", bench_md5_backends),
+               ("fork_server", bench_fork_server),
+               ("extract_diff", bench_extract_diff),
+               ("end_to_end", bench_end_to_end)]
+
+
+def _git_commit():
+  try:
+    with open(os.devnull, "w") as devnull:
+      return subprocess.Popen(["git", "rev-parse", "HEAD"], cwd = _SOURCE_DIR,
+                              stdout = subprocess.PIPE,
+                              stderr = devnull).communicate()[0].strip()
+  except OSError:
+    return None
+
+
+def main(args):
+  try:
+    opts, args = getopt.getopt(
+        args, "",
+        ["packages=", "files-per-package=", "file-size=", "modified=",
+         "missing=", "extra=", "repeat=", "only=", "output=", "workdir=",
+         "help"])
+  except getopt.GetoptError, err:
+    print >> sys.stderr, str(err)
+    print >> sys.stderr, _USAGE
+    return 2
+  if args:
+    print >> sys.stderr, _USAGE
+    return 2
+  params = synthetic.Parameters()
+  repeat = 1
+  only = None
+  output = "benchmark-results.json"
+  work_dir = None
+  try:
+    for (opt, arg) in opts:
+      opt = opt.lstrip("-")
+      if opt == "packages":
+        params.packages = int(arg)
+      elif opt == "files-per-package":
+        params.files_per_package = int(arg)
+      elif opt == "file-size":
+        params.file_size = int(arg)
+      elif opt == "modified":
+        params.modified = float(arg)
+      elif opt == "missing":
+        params.missing = float(arg)
+      elif opt == "extra":
+        params.extra = float(arg)
+      elif opt == "repeat":
+        repeat = int(arg)
+      elif opt == "only":
+        only = arg.split(",")
+      elif opt == "output":
+        output = arg
+      elif opt == "workdir":
+        work_dir = os.path.abspath(arg)
+      elif opt == "help":
+        print _USAGE
+        return 0
+  except ValueError, e:
+    print >> sys.stderr, "Invalid value: %s" % e
+    return 2
+  keep = bool(work_dir)
+  if not work_dir:
+    work_dir = tempfile.mkdtemp(prefix="apt-diff-bench_")
+  elif not os.path.isdir(work_dir):
+    os.makedirs(work_dir)
+  stats.set_enabled(True)
+  try:
+    system = synthetic.System(os.path.join(work_dir, "system"), params)
+    if os.path.exists(system.base_dir):
+      # Left by an earlier run with the same --workdir. What the benchmarks
+      # know of the system is only kept in memory, so generate it again.
+      shutil.rmtree(system.base_dir)
+    print "Generating synthetic system in %s" % system.base_dir
+    start = time.time()
+    system.generate()
+    results = {"generate": {"seconds": time.time() - start}}
+    for (name, function) in _BENCHMARKS:
+      if only and name not in only:
+        continue
+      print "Running %s..." % name
+      bench_dir = os.path.join(work_dir, name)
+      if os.path.exists(bench_dir):
+        shutil.rmtree(bench_dir)
+      os.mkdir(bench_dir)
+      results[name] = function(system, bench_dir, repeat)
+      print "    " + json.dumps(results[name], sort_keys=True)
+  finally:
+    if not keep:
+      shutil.rmtree(work_dir)
+  with open(output, "w") as f:
+    json.dump({"commit": _git_commit(),
+               "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+               "python": platform.python_version(),
+               "parameters": params.to_dict(),
+               "repeat": repeat,
+               "results": results}, f, indent=2, sort_keys=True)
+  print "Wrote %s" % output
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,230 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Generator for a synthetic system to benchmark apt-diff against.
+
+A System consists of:
+  admin/            a dpkg database (status file and info directory)
+  root/             the installed files, some of them modified, missing or
+                    extra
+  repo/             the .debs of every package and a Packages index, usable
+                    as a "file:" APT source
+  apt/              APT configuration and state that point at the above
+
+Installed paths are the absolute paths of the files under root/, so apt-diff
+can check them directly without touching the host's own files.
+"""
+
+import hashlib
+import os
+import random
+import shutil
+import subprocess
+
+# Fraction of packages that ship no .md5sums file.
+_NO_MD5SUMS_FRACTION = 0.1
+# Every package with this index modulo is given a conffile.
+_CONFFILE_EVERY = 5
+_VERSION = "1.0-1"
+_ARCH = "all"
+
+
+class Parameters:
+  """The shape of a synthetic system."""
+
+  def __init__(self, packages=200, files_per_package=20, file_size=4096,
+               modified=0.02, missing=0.01, extra=0.01, seed=0):
+    self.packages = packages
+    self.files_per_package = files_per_package
+    self.file_size = file_size
+    self.modified = modified
+    self.missing = missing
+    self.extra = extra
+    self.seed = seed
+
+  def to_dict(self):
+    return dict(self.__dict__)
+
+
+def _write_deb(staging_dir, deb_path):
+  with open(os.devnull, "w") as devnull:
+    subprocess.check_call(["dpkg-deb", "-Zgzip", "--build", staging_dir,
+                           deb_path], stdout = devnull)
+
+
+class System:
+  """A synthetic system generated in a directory."""
+
+  def __init__(self, base_dir, params):
+    self.base_dir = base_dir
+    self.params = params
+    self.admin_dir = os.path.join(base_dir, "admin")
+    self.root = os.path.join(base_dir, "root")
+    self.repo_dir = os.path.join(base_dir, "repo")
+    self.apt_dir = os.path.join(base_dir, "apt")
+    # Package name to the list of its files' absolute paths.
+    self.package_files = {}
+    # Absolute path to md5sum, for every file as shipped.
+    self.md5sums = {}
+    self.modified_paths = []
+    self.missing_paths = []
+    self.extra_paths = []
+    self.packages_without_md5sums = set()
+
+  def package_names(self):
+    return sorted(self.package_files)
+
+  def deb_path(self, pkgname):
+    return os.path.join(self.repo_dir, "%s_%s_%s.deb" % (pkgname, _VERSION,
+                                                        _ARCH))
+
+  def generate(self):
+    """Creates the whole system."""
+    rng = random.Random(self.params.seed)
+    for d in (self.admin_dir, os.path.join(self.admin_dir, "info"),
+              os.path.join(self.admin_dir, "updates"), self.root,
+              self.repo_dir):
+      os.makedirs(d)
+    status = []
+    packages_index = []
+    for i in xrange(self.params.packages):
+      pkgname = "synthetic%05d" % i
+      if rng.random() < _NO_MD5SUMS_FRACTION:
+        self.packages_without_md5sums.add(pkgname)
+      conffile = None
+      if i % _CONFFILE_EVERY == 0:
+        conffile = os.path.join(self.root, "etc", pkgname + ".conf")
+      self.__generate_package(rng, pkgname, conffile, status, packages_index)
+    with open(os.path.join(self.admin_dir, "status"), "w") as f:
+      f.write("\n".join(status))
+    with open(os.path.join(self.repo_dir, "Packages"), "w") as f:
+      f.write("\n".join(packages_index))
+    self.__perturb(rng)
+    self.__write_apt_config()
+
+  def __generate_package(self, rng, pkgname, conffile, status,
+                         packages_index):
+    staging = os.path.join(self.base_dir, "staging", pkgname)
+    files = []
+    share_dir = os.path.join(self.root, "usr", "share", pkgname)
+    for j in xrange(self.params.files_per_package):
+      files.append(os.path.join(share_dir, "file%04d" % j))
+    if conffile:
+      files.append(conffile)
+    # Every directory from the filesystem root down is owned, as in real
+    # .list files.
+    dirs = set()
+    for path in files:
+      parent = os.path.dirname(path)
+      while parent != "/":
+        dirs.add(parent)
+        parent = os.path.dirname(parent)
+    for path in files:
+      data = ("%0*x" % (self.params.file_size * 2,
+                        rng.getrandbits(self.params.file_size * 8))).decode(
+                            "hex")
+      for dest in (path, staging + path):
+        if not os.path.isdir(os.path.dirname(dest)):
+          os.makedirs(os.path.dirname(dest))
+        with open(dest, "wb") as f:
+          f.write(data)
+      self.md5sums[path] = hashlib.md5(data).hexdigest()
+    self.package_files[pkgname] = files
+    os.makedirs(os.path.join(staging, "DEBIAN"))
+    control = ("Package: %s\nVersion: %s\nArchitecture: %s\n"
+               "Maintainer: Benchmark <benchmark@example.com>\n"
+               "Installed-Size: %d\nDescription: Synthetic package\n" % (
+                   pkgname, _VERSION, _ARCH,
+                   len(files) * self.params.file_size / 1024))
+    with open(os.path.join(staging, "DEBIAN", "control"), "w") as f:
+      f.write(control)
+    if conffile:
+      with open(os.path.join(staging, "DEBIAN", "conffiles"), "w") as f:
+        f.write(conffile + "\n")
+    deb_path = self.deb_path(pkgname)
+    _write_deb(staging, deb_path)
+    shutil.rmtree(staging)
+    # The dpkg database.
+    info_prefix = os.path.join(self.admin_dir, "info", pkgname)
+    with open(info_prefix + ".list", "w") as f:
+      f.write("/.\n")
+      for path in sorted(dirs) + files:
+        f.write(path + "\n")
+    if pkgname not in self.packages_without_md5sums:
+      with open(info_prefix + ".md5sums", "w") as f:
+        for path in files:
+          if path != conffile:
+            f.write("%s  %s\n" % (self.md5sums[path], path[1:]))
+    stanza = control.replace("Architecture:", "Status: install ok installed\n"
+                             "Architecture:", 1)
+    if conffile:
+      stanza = stanza + "Conffiles:\n %s %s\n" % (conffile,
+                                                  self.md5sums[conffile])
+    status.append(stanza)
+    # The archive index.
+    with open(deb_path, "rb") as f:
+      deb_data = f.read()
+    packages_index.append(
+        control + "Filename: ./%s\nSize: %d\nMD5sum: %s\nSHA256: %s\n" % (
+            os.path.basename(deb_path), len(deb_data),
+            hashlib.md5(deb_data).hexdigest(),
+            hashlib.sha256(deb_data).hexdigest()))
+
+  def __perturb(self, rng):
+    """Modifies, removes and adds files according to the parameters."""
+    all_files = sorted(self.md5sums)
+    for path in all_files:
+      r = rng.random()
+      if r < self.params.modified:
+        with open(path, "ab") as f:
+          f.write("modified\n")
+        self.modified_paths.append(path)
+      elif r < self.params.modified + self.params.missing:
+        os.unlink(path)
+        self.missing_paths.append(path)
+    extra_count = int(len(all_files) * self.params.extra)
+    for i in xrange(extra_count):
+      path = os.path.join(os.path.dirname(rng.choice(all_files)),
+                          "extra%05d" % i)
+      with open(path, "w") as f:
+        f.write("extra\n")
+      self.extra_paths.append(path)
+
+  def __write_apt_config(self):
+    for d in ("lists/partial", "cache/archives/partial", "etc"):
+      os.makedirs(os.path.join(self.apt_dir, d))
+    with open(os.path.join(self.apt_dir, "etc", "sources.list"), "w") as f:
+      f.write("deb [trusted=yes] file:%s ./\n" % self.repo_dir)
+
+  def apt_options(self):
+    """Gets the APT options, as (name, value) pairs, that point APT at this
+       system instead of the host."""
+    return [("Dir::State::status", os.path.join(self.admin_dir, "status")),
+            ("Dir::State::Lists", os.path.join(self.apt_dir, "lists")),
+            ("Dir::Cache", os.path.join(self.apt_dir, "cache")),
+            ("Dir::Etc::SourceList",
+             os.path.join(self.apt_dir, "etc", "sources.list")),
+            ("Dir::Etc::SourceParts", os.path.join(self.apt_dir, "etc")),
+            ("Debug::NoLocking", "1")]
+
+  def update_apt_lists(self):
+    """Runs "apt-get update" against the archive source."""
+    args = ["apt-get", "-q", "update"]
+    for (name, value) in self.apt_options():
+      args.extend(["-o", "%s=%s" % (name, value)])
+    with open(os.devnull, "w") as devnull:
+      subprocess.check_call(args, stdout = devnull)
@@ -0,0 +1,164 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Checks that an interrupted run's checkpoint replays what it had completed,
+and nothing that the interruption or later changes to the system made
+unreliable."""
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from apt_diff import checkpoint
+
+_MD5SUM_A = "0123456789abcdef0123456789abcdef"
+_MD5SUM_B = "fedcba9876543210fedcba9876543210"
+
+
+class CheckpointTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.checkpoint_dir = os.path.join(self.tempdir, "checkpoint")
+    checkpoint.reset(self.checkpoint_dir)
+    self.admin_dir = os.path.join(self.tempdir, "admin")
+    os.makedirs(os.path.join(self.admin_dir, "info"))
+    open(os.path.join(self.admin_dir, "status"), "w").close()
+    for pkgname in ("a", "b"):
+      self.write_info_file(pkgname + ".list", "/usr/share/doc/%s\n" % pkgname)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def write_info_file(self, filename, content):
+    """Replaces a file of the dpkg database, as dpkg does."""
+    path = os.path.join(self.admin_dir, "info", filename)
+    with open(path + ".new", "w") as f:
+      f.write(content)
+    os.rename(path + ".new", path)
+
+  def journal_path(self, prefix):
+    return os.path.join(self.checkpoint_dir, prefix + str(os.getpid()))
+
+  def test_replay(self):
+    journal = checkpoint.Journal(self.checkpoint_dir,
+                                 checkpoint.MD5SUMS_JOURNAL)
+    journal.record_md5sum(_MD5SUM_A, "/usr/bin/a", True)
+    journal.record_md5sum(_MD5SUM_B, "/usr/bin/file with spaces", False)
+    journal.close()
+    journal = checkpoint.Journal(self.checkpoint_dir, checkpoint.DIFFS_JOURNAL)
+    journal.record_diff("a", "/etc/a.conf", 0)
+    journal.record_diff("b", "/etc/b.conf", 1)
+    journal.close()
+    self.assertEqual({(_MD5SUM_A, "/usr/bin/a"): True,
+                      (_MD5SUM_B, "/usr/bin/file with spaces"): False},
+                     checkpoint.load_md5sum_verdicts(self.checkpoint_dir))
+    self.assertEqual({("a", "/etc/a.conf"): 0, ("b", "/etc/b.conf"): 1},
+                     checkpoint.load_diff_results(self.checkpoint_dir))
+    # Even when the torn record is long.
+    with open(self.journal_path(checkpoint.DIFFS_JOURNAL), "a") as f:
+      f.write("0 c /" + "c" * 10000)
+    journal = checkpoint.Journal(self.checkpoint_dir, checkpoint.DIFFS_JOURNAL)
+    journal.record_diff("d", "/etc/d.conf", 0)
+    journal.close()
+    self.assertEqual({("a", "/etc/a.conf"): 0, ("b", "/etc/b.conf"): 1,
+                      ("d", "/etc/d.conf"): 0},
+                     checkpoint.load_diff_results(self.checkpoint_dir))
+
+  def test_torn_last_line(self):
+    # The journals of two processes, each cut off mid-record.
+    with open(self.journal_path(checkpoint.MD5SUMS_JOURNAL), "w") as f:
+      f.write("OK %s /usr/bin/a\nBAD %s /usr/bin/b\nOK %s /usr/bi" % (
+          _MD5SUM_A, _MD5SUM_B, _MD5SUM_A))
+    with open(os.path.join(self.checkpoint_dir,
+                           checkpoint.MD5SUMS_JOURNAL + "1"), "w") as f:
+      f.write("OK %s /usr/bin/c\nOK" % _MD5SUM_A)
+    with open(self.journal_path(checkpoint.DIFFS_JOURNAL), "w") as f:
+      f.write("0 a /etc/a.conf\n1 b /etc/b.co")
+    self.assertEqual({(_MD5SUM_A, "/usr/bin/a"): True,
+                      (_MD5SUM_B, "/usr/bin/b"): False,
+                      (_MD5SUM_A, "/usr/bin/c"): True},
+                     checkpoint.load_md5sum_verdicts(self.checkpoint_dir))
+    self.assertEqual({("a", "/etc/a.conf"): 0},
+                     checkpoint.load_diff_results(self.checkpoint_dir))
+    # A resumed run with the same pid appends to the journal after the last
+    # complete record.
+    journal = checkpoint.Journal(self.checkpoint_dir, checkpoint.DIFFS_JOURNAL)
+    journal.record_diff("b", "/etc/b.conf", 1)
+    journal.close()
+    self.assertEqual({("a", "/etc/a.conf"): 0, ("b", "/etc/b.conf"): 1},
+                     checkpoint.load_diff_results(self.checkpoint_dir))
+
+  def test_invalid_record(self):
+    with open(self.journal_path(checkpoint.DIFFS_JOURNAL), "w") as f:
+      f.write("0 a /etc/a.conf\ngarbage\n0 b /etc/b.conf\n")
+    stderr = sys.stderr
+    sys.stderr = StringIO.StringIO()
+    try:
+      results = checkpoint.load_diff_results(self.checkpoint_dir)
+      warnings = sys.stderr.getvalue()
+    finally:
+      sys.stderr = stderr
+    self.assertEqual({("a", "/etc/a.conf"): 0, ("b", "/etc/b.conf"): 0},
+                     results)
+    self.assertTrue("garbage" in warnings)
+
+  def test_position(self):
+    self.assertEqual(None, checkpoint.load_position(self.checkpoint_dir))
+    checkpoint.save_position(self.checkpoint_dir, ["/etc", "/usr"],
+                             "/usr/bin/a")
+    self.assertEqual((["/etc", "/usr"], "/usr/bin/a"),
+                     checkpoint.load_position(self.checkpoint_dir))
+    with open(os.path.join(self.checkpoint_dir, "position"), "w") as f:
+      f.write("/etc\n/usr\n")
+    self.assertEqual(None, checkpoint.load_position(self.checkpoint_dir))
+
+  def test_resume_after_packages_changed(self):
+    self.assertEqual(set(), checkpoint.changed_packages(self.checkpoint_dir,
+                                                        self.admin_dir))
+    # Resumed with nothing changed.
+    self.assertEqual(set(), checkpoint.changed_packages(self.checkpoint_dir,
+                                                        self.admin_dir))
+    # Upgraded, removed and installed while interrupted.
+    self.write_info_file("a.list", "/usr/share/doc/a\n/usr/bin/a\n")
+    os.remove(os.path.join(self.admin_dir, "info", "b.list"))
+    self.write_info_file("c.md5sums", "%s  usr/bin/c\n" % _MD5SUM_A)
+    self.assertEqual(set(["a", "b", "c"]),
+                     checkpoint.changed_packages(self.checkpoint_dir,
+                                                 self.admin_dir))
+    # Still compared with the state before the first interruption, whose
+    # work is still in the journals.
+    self.assertEqual(set(["a", "b", "c"]),
+                     checkpoint.changed_packages(self.checkpoint_dir,
+                                                 self.admin_dir))
+    # Each database is recorded separately, and a new run starts afresh.
+    other_admin_dir = os.path.join(self.tempdir, "other")
+    shutil.copytree(self.admin_dir, other_admin_dir)
+    self.assertEqual(set(), checkpoint.changed_packages(self.checkpoint_dir,
+                                                        other_admin_dir))
+    checkpoint.reset(self.checkpoint_dir)
+    self.assertEqual(set(), checkpoint.changed_packages(self.checkpoint_dir,
+                                                        self.admin_dir))
+
+
+if __name__ == "__main__":
+  unittest.main()
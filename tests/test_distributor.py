@@ -0,0 +1,211 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Checks that the distributor kills workers that hang, hands their work to
+others, and holds up its input while too much work is waiting."""
+
+import errno
+import fcntl
+import os
+import select
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from apt_diff import distributor
+from apt_diff import launch_helper
+
+# How long a worker may take to answer a line before it is killed.
+_TIMEOUT_SECONDS = 0.5
+# How long to wait for output that should arrive.
+_WAIT_SECONDS = 10
+# A worker never answers this line.
+_HANG = "hang\n"
+# A worker waits for the gate file to exist before answering this line.
+_GATE = "gate\n"
+
+
+class DistributorTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.pids_file = os.path.join(self.tempdir, "pids")
+    self.gate_file = os.path.join(self.tempdir, "gate")
+    open(self.pids_file, "w").close()
+
+  def tearDown(self):
+    for pid in self.worker_pids():
+      try:
+        os.kill(pid, signal.SIGKILL)
+      except OSError:
+        pass
+    shutil.rmtree(self.tempdir)
+
+  def worker_pids(self):
+    with open(self.pids_file) as f:
+      return [int(line) for line in f]
+
+  def start(self, **kwargs):
+    """Starts a distributor over workers that answer each line in upper case.
+       Returns the write end of its input and its output."""
+    gate_file = self.gate_file
+    pids_file = self.pids_file
+
+    def worker(input_files, output_file):
+      for line in iter(input_files[0].readline, ""):
+        if line == _HANG:
+          time.sleep(3600)
+        elif line == _GATE:
+          while not os.path.exists(gate_file):
+            time.sleep(0.05)
+        output_file.write(line.upper())
+        output_file.flush()
+
+    def spawner():
+      (in_read, in_write) = os.pipe()
+      (out_read, pid) = launch_helper.launch(worker, [in_read], [in_write])
+      with open(pids_file, "a") as f:
+        f.write("%d\n" % pid)
+      return (os.fdopen(in_write, "w"), os.fdopen(out_read, "r"), pid)
+
+    def run(input_files, output_file):
+      distributor.run(input_files[0], output_file, spawner, max_processes=1,
+                      timeout_function=lambda line: "timeout " + line,
+                      **kwargs)
+
+    (in_read, in_write) = os.pipe()
+    (out_read, self.pid) = launch_helper.launch(run, [in_read], [in_write])
+    return (in_write, out_read)
+
+  def read_output(self, out_read, count=None):
+    """Reads lines of output until there are count of them or it ends."""
+    lines = []
+    partial = ""
+    deadline = time.time() + _WAIT_SECONDS
+    while count is None or len(lines) < count:
+      (readable, _, _) = select.select([out_read], [], [],
+                                       max(deadline - time.time(), 0))
+      self.assertTrue(readable, "Timed out after %s" % lines)
+      data = os.read(out_read, 4096)
+      if not data:
+        self.assertEqual("", partial)
+        break
+      data = partial + data
+      lines.extend([line + "\n" for line in data.split("\n")[:-1]])
+      partial = data.split("\n")[-1]
+    return lines
+
+  def finish(self, out_read):
+    """Checks that the output and the distributor end, and that no worker is
+       left behind."""
+    self.assertEqual([], self.read_output(out_read))
+    os.close(out_read)
+    (_, status) = os.waitpid(self.pid, 0)
+    self.assertEqual(0, status)
+    for pid in self.worker_pids():
+      self.assertRaises(OSError, os.kill, pid, 0)
+
+  def test_kill_requeues_to_new_worker(self):
+    (in_write, out_read) = self.start(timeout=_TIMEOUT_SECONDS)
+    os.write(in_write, "a\n" + _HANG + "b\nc\n")
+    self.assertEqual(["A\n", "timeout hang\n", "B\n", "C\n"],
+                     self.read_output(out_read, 4))
+    self.assertEqual(2, len(self.worker_pids()))
+    # The new worker takes further input.
+    os.write(in_write, "d\n")
+    self.assertEqual(["D\n"], self.read_output(out_read, 1))
+    os.close(in_write)
+    self.finish(out_read)
+
+  def test_kill_after_input_closed(self):
+    (in_write, out_read) = self.start(timeout=_TIMEOUT_SECONDS)
+    # The inputs of the workers are all closed by the time the hung one is
+    # killed, so its work goes to a new worker whose input is closed in turn.
+    os.write(in_write, "a\n" + _HANG + "b\nc\n")
+    os.close(in_write)
+    self.assertEqual(["A\n", "timeout hang\n", "B\n", "C\n"],
+                     self.read_output(out_read, 4))
+    # Without waiting for the new worker to be retired.
+    start = time.time()
+    self.finish(out_read)
+    self.assertTrue(time.time() - start < distributor._IDLE_SECONDS)
+    self.assertEqual(2, len(self.worker_pids()))
+
+  def test_kill_of_every_line(self):
+    (in_write, out_read) = self.start(timeout=_TIMEOUT_SECONDS)
+    os.write(in_write, _HANG * 3)
+    os.close(in_write)
+    self.assertEqual(["timeout hang\n"] * 3, self.read_output(out_read, 3))
+    self.finish(out_read)
+    self.assertEqual(3, len(self.worker_pids()))
+
+  def test_max_queued_pauses_and_resumes_input(self):
+    (in_write, out_read) = self.start(max_queued=10)
+    os.write(in_write, _GATE)
+    # While the worker is held up, the input is not read, so it fills up.
+    flags = fcntl.fcntl(in_write, fcntl.F_GETFL)
+    fcntl.fcntl(in_write, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    line = "x" * 99 + "\n"
+    written = 0
+    deadline = time.time() + _WAIT_SECONDS
+    while time.time() < deadline:
+      try:
+        written = written + os.write(in_write, line)
+      except OSError, e:
+        if e.errno != errno.EAGAIN:
+          raise
+        # Give the distributor the chance to read more.
+        time.sleep(0.5)
+        try:
+          written = written + os.write(in_write, line)
+        except OSError, e:
+          if e.errno != errno.EAGAIN:
+            raise
+          break
+    self.assertTrue(time.time() < deadline, "The input was never held up")
+    self.assertEqual(0, written % len(line))
+    fcntl.fcntl(in_write, fcntl.F_SETFL, flags)
+    # Letting the worker go reads the rest.
+    open(self.gate_file, "w").close()
+    os.write(in_write, "y\n")
+    os.close(in_write)
+    output = self.read_output(out_read)
+    self.assertEqual(
+        [_GATE.upper()] + [line.upper()] * (written / len(line)) + ["Y\n"],
+        output)
+    self.finish(out_read)
+
+  def test_kill_resumes_paused_input(self):
+    (in_write, out_read) = self.start(timeout=_TIMEOUT_SECONDS, max_queued=2)
+    os.write(in_write, _HANG * 2)
+    # Only read once a hung worker is killed, since nothing is ever answered
+    # otherwise.
+    time.sleep(_TIMEOUT_SECONDS / 2)
+    os.write(in_write, "b\n")
+    os.close(in_write)
+    self.assertEqual(["timeout hang\n", "timeout hang\n", "B\n"],
+                     self.read_output(out_read, 3))
+    self.finish(out_read)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,106 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Checks the paths that a PathFilter includes against a plain scan of its
+paths."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from apt_diff import dpkg_helper
+
+_PATHS = ["/", "/etc", "/etc/apt", "/etc/apt/sources.list", "/etcetera",
+          "/usr", "/usr/lib", "/usr/lib/x", "/usr/lib/x/y", "/usr/lib64",
+          "/usr/lib64/x", "/usr/lib-old", "/usr/lib.so", "/usr/libexec",
+          "/usr/li", "/usr/share", "/usr/share/doc", "/var", "/var/lib/dpkg"]
+
+
+def _included(filter_paths, p):
+  for filter_path in filter_paths:
+    filter_path = filter_path.rstrip("/") or "/"
+    if (filter_path == "/" or p == filter_path or
+        p.startswith(filter_path + "/")):
+      return True
+  return False
+
+
+class PathFilterTest(unittest.TestCase):
+
+  def check(self, filter_paths):
+    path_filter = dpkg_helper.PathFilter(filter_paths)
+    expected = [p for p in _PATHS if _included(filter_paths, p)]
+    self.assertEqual(expected, [p for p in _PATHS if path_filter.includes(p)])
+    self.assertEqual(expected, list(path_filter.filter(_PATHS)))
+    return path_filter
+
+  def test_nested(self):
+    path_filter = self.check(["/usr/lib/x", "/usr/lib", "/usr/lib/x/y"])
+    self.assertEqual(["/usr/lib"], path_filter.outermost_paths())
+
+  def test_siblings(self):
+    path_filter = self.check(["/usr/share", "/usr/lib", "/etc/apt"])
+    self.assertEqual(["/etc/apt", "/usr/lib", "/usr/share"],
+                     path_filter.outermost_paths())
+
+  def test_prefix_collision(self):
+    path_filter = self.check(["/usr/lib"])
+    self.assertFalse(path_filter.includes("/usr/lib64"))
+    self.assertFalse(path_filter.includes("/usr/lib-old"))
+    self.assertFalse(path_filter.includes("/usr/lib.so"))
+    self.assertFalse(path_filter.includes("/usr/li"))
+    self.assertTrue(path_filter.includes("/usr/lib/x/y"))
+    path_filter = self.check(["/usr/lib64", "/usr/lib-old", "/etc"])
+    self.assertFalse(path_filter.includes("/usr/lib"))
+    self.assertFalse(path_filter.includes("/etcetera"))
+    self.assertEqual(["/etc", "/usr/lib-old", "/usr/lib64"],
+                     path_filter.outermost_paths())
+
+  def test_trailing_slash(self):
+    path_filter = self.check(["/usr/lib/"])
+    self.assertEqual(["/usr/lib"], path_filter.outermost_paths())
+
+  def test_everything(self):
+    path_filter = self.check(["/usr", "/"])
+    self.assertTrue(path_filter.includes_all())
+    self.assertEqual(["/"], path_filter.outermost_paths())
+    self.assertTrue(path_filter.filter(_PATHS) is _PATHS)
+
+  def test_nothing(self):
+    path_filter = self.check([])
+    self.assertFalse(path_filter.includes_all())
+    self.assertEqual([], path_filter.outermost_paths())
+
+  def test_filter_keeps_order_and_duplicates(self):
+    path_filter = dpkg_helper.PathFilter(["/usr/lib"])
+    self.assertEqual(["/usr/lib/x", "/usr/lib", "/usr/lib/x"],
+                     path_filter.filter(["/usr/lib/x", "/usr/lib64", "/usr/lib",
+                                         "/usr/lib/x", "/etc"]))
+
+  def test_filtered_entries(self):
+    path_filter = dpkg_helper.PathFilter(["/usr/lib"])
+    entries = [("a", "/usr/lib/x"), ("b", "/usr/lib64"), ("c", "/usr/lib/x"),
+               ("d", "/usr/lib")]
+    self.assertEqual([("a", "/usr/lib/x"), ("c", "/usr/lib/x"),
+                      ("d", "/usr/lib")],
+                     dpkg_helper._filtered(path_filter, iter(entries), 1))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,209 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Checks that the path index says what the info files of a dpkg database say,
+as the packages change."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from apt_diff import dpkg_helper
+from apt_diff import path_index
+
+_MD5SUM_A = "0123456789abcdef0123456789abcdef"
+_MD5SUM_B = "fedcba9876543210fedcba9876543210"
+
+# The .list and .md5sums of each package. /usr/share/doc and /usr/lib/libx.so
+# have several owners, and /usr/lib64 shares a prefix with /usr/lib.
+_PACKAGES = {
+    "a": (["/.", "/usr", "/usr/lib", "/usr/lib/libx.so", "/usr/share",
+           "/usr/share/doc", "/usr/share/doc/a"],
+          {"/usr/lib/libx.so": _MD5SUM_A, "/usr/share/doc/a": _MD5SUM_A}),
+    "b": (["/.", "/usr", "/usr/lib", "/usr/lib/libx.so", "/usr/lib64",
+           "/usr/lib64/liby.so", "/usr/share", "/usr/share/doc"],
+          {"/usr/lib/libx.so": _MD5SUM_B, "/usr/lib64/liby.so": _MD5SUM_B,
+           # Not in its .list.
+           "/usr/share/doc/b": _MD5SUM_B}),
+    "c": (["/.", "/etc", "/etc/c.conf"], {}),
+}
+
+
+class PathIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.admin_dir = os.path.join(self.tempdir, "admin")
+    os.makedirs(os.path.join(self.admin_dir, "info"))
+    self.packages = {}
+    for (pkgname, (listed, md5sums)) in _PACKAGES.iteritems():
+      self.write_package(pkgname, listed, md5sums)
+    with open(os.path.join(self.admin_dir, "status"), "w") as f:
+      for pkgname in sorted(_PACKAGES):
+        f.write("Package: %s\nStatus: install ok installed\n"
+                "Maintainer: nobody\nDescription: test\nVersion: 1\n"
+                "Architecture: all\n" % pkgname)
+        if pkgname == "c":
+          f.write("Conffiles:\n /etc/c.conf %s\n" % _MD5SUM_A)
+        f.write("\n")
+    self.index = path_index.PathIndex(os.path.join(self.tempdir, "index"),
+                                      self.admin_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def write_package(self, pkgname, listed, md5sums):
+    """Replaces the info files of a package, as dpkg does."""
+    self.packages[pkgname] = (listed, md5sums)
+    for (ext, lines) in (
+        (".list", [p + "\n" for p in listed]),
+        (".md5sums", ["%s  %s\n" % (md5sum, p[1:])
+                      for (p, md5sum) in sorted(md5sums.iteritems())])):
+      path = os.path.join(self.admin_dir, "info", pkgname + ext)
+      with open(path + ".new", "w") as f:
+        f.writelines(lines)
+      os.rename(path + ".new", path)
+
+  def remove_package(self, pkgname):
+    del self.packages[pkgname]
+    for ext in (".list", ".md5sums"):
+      os.remove(os.path.join(self.admin_dir, "info", pkgname + ext))
+
+  def expected(self, normpath="/"):
+    """Gets the entries that a scan of normpath should yield."""
+    entries = {}
+    for (pkgname, (listed, md5sums)) in self.packages.iteritems():
+      for p in listed:
+        entries[(os.path.normpath(p), pkgname)] = (True, None)
+      for (p, md5sum) in md5sums.iteritems():
+        entries[(p, pkgname)] = (entries.get((p, pkgname), (False,))[0],
+                                 md5sum)
+    prefix = normpath.rstrip("/") + "/"
+    return sorted([(p, pkgname, listed, md5sum)
+                   for ((p, pkgname), (listed, md5sum)) in entries.iteritems()
+                   if p == normpath or p.startswith(prefix)])
+
+  def scan(self, normpath="/"):
+    mapped_index = self.index.open()
+    try:
+      return list(mapped_index.scan(normpath))
+    finally:
+      mapped_index.close()
+
+  def lookup(self, normpath):
+    mapped_index = self.index.open()
+    try:
+      return mapped_index.lookup(normpath)
+    finally:
+      mapped_index.close()
+
+  def records_inode(self):
+    return os.stat(self.index.records_path()).st_ino
+
+  def check_dpkg_state(self):
+    """Checks that the dpkg state loads the same from the index as from the
+       info files."""
+    path_filter = dpkg_helper.PathFilter(["/"])
+    from_info = dpkg_helper.DpkgHelper(path_filter, self.admin_dir)
+    from_index = dpkg_helper.DpkgHelper(path_filter, self.admin_dir,
+                                        index=self.index)
+    for (p, _, _, _) in self.expected():
+      nodes = (from_info.lookup(p), from_index.lookup(p))
+      if nodes[0].children():
+        # Which owners of a directory are recorded depends on the load order.
+        self.assertEqual(len(nodes[0].owners()), len(nodes[1].owners()))
+      else:
+        self.assertEqual(sorted(nodes[0].owners()), sorted(nodes[1].owners()))
+      self.assertEqual(
+          *[dict([(pkgname, (pkg_info.md5sum(), pkg_info.conffile_status()))
+                  for (pkgname, pkg_info) in node.package_info().iteritems()])
+            for node in nodes])
+
+  def test_round_trip(self):
+    self.assertEqual(3, self.index.update())
+    self.assertEqual(self.expected(), self.scan())
+    self.assertEqual([("c", "/etc/c.conf", _MD5SUM_A, False)],
+                     list(self.index.conffiles()))
+    self.check_dpkg_state()
+
+  def test_lookup_with_several_owners(self):
+    self.index.update()
+    self.assertEqual([("a", True, _MD5SUM_A), ("b", True, _MD5SUM_B)],
+                     self.lookup("/usr/lib/libx.so"))
+    self.assertEqual([("a", True, None), ("b", True, None)],
+                     self.lookup("/usr/share/doc"))
+    self.assertEqual([("b", False, _MD5SUM_B)],
+                     self.lookup("/usr/share/doc/b"))
+    self.assertEqual([], self.lookup("/usr/share/doc/c"))
+    self.assertEqual(["a", "b"], sorted(self.index.owners(["/usr/lib"])))
+
+  def test_scan_of_subtree(self):
+    self.index.update()
+    for normpath in ("/usr/lib", "/usr/lib64", "/usr/share/doc", "/etc",
+                     "/usr/lib/libx.so", "/nonexistent"):
+      self.assertEqual(self.expected(normpath), self.scan(normpath))
+    self.assertFalse([p for (p, _, _, _) in self.scan("/usr/lib")
+                      if p.startswith("/usr/lib64")])
+
+  def test_update_merges_changes(self):
+    self.index.update()
+    self.assertEqual(0, self.index.update())
+    # Change one package, remove another and add a new one, all sharing
+    # paths with the others.
+    listed = _PACKAGES["a"][0] + ["/usr/lib/libz.so"]
+    self.write_package("a", listed, {"/usr/lib/libx.so": _MD5SUM_B})
+    self.remove_package("b")
+    self.write_package("d", ["/.", "/usr", "/usr/share", "/usr/share/doc",
+                             "/usr/share/doc/b"], {})
+    self.assertEqual(3, self.index.update())
+    self.assertEqual(self.expected(), self.scan())
+    self.assertEqual(self.expected("/usr/lib"), self.scan("/usr/lib"))
+    self.assertEqual([("a", True, _MD5SUM_B)],
+                     self.lookup("/usr/lib/libx.so"))
+    self.assertEqual([("d", True, None)], self.lookup("/usr/share/doc/b"))
+    self.check_dpkg_state()
+    # And again, on top of the changes so far.
+    self.write_package("b", *_PACKAGES["b"])
+    self.assertEqual(1, self.index.update())
+    self.assertEqual(self.expected(), self.scan())
+    self.check_dpkg_state()
+
+  def test_small_changes_leave_the_records_file(self):
+    for i in xrange(100):
+      self.write_package("filler%d" % i, ["/opt/filler%d" % i], {})
+    self.index.update()
+    inode = self.records_inode()
+    self.write_package("c", ["/.", "/etc", "/etc/c.conf", "/etc/c2.conf"], {})
+    self.index.update()
+    self.assertEqual(inode, self.records_inode())
+    self.assertEqual(self.expected(), self.scan())
+    # Enough changes are merged into a new records file.
+    for i in xrange(50):
+      self.write_package("filler%d" % i, ["/opt/filler%d" % i,
+                                          "/opt/filler%d/new" % i], {})
+    self.index.update()
+    self.assertNotEqual(inode, self.records_inode())
+    self.assertEqual(self.expected(), self.scan())
+    self.check_dpkg_state()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,93 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Checks that the files of a root are found by following their symlinks the
+way they would be followed from inside the root."""
+
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from apt_diff import root_helper
+
+
+class ResolverTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.root, "usr/lib/x"))
+    os.mkdir(os.path.join(self.root, "usr/bin"))
+    os.mkdir(os.path.join(self.root, "etc"))
+    open(os.path.join(self.root, "usr/lib/x/real"), "w").close()
+    os.symlink("/usr/lib/x/real", os.path.join(self.root, "usr/bin/absolute"))
+    os.symlink("../lib/x/real", os.path.join(self.root, "usr/bin/relative"))
+    os.symlink("../../../../../etc", os.path.join(self.root, "usr/bin/up"))
+    os.symlink("/usr/lib", os.path.join(self.root, "lib"))
+    os.symlink("/etc/loop", os.path.join(self.root, "etc/loop"))
+    self.resolver = root_helper.Resolver(self.root)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def host_path(self, normpath, follow=True):
+    return self.resolver.host_path(self.root + normpath, follow)
+
+  def test_absolute_symlink_stays_in_root(self):
+    self.assertEqual(self.root + "/usr/lib/x/real",
+                     self.host_path("/usr/bin/absolute"))
+    self.assertEqual(self.root + "/usr/bin/absolute",
+                     self.host_path("/usr/bin/absolute", False))
+
+  def test_relative_symlink(self):
+    self.assertEqual(self.root + "/usr/lib/x/real",
+                     self.host_path("/usr/bin/relative"))
+
+  def test_parent_goes_no_higher_than_root(self):
+    self.assertEqual(self.root + "/etc", self.host_path("/usr/bin/up"))
+
+  def test_symlinked_directory(self):
+    self.assertEqual(self.root + "/usr/lib/x/real",
+                     self.host_path("/lib/x/real", False))
+    self.assertEqual(self.root + "/usr/lib", self.host_path("/lib"))
+    self.assertEqual(self.root + "/lib", self.host_path("/lib", False))
+
+  def test_root(self):
+    self.assertEqual(self.root, self.host_path(""))
+    self.assertEqual("/usr/lib", root_helper.resolve(self.root, "/lib/x/.."))
+
+  def test_loop(self):
+    self.assertEqual(None, root_helper.resolve(self.root, "/etc/loop"))
+    try:
+      self.host_path("/etc/loop")
+    except OSError, e:
+      self.assertEqual(errno.ELOOP, e.errno)
+    else:
+      self.fail("No error for a symlink loop")
+
+  def test_no_root(self):
+    resolver = root_helper.Resolver("")
+    self.assertEqual("/usr/bin/absolute",
+                     resolver.host_path("/usr/bin/absolute"))
+
+
+if __name__ == "__main__":
+  unittest.main()
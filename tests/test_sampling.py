@@ -0,0 +1,74 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Checks that consecutive sampled runs check every file exactly once, with
+the run number kept in the tempdir."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from apt_diff import api
+from apt_diff import main
+
+_PATHS = ["/etc/hostname", "/usr/bin/bash", "/usr/lib/os-release",
+          "/usr/share/doc/bash/copyright"] + [
+              "/usr/share/man/man1/page%d.1.gz" % i for i in xrange(100)]
+
+
+class SamplingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def run_check(self, sample, targets):
+    """Plays a sampled check that completes. Returns the paths that it
+       checks."""
+    key = api._sample_run_key(sample, targets)
+    run = api._load_sample_run(self.tempdir, key)
+    api._save_sample_run(self.tempdir, key, run + 1)
+    return [path for path in _PATHS
+            if main.sample_slice(path, sample) == run % sample]
+
+  def test_consecutive_runs_check_every_path_once(self):
+    for sample in (2, 3, 7):
+      checked = []
+      for _ in xrange(sample):
+        checked.extend(self.run_check(sample, ["/"]))
+      self.assertEqual(sorted(_PATHS), sorted(checked))
+
+  def test_other_checks_keep_the_slices(self):
+    # Other numbers of slices and other targets in between don't skip any
+    # slice.
+    checked = []
+    for _ in xrange(3):
+      checked.extend(self.run_check(3, ["/"]))
+      self.run_check(2, ["/"])
+      self.run_check(3, ["/usr"])
+      self.run_check(3, ["/", "package bash"])
+    self.assertEqual(sorted(_PATHS), sorted(checked))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,105 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Checks that sharding the dpkg state assigns every path to exactly one
+shard."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from apt_diff import dpkg_helper
+
+# A tree deeper than the shard depth, with directories at every level above
+# it.
+_PATHS = ["/", "/etc", "/etc/apt", "/etc/apt/apt.conf.d",
+          "/etc/apt/apt.conf.d/01autoremove"]
+for _i in xrange(20):
+  _PATHS.extend(["/usr/share/doc/pkg%d" % _i,
+                 "/usr/share/doc/pkg%d/copyright" % _i,
+                 "/usr/share/doc/pkg%d/examples" % _i,
+                 "/usr/share/doc/pkg%d/examples/a/b/c" % _i,
+                 "/usr/lib/lib%d.so" % _i,
+                 "/var/lib/pkg%d" % _i])
+_PATHS.extend(["/usr", "/usr/share", "/usr/share/doc", "/usr/lib", "/var",
+               "/var/lib"])
+_PATHS.sort()
+
+
+class ShardTest(unittest.TestCase):
+
+  def test_subtrees_stay_together(self):
+    depth = dpkg_helper.SHARD_DEPTH
+    for p in _PATHS:
+      if dpkg_helper.path_depth(p) > depth + 1:
+        self.assertEqual(dpkg_helper.shard_of(os.path.dirname(p), 7),
+                         dpkg_helper.shard_of(p, 7))
+
+  def check_partition(self, path_filter):
+    included = [p for p in _PATHS if path_filter.includes(p)]
+    outermost = set(path_filter.outermost_paths())
+    for shards in (2, 3, 5, 8):
+      seen = []
+      used = 0
+      for shard in xrange(shards):
+        shard_filter = dpkg_helper.ShardFilter(path_filter, shard, shards)
+        filtered = shard_filter.filter(_PATHS)
+        # The same paths one at a time.
+        self.assertEqual(filtered,
+                         [p for p in _PATHS if shard_filter.includes(p)])
+        seen.extend([p for p in filtered if p not in outermost])
+        if len(filtered) > len(outermost):
+          used = used + 1
+      self.assertTrue(used > 1)
+      # The outermost paths are in every shard so that they can be looked
+      # up, and every other path is in exactly one.
+      self.assertEqual(sorted([p for p in included if p not in outermost]),
+                       sorted(seen))
+
+  def test_shard_filters_partition_paths(self):
+    self.check_partition(dpkg_helper.PathFilter(["/usr", "/etc/apt"]))
+
+  def test_shard_filters_partition_everything(self):
+    # Including the directories above the shard depth.
+    self.check_partition(dpkg_helper.PathFilter(["/"]))
+
+  def test_shallow_directories_are_noted(self):
+    # The children of a directory no deeper than the shard depth are in other
+    # shards than it, so each shard notes that the directory has children,
+    # without loading the children themselves.
+    path_filter = dpkg_helper.PathFilter(["/"])
+    shards = 4
+    for shard in xrange(shards):
+      shard_filter = dpkg_helper.ShardFilter(path_filter, shard, shards)
+      filtered = shard_filter.filter(_PATHS)
+      self.assertEqual(len(set(filtered)), len(filtered))
+      for p in ("/", "/usr", "/usr/share", "/usr/share/doc",
+                "/usr/share/doc/pkg0", "/etc/apt/apt.conf.d"):
+        self.assertTrue(shard_filter.has_children(p))
+      self.assertFalse(shard_filter.has_children("/usr/lib/lib0.so"))
+      self.assertFalse(shard_filter.has_children("/srv"))
+
+  def test_single_shard_is_everything(self):
+    path_filter = dpkg_helper.PathFilter(["/"])
+    shard_filter = dpkg_helper.ShardFilter(path_filter, 0, 1)
+    self.assertEqual(_PATHS, shard_filter.filter(_PATHS))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,70 @@
+# Copyright (c) 2010 Tristan Schmelcher <tristan_schmelcher@alumni.uwaterloo.ca>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Checks that findings stream out of the processing pipeline as they are
+found, rather than when the input runs out."""
+
+import os
+import select
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from apt_diff import differ_process
+from apt_diff import findings
+from apt_diff import launch_helper
+
+# How long to wait for a record that should arrive right away.
+_TIMEOUT_SECONDS = 10
+
+
+class StreamingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    for name in ("checkpoint", "extracted", "manifests"):
+      os.mkdir(os.path.join(self.tempdir, name))
+    
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def test_differ_passes_records_on_before_eof(self):
+    differ = differ_process.create(os.path.join(self.tempdir, "extracted"),
+                                   os.path.join(self.tempdir, "checkpoint"),
+                                   os.path.join(self.tempdir, "manifests"))
+    (in_read, in_write) = os.pipe()
+    (out_read, pid) = launch_helper.launch(differ, [in_read], [in_write])
+    # Play a slow APT fetch stage: send one finding, then hold the pipe open.
+    line = findings.encode(findings.record(findings.ERROR, "Timed out",
+                                           packages=["pkg"]))
+    os.write(in_write, line)
+    try:
+      (readable, _, _) = select.select([out_read], [], [], _TIMEOUT_SECONDS)
+      self.assertTrue(readable, "No record before the end of the input")
+      output = os.fdopen(out_read, "r")
+      self.assertEqual(line, output.readline())
+    finally:
+      os.close(in_write)
+      os.waitpid(pid, 0)
+    output.close()
+
+
+if __name__ == "__main__":
+  unittest.main()